@@ -0,0 +1,59 @@
+import argparse
+import os
+import socket
+
+from dotenv import load_dotenv
+
+from workers.build_agent import RemoteBuildAgent
+from workers.log_pipeline import LogPipeline
+
+
+# Load the environment variables
+load_dotenv()
+
+
+if __name__ == "__main__":
+
+    # Configure logging, records are written by a background thread
+    LogPipeline.setup(default_sinks="stderr")
+
+    # Allowing to pass the server and agent name at runtime
+    parser = argparse.ArgumentParser(description="Simple Continuous Integration Agent")
+
+    # Server
+    parser.add_argument(
+        "--server",
+        type=str,
+        default="http://127.0.0.1:8080",
+        help="Address of the CI server",
+    )
+
+    # Name
+    parser.add_argument(
+        "--name",
+        type=str,
+        default=f"{socket.gethostname()}-{os.getpid()}",
+        help="Name of the agent, must be unique",
+    )
+
+    # Poll interval
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=5,
+        help="Seconds to wait before polling an empty queue again",
+    )
+
+    args = parser.parse_args()
+
+    agent = RemoteBuildAgent(
+        name=args.name,
+        server_url=args.server,
+        token=os.getenv("CI_AGENT_TOKEN", ""),
+        poll_interval=args.poll_interval,
+    )
+
+    try:
+        agent.run_forever()
+    except KeyboardInterrupt:
+        agent.stop()
@@ -0,0 +1,439 @@
+import base64
+import binascii
+import functools
+import hashlib
+import json
+
+from typing import Callable, Iterator
+
+from flask import Blueprint, Response, request
+
+from workers.batch_diff import BatchDiff
+from workers.case_history import CaseHistory
+from workers.database import DBWorker
+from workers.enums import BuildStage
+
+
+api = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+
+class ApiError(Exception):
+    """
+    Error of a request to the API, returned as a json error with its status code.
+
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def api_error(error: ApiError):
+    return {"status": "error", "message": error.message}, error.status
+
+
+# Default and maximum number of items of a page, limit=all streams the whole list
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def selected_fields(available: tuple) -> list[str]:
+    """
+    Fields asked with ?fields=id,total, every field by default.
+
+    Raises:
+        ApiError if a field does not exist
+
+    """
+    if not (fields := request.args.get("fields")):
+        return list(available)
+
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+
+    if unknown := [field for field in fields if field not in available]:
+        raise ApiError(
+            f"unknown fields: {', '.join(unknown)}, available: {', '.join(available)}"
+        )
+
+    return fields
+
+
+def page_limit() -> int:
+    """
+    Number of items asked with ?limit=, None for limit=all.
+
+    """
+    limit = request.args.get("limit", str(DEFAULT_LIMIT))
+
+    if limit == "all":
+        return None
+
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_LIMIT:
+        raise ApiError(f"limit must be between 1 and {MAX_LIMIT}, or all")
+
+    return int(limit)
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode()
+
+
+def page_cursor() -> int:
+    """
+    Id of the last item of the previous page, from the opaque ?cursor= value.
+
+    """
+    if not (cursor := request.args.get("cursor")):
+        return None
+
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["id"])
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ApiError("invalid cursor")
+
+
+def not_modified(version: str) -> tuple[str, Response]:
+    """
+    ETag of the asked representation, and a 304 response if the client has it.
+
+    Params:
+        version: value changing whenever the data of the resource changes
+
+    """
+    etag = hashlib.sha1(f"{version}:{request.full_path}".encode()).hexdigest()
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return etag, response
+
+    return etag, None
+
+
+def stream_list(
+    records: Iterator[dict],
+    fields: list[str],
+    limit: int,
+    etag: str,
+    extra: dict = None,
+) -> Response:
+    """
+    Stream a page of records as {"data": [...], "next_cursor": ...}.
+
+    The records are read one at a time, so exporting a whole history
+    with limit=all never holds it in memory.
+
+    Params:
+        records: iterator of limit + 1 records, the extra one means there is a next page
+        fields: the fields of each record to send
+        limit: the size of the page, None if the whole list is sent
+        etag: the ETag of the response
+        extra: other keys of the response, sent before the data
+
+    """
+
+    def generate() -> Iterator[str]:
+        yield "{"
+
+        for key, value in (extra or {}).items():
+            yield f"{json.dumps(key)}: {json.dumps(value, default=str)}, "
+
+        yield '"data": ['
+
+        last_id, next_cursor = None, None
+
+        for index, record in enumerate(records):
+            if limit is not None and index == limit:
+                next_cursor = encode_cursor(last_id)
+                break
+
+            yield ("" if index == 0 else ", ") + json.dumps(
+                {field: record[field] for field in fields}, default=str
+            )
+            last_id = record["id"]
+
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+    response = Response(generate(), mimetype="application/json")
+    response.set_etag(etag)
+
+    return response
+
+
+def one_more(limit: int) -> int:
+    return None if limit is None else limit + 1
+
+
+def single(record: dict, fields: list[str], etag: str) -> Response:
+    response = Response(
+        json.dumps({field: record[field] for field in fields}, default=str),
+        mimetype="application/json",
+    )
+    response.set_etag(etag)
+
+    return response
+
+
+def conditional(version: Callable[[], str]) -> Callable:
+    """
+    Decorator answering 304 when the client has the current version of the
+    resource, the view gets the etag to set on its response.
+
+    """
+
+    def decorator(view: Callable) -> Callable:
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            etag, response = not_modified(version(**kwargs))
+
+            return response or view(etag=etag, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+PROJECT_FIELDS = ("id", "name", "test_file", "github_url", "target_branch", "last_batch_id")
+
+BATCH_FIELDS = (
+    "id",
+    "project_id",
+    "errors",
+    "failures",
+    "skipped",
+    "total",
+    "execution_time",
+    "datetime",
+    "cached_from",
+)
+
+BATCH_DETAIL_FIELDS = BATCH_FIELDS + ("timings", "pipeline")
+
+CASE_FIELDS = ("id", "name", "duration", "outcome")
+
+DIFF_FIELDS = ("batch_id", "base_batch_id", "counts", "duration_delta") + BatchDiff.kinds
+
+TEST_FIELDS = (
+    ("id", "name", "runs")
+    + CaseHistory.OUTCOMES
+    + ("failure_rate", "mean", "p50", "p90", "p99")
+)
+
+# Tests are sorted by name, or by one of these fields, the greatest first
+TEST_SORTS = ("runs", "failure_rate", "mean", "p50", "p90", "p99")
+
+# Batches of the history of /tests by default
+DEFAULT_TEST_BATCHES = 100
+
+
+def projects_version() -> str:
+    db_worker = DBWorker()
+
+    # The last batch of each project is part of the list
+    return f"{db_worker.get_projects_version()}:{db_worker.get_test_batches_version()}"
+
+
+def get_project(project_id: int) -> dict:
+    """
+    Raises:
+        ApiError if the project does not exist
+
+    """
+    project = next(DBWorker().iter_projects(project_id - 1, 1), None)
+
+    if project is None or project["id"] != project_id:
+        raise ApiError("project not found", 404)
+
+    return project
+
+
+def get_batch(batch_id: int) -> dict:
+    """
+    Raises:
+        ApiError if the batch does not exist
+
+    """
+    batch = next(DBWorker().iter_test_batches(before_id=batch_id + 1, limit=1), None)
+
+    if batch is None or batch["id"] != batch_id:
+        raise ApiError("batch not found", 404)
+
+    return batch
+
+
+@api.route("/projects")
+@conditional(projects_version)
+def projects(etag: str):
+    """
+    Projects, by id.
+
+    """
+    fields = selected_fields(PROJECT_FIELDS)
+    limit = page_limit()
+
+    records = DBWorker().iter_projects(page_cursor(), one_more(limit))
+
+    return stream_list(records, fields, limit, etag)
+
+
+@api.route("/projects/<int:project_id>")
+@conditional(lambda project_id: DBWorker().get_test_batches_version(project_id))
+def project(project_id: int, etag: str):
+    """
+    A project.
+
+    """
+    return single(get_project(project_id), selected_fields(PROJECT_FIELDS), etag)
+
+
+@api.route("/projects/<int:project_id>/batches")
+@conditional(lambda project_id: DBWorker().get_test_batches_version(project_id))
+def project_batches(project_id: int, etag: str):
+    """
+    Batches of a project, the most recent first.
+
+    """
+    get_project(project_id)
+
+    fields = selected_fields(BATCH_FIELDS)
+    limit = page_limit()
+
+    records = DBWorker().iter_test_batches(project_id, page_cursor(), one_more(limit))
+
+    return stream_list(records, fields, limit, etag, {"project_id": project_id})
+
+
+@api.route("/projects/<int:project_id>/stats")
+@conditional(lambda project_id: DBWorker().get_test_batches_version(project_id))
+def project_stats(project_id: int, etag: str):
+    """
+    Stats and average stage timings of a project.
+
+    """
+    get_project(project_id)
+
+    db_worker = DBWorker()
+    stats = {
+        "project_id": project_id,
+        **db_worker.get_project_statistics(project_id),
+        "average_timings": db_worker.get_project_average_stage_timings(project_id),
+    }
+
+    return single(stats, selected_fields(tuple(stats)), etag)
+
+
+@api.route("/projects/<int:project_id>/tests")
+@conditional(lambda project_id: DBWorker().get_test_batches_version(project_id))
+def project_tests(project_id: int, etag: str):
+    """
+    Duration percentiles and outcomes of each test of a project, over its
+    last ?batches= batches (100 by default, or all).
+
+    """
+    get_project(project_id)
+
+    fields = selected_fields(TEST_FIELDS)
+    limit = page_limit()
+
+    batches = request.args.get("batches", str(DEFAULT_TEST_BATCHES))
+    if batches != "all" and (not batches.isdigit() or int(batches) < 1):
+        raise ApiError("batches must be a positive number, or all")
+
+    sort = request.args.get("sort", "name")
+    if sort != "name" and sort not in TEST_SORTS:
+        raise ApiError(f"sort must be name or one of: {', '.join(TEST_SORTS)}")
+
+    history = CaseHistory.load(
+        DBWorker(), project_id, None if batches == "all" else int(batches)
+    )
+    tests = history.test_stats()
+
+    if sort != "name":
+        # Tests without a value last
+        tests.sort(key=lambda test: (test[sort] is not None, test[sort]), reverse=True)
+
+    # The id of a test is its position, the cursor of the next page
+    for position, test in enumerate(tests, start=1):
+        test["id"] = position
+
+    after = page_cursor() or 0
+
+    return stream_list(
+        iter(tests[after:]),
+        fields,
+        limit,
+        etag,
+        {"project_id": project_id, "cases": len(history)},
+    )
+
+
+# Batches do not change once ingested
+@api.route("/batches/<int:batch_id>")
+@conditional(lambda batch_id: f"batch-{batch_id}")
+def batch(batch_id: int, etag: str):
+    """
+    A batch, with its stage timings and the results of its pipeline stages.
+
+    """
+    fields = selected_fields(BATCH_DETAIL_FIELDS)
+
+    db_worker = DBWorker()
+    record = get_batch(batch_id)
+
+    if "timings" in fields:
+        record["timings"] = db_worker.get_batch_stage_timings(batch_id)
+    if "pipeline" in fields:
+        record["pipeline"] = db_worker.get_batch_pipeline_stages(batch_id)
+
+    return single(record, fields, etag)
+
+
+@api.route("/batches/<int:batch_id>/cases")
+@conditional(lambda batch_id: f"batch-{batch_id}")
+def batch_cases(batch_id: int, etag: str):
+    """
+    Test cases of a batch, by id.
+
+    """
+    get_batch(batch_id)
+
+    fields = selected_fields(CASE_FIELDS)
+    limit = page_limit()
+
+    records = DBWorker().iter_test_cases(batch_id, page_cursor(), one_more(limit))
+
+    return stream_list(records, fields, limit, etag, {"batch_id": batch_id})
+
+
+@api.route("/batches/<int:batch_id>/diff")
+@conditional(lambda batch_id: f"batch-{batch_id}")
+def batch_diff(batch_id: int, etag: str):
+    """
+    Changes of the test cases of a batch since the previous batch of its project.
+
+    """
+    get_batch(batch_id)
+
+    fields = selected_fields(DIFF_FIELDS)
+
+    if (diff := BatchDiff.load(DBWorker(), batch_id)) is None:
+        raise ApiError("batch not compared, it is the first of its project or reuses cached results", 404)
+
+    return single(diff, fields, etag)
+
+
+@api.route("/stats")
+@conditional(lambda: DBWorker().get_test_batches_version())
+def stats(etag: str):
+    """
+    Stats of all the projects.
+
+    """
+    stats = {
+        **DBWorker().get_tests_statistics(),
+        "stages": [stage.value for stage in BuildStage],
+    }
+
+    return single(stats, selected_fields(tuple(stats)), etag)
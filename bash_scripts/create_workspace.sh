@@ -0,0 +1,25 @@
+#!/bin/bash
+
+set -e # exit program if a command returns a non-zero status
+
+project_name="$1"
+workspace="$2"
+ref="$3"
+
+project_folder="./projects/$project_name"
+
+if ! [ -d "$project_folder" ]; then
+    echo -e "\n$project_name does not exist, please run clone_project.sh first\n"
+    exit 1
+fi
+
+cd "$project_folder"
+
+# Forget the workspaces of builds that were interrupted
+git worktree prune
+
+# The commit may be on another branch than the one pulled
+git fetch --quiet origin || echo -e "\nCould not fetch $project_name, using the local objects\n"
+
+# The workspace shares the objects of the project clone, only the files are written
+git worktree add --detach "$workspace" "$ref"
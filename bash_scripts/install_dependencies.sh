@@ -0,0 +1,23 @@
+#!/bin/bash
+
+set -e # exit program if a command returns a non-zero status
+
+project_name="$1"
+venv_name="$2"
+
+project_path="./projects/$project_name"
+
+# The rest are the arguments of pip install: the -r of the requirements
+# files which exist, the packages of the test runner and the project extras.
+# If there is nothing to install, we stop program with exit status 2
+if [ $# -le 2 ]; then
+    echo -e "\nCannot proceed, no requirements file and nothing else to install\n"
+    exit 2
+fi
+
+# Then we activate the venv
+source "$project_path/$venv_name/bin/activate"
+echo -e "\nvenv activated\n"
+
+# We install dependencies, along with the packages needed by the test runner
+pip install "${@:3}"
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+project_name="$1"
+workspace="$2"
+
+project_folder="./projects/$project_name"
+
+# If git cannot remove it (project deleted ...), the folder is removed anyway
+git -C "$project_folder" worktree remove --force "$workspace" || rm -rf "$workspace"
+git -C "$project_folder" worktree prune || true
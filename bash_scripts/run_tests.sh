@@ -3,44 +3,15 @@
 set -e # exit program if a command returns a non-zero status
 
 project_name="$1"
-test_file="$2"
+venv_name="$2"
+working_dir="$3"
 
 project_path="./projects/$project_name"
 
-# If requirements.txt does not exist, we stop program with exit status 2
-if ! [ -f "$project_path/requirements.txt" ]; then
-    echo -e "\nCannot proceed, requirements.txt does not exist at $project_path/\n"
-    exit 2
-fi
-
-# If test file does not exist, we stop program with exit status 3
-if ! [ -f "$project_path/$test_file" ]; then
-    echo -e "\nCannot proceed, $test_file does not exist at $project_path/\n"
-    exit 3
-fi
-
-# We create a venv if it doesn't exist
-if ! [ -d "./$project_path/.venv" ]; then
-    echo -e "\nvenv does not exist, creating it at $project_path/.venv\n"
-    python3 -m venv "$project_path/.venv"
-    sleep 0.5
-
-    # If we cannot creatr it, we return a status code 3
-    if ! [ -d "$project_path/.venv" ]; then
-    echo -e "\nCould not create .venv, check your python or permissions.\n"
-    exit 3
-    fi
-fi
-
-# Then we activate it
-source "$project_path/.venv/bin/activate"
+# The venv is created by setup_venv.sh and dependencies installed by install_dependencies.sh
+source "$project_path/$venv_name/bin/activate"
 echo -e "\nvenv activated\n"
 
-
-# We install dependencies
-pip install -r "$project_path/requirements.txt"
-
-# Running tests and redirect output to a junitxml standard file
-pytest --junitxml="$project_path/pytest_results.xml" "$project_path/$test_file"
-
-
+# Running the test command of the runner backend, it writes junitxml reports
+cd "$working_dir"
+"${@:4}"
@@ -0,0 +1,21 @@
+#!/bin/bash
+
+set -e # exit program if a command returns a non-zero status
+
+project_name="$1"
+venv_name="${2:-.venv}"
+python="${3:-python3}"
+
+project_path="./projects/$project_name"
+
+# We create a venv if it doesn't exist
+if ! [ -d "$project_path/$venv_name" ]; then
+    echo -e "\nvenv does not exist, creating it at $project_path/$venv_name with $python\n"
+
+    # If the interpreter or the venv module is missing, we return a status code 4
+    if ! command -v "$python" > /dev/null || ! "$python" -m venv "$project_path/$venv_name"; then
+        echo -e "\nCould not create $venv_name, check your python or permissions.\n"
+        rm -rf "$project_path/$venv_name"
+        exit 4
+    fi
+fi
@@ -0,0 +1,97 @@
+import random
+
+from datetime import datetime, timedelta
+from xml.sax.saxutils import quoteattr
+
+from workers.database import DBWorker
+
+
+class DataGenerator:
+    """
+    Generate reproducible synthetic CI history for the benchmarks.
+
+    The same seed always produces the same projects, batches and test cases.
+
+    """
+
+    def __init__(self, seed: int = 42):
+        self.seed = seed
+
+    def test_names(self, count: int) -> list[str]:
+        return [f"test_module_{index // 50}::test_case_{index}" for index in range(count)]
+
+    def make_batch(self, rng: random.Random, cases: int, timestamp: datetime) -> dict:
+        failures = rng.randint(0, cases // 20)
+        errors = rng.randint(0, cases // 50)
+        skipped = rng.randint(0, cases // 50)
+
+        return {
+            "errors": errors,
+            "failures": failures,
+            "skipped": skipped,
+            "tests": cases,
+            "time": round(rng.uniform(1, 300), 3),
+            "timestamp": timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+        }
+
+    def make_test_cases(self, rng: random.Random, cases: int) -> list[tuple]:
+        return [
+            (name, round(rng.expovariate(20), 4)) for name in self.test_names(cases)
+        ]
+
+    def populate(
+        self, db_worker: DBWorker, projects: int, batches: int, cases: int
+    ) -> list[int]:
+        """
+        Insert projects x batches x cases rows through DBWorker.
+
+        Returns:
+            The ids of the generated projects
+
+        """
+        rng = random.Random(self.seed)
+        start = datetime(2024, 1, 1)
+        project_ids = []
+
+        for project_index in range(projects):
+            name = f"bench-project-{project_index}"
+            db_worker.insert_project_to_database(
+                name, "test_file.py", f"https://github.com/bench/{name}"
+            )
+            project_id = db_worker.get_project(name)[0]
+            project_ids.append(project_id)
+
+            for batch_index in range(batches):
+                timestamp = start + timedelta(hours=batch_index, minutes=project_index)
+                batch_id = db_worker.insert_test_batch(
+                    project_id, self.make_batch(rng, cases, timestamp)
+                )
+                db_worker.insert_many_test_cases(
+                    batch_id, self.make_test_cases(rng, cases)
+                )
+
+        return project_ids
+
+    def write_junitxml(self, path: str, cases: int) -> None:
+        """
+        Write a pytest-like junitxml report with the given number of test cases.
+
+        """
+        rng = random.Random(self.seed)
+
+        with open(path, "w") as report:
+            report.write('<?xml version="1.0" encoding="utf-8"?><testsuites>')
+            report.write(
+                f'<testsuite name="pytest" errors="0" failures="0" skipped="0" '
+                f'tests="{cases}" time="{cases / 100}" '
+                f'timestamp="2024-03-03T15:34:37.859003" hostname="bench">'
+            )
+
+            for name in self.test_names(cases):
+                classname, _, case_name = name.partition("::")
+                report.write(
+                    f"<testcase classname={quoteattr(classname)} name={quoteattr(case_name)} "
+                    f'time="{rng.expovariate(20):.4f}" />'
+                )
+
+            report.write("</testsuite></testsuites>")
@@ -0,0 +1,321 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from typing import Callable
+
+# Get the path of the repository, benchmarks are run with python benchmarks/run_benchmarks.py
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+WEBHOOK_SECRET = "benchmark-secret"
+
+
+class BenchmarkSuite:
+    """
+    Benchmarks of ingestion, dashboard queries and webhook throughput.
+
+    Everything runs in a temporary folder with its own database, filled
+    with synthetic history of projects x batches x cases rows.
+
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.results = {}
+
+    def measure(
+        self, name: str, function: Callable, operations: int = 1, setup: Callable = None
+    ) -> dict:
+        """
+        Run a function args.repeat times and keep the min and median wall time.
+
+        Params:
+            name: name of the benchmark in the results
+            function: the function to time
+            operations: operations done by one call, to compute a rate
+            setup: function called before each run, not timed
+
+        """
+        durations = []
+
+        for _ in range(self.args.repeat):
+            if setup is not None:
+                setup()
+
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+
+        median = statistics.median(durations)
+
+        self.results[name] = {
+            "min_seconds": min(durations),
+            "median_seconds": median,
+            "operations": operations,
+            "operations_per_second": operations / median if median else None,
+        }
+
+        print(f"{name:<40} {median * 1000:>10.2f} ms  {operations / median:>12.1f} ops/s")
+
+        return self.results[name]
+
+    def run(self) -> dict:
+        from benchmarks.data_generator import DataGenerator
+        from workers.database import DBWorker
+
+        generator = DataGenerator(self.args.seed)
+        db_worker = DBWorker()
+
+        start = time.perf_counter()
+        project_ids = generator.populate(
+            db_worker, self.args.projects, self.args.batches, self.args.cases
+        )
+        print(f"generated history in {time.perf_counter() - start:.1f} s\n")
+
+        self.bench_ingestion(generator, db_worker, project_ids)
+        self.bench_dashboard_queries(db_worker, project_ids)
+        self.bench_junitxml_parsing(generator)
+        self.bench_webhooks(generator)
+
+        return self.results
+
+    def bench_ingestion(self, generator, db_worker, project_ids: list[int]) -> None:
+        rng = random.Random(self.args.seed)
+        test_cases = generator.make_test_cases(rng, self.args.cases)
+        batch = generator.make_batch(rng, self.args.cases, datetime(2024, 6, 1))
+        batch_ids = []
+
+        def new_batch():
+            batch_ids.append(db_worker.insert_test_batch(project_ids[0], batch))
+
+        self.measure(
+            "insert_many_test_cases",
+            lambda: db_worker.insert_many_test_cases(batch_ids[-1], test_cases),
+            operations=len(test_cases),
+            setup=new_batch,
+        )
+
+    def bench_dashboard_queries(self, db_worker, project_ids: list[int]) -> None:
+        self.measure("get_all_projects", db_worker.get_all_projects)
+        self.measure("get_tests_statistics", db_worker.get_tests_statistics)
+        self.measure(
+            "get_project_statistics",
+            lambda: db_worker.get_project_statistics(project_ids[0]),
+        )
+        self.measure(
+            "get_project_test_batches",
+            lambda: db_worker.get_project_test_batches(project_ids[0]),
+        )
+
+    def bench_junitxml_parsing(self, generator) -> None:
+        from workers.tester import Tester
+
+        # parse_junitxml_file reads the report inside the projects/ folder
+        project_name = f"benchmark-report-{os.getpid()}"
+        project_folder = os.path.join(REPO_DIR, "projects", project_name)
+        os.makedirs(project_folder)
+
+        try:
+            generator.write_junitxml(
+                os.path.join(project_folder, "pytest_results.xml"),
+                self.args.report_cases,
+            )
+
+            def parse():
+                _, _, testcases = Tester.parse_junitxml_file(project_name)
+                list(testcases)
+
+            self.measure(
+                "parse_junitxml_file", parse, operations=self.args.report_cases
+            )
+        finally:
+            shutil.rmtree(project_folder)
+
+    def bench_webhooks(self, generator) -> None:
+        """
+        Measure /test requests per second, then the end to end build rate
+        with local agents and a stub test runner.
+
+        """
+        import main
+
+        from workers.build_agent import LocalBuildAgent
+        from workers.database import DBWorker
+        from workers.project_manager import ProjectManager
+        from workers.tester import Tester
+
+        rng = random.Random(self.args.seed)
+        report = generator.make_batch(rng, 20, datetime(2024, 6, 1))
+        testcases = generator.make_test_cases(rng, 20)
+
+        # Stub test runner: no git, no venv, no pytest, only the CI server code
+        ProjectManager.pull_latest_changes = classmethod(lambda cls, name: True)
+        ProjectManager.create_workspace = classmethod(lambda cls, name, ref=None: name)
+        ProjectManager.remove_workspace = classmethod(lambda cls, name, workspace: True)
+        Tester.run_test_script = classmethod(
+            lambda cls, name, test_file, *args: (True, "Success")
+        )
+        Tester.parse_junitxml_file = classmethod(
+            lambda cls, name, *args: (name, report, iter(testcases))
+        )
+
+        client = main.app.test_client()
+
+        payloads = []
+        for index in range(self.args.requests):
+            project = f"bench-project-{index % self.args.projects}"
+            body = json.dumps(
+                {"ref": "refs/heads/main", "after": f"{index:040x}", "repository": {"name": project}}
+            ).encode()
+            signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256)
+            payloads.append((body, "sha256=" + signature.hexdigest()))
+
+        def send_webhooks():
+            for body, signature in payloads:
+                response = client.post(
+                    "/test",
+                    data=body,
+                    content_type="application/json",
+                    headers={"X-Hub-Signature-256": signature},
+                )
+                assert response.json["status"] == "success", response.json
+
+        db_worker = DBWorker()
+
+        def drain_queue():
+            agents = [
+                LocalBuildAgent(f"bench-{number}", poll_interval=0.01)
+                for number in range(self.args.agents)
+            ]
+            threads = [threading.Thread(target=agent.run_forever) for agent in agents]
+
+            for thread in threads:
+                thread.start()
+
+            while db_worker.count_build_jobs("queued") or db_worker.count_build_jobs("leased"):
+                time.sleep(0.01)
+
+            for agent in agents:
+                agent.stop()
+            for thread in threads:
+                thread.join()
+
+        self.measure(
+            "webhook_requests", send_webhooks, operations=self.args.requests, setup=drain_queue
+        )
+
+        self.measure(
+            "webhook_to_ingested_build",
+            lambda: (send_webhooks(), drain_queue()),
+            operations=self.args.requests,
+            setup=drain_queue,
+        )
+
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(previous: dict, current: dict) -> None:
+    """
+    Print the change of the rate of each benchmark against a previous run.
+
+    """
+    print(f"\ncompared to {previous['version']} ({previous['timestamp']})\n")
+
+    if previous["parameters"] != current["parameters"]:
+        print("warning: the runs used different parameters\n")
+
+    for name, result in current["results"].items():
+        if name not in previous["results"]:
+            continue
+
+        before = previous["results"][name]["operations_per_second"]
+        after = result["operations_per_second"]
+        change = (after - before) / before * 100
+
+        print(f"{name:<40} {before:>12.1f} -> {after:>12.1f} ops/s  {change:>+7.1f} %")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simple CI benchmarks")
+
+    parser.add_argument("--projects", type=int, default=10, help="Number of projects")
+    parser.add_argument("--batches", type=int, default=50, help="Batches per project")
+    parser.add_argument("--cases", type=int, default=200, help="Test cases per batch")
+    parser.add_argument(
+        "--report-cases", type=int, default=50000, help="Test cases in the parsed junitxml report"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Webhooks sent by the throughput benchmarks"
+    )
+    parser.add_argument("--agents", type=int, default=4, help="Local build agents")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each benchmark")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the data generator")
+    parser.add_argument(
+        "--output", type=str, default="benchmark_results.json", help="JSON file to write results to"
+    )
+    parser.add_argument(
+        "--compare", type=str, default=None, help="Previous results to compare with"
+    )
+
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    previous = None
+
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+
+    # The benchmarks use their own database and log file
+    work_dir = tempfile.mkdtemp(prefix="ci-benchmarks-")
+    os.chdir(work_dir)
+    os.environ["GITHUB_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    os.environ["CI_LOG_SINKS"] = "file"
+
+    try:
+        results = BenchmarkSuite(args).run()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir)
+
+    current = {
+        "version": git_version(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "compare")
+        },
+        "results": results,
+    }
+
+    with open(output, "w") as output_file:
+        json.dump(current, output_file, indent=4)
+
+    print(f"\nresults written to {output}")
+
+    if previous is not None:
+        compare(previous, current)
@@ -0,0 +1,54 @@
+import argparse
+import json
+import sys
+
+from workers.database import DBWorker
+from workers.history import History
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Export or import the history of the CI server (projects, batches, test cases)"
+    )
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("file", help="History file, ending with .gz to compress it, - for stdout / stdin")
+
+    # Database
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        help="Database to export from or import to, a sqlite file or a PostgreSQL url, CI_DATABASE_URL by default",
+    )
+
+    # Format
+    parser.add_argument(
+        "--format",
+        choices=History.formats,
+        default="ndjson",
+        help="Format of the export, imports detect it",
+    )
+
+    # Chunk size
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=5000,
+        help="Rows read or written at a time",
+    )
+
+    args = parser.parse_args()
+
+    db_worker = DBWorker(args.db)
+
+    try:
+        if args.command == "export":
+            counts = History.export(db_worker, args.file, args.format, args.chunk_size)
+        else:
+            counts = History.import_(db_worker, args.file, args.chunk_size)
+    except ValueError as error:
+        sys.exit(f"{args.command} failed: {error}")
+
+    # The counts go to stderr, the history may be written to stdout
+    print(json.dumps({args.command: counts}), file=sys.stderr)
@@ -1,32 +1,105 @@
 import argparse
 import logging
 import os
+import threading
+import time
 
 from dotenv import load_dotenv
 
-from flask import Flask, request, render_template, flash, redirect, url_for
+from flask import Flask, Response, request, render_template, flash, redirect, url_for, g
+
+from api import api
 
 # Function to verify the signature
 # To ensure that the payload was sent from GitHub
 from workers.webhook_validator import WebhookValidator
 
+from workers.batch_diff import BatchDiff
 from workers.database import DBWorker
+from workers.enums import BuildStage
+from workers.event_broadcaster import EventBroadcaster
+from workers.job_queue import JobQueue
+from workers.log_pipeline import LogPipeline
+from workers.matrix import BuildMatrix
+from workers.metrics import Metrics
+from workers.process_runner import ProcessRunner
 from workers.project_manager import ProjectManager
-from workers.tester import Tester
+from workers.query_profiler import QueryProfiler
+from workers.stage_timer import StageTimer
 
 app = Flask(__name__)
+app.register_blueprint(api)
 
 # Load the environment variables
 load_dotenv()
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 
 
-# Configure Flask logging
+# Configure logging, records are written by a background thread
+LogPipeline.setup()
 app.logger.setLevel(logging.INFO)  # Set log level to INFO
-handler = logging.FileHandler("flask-app.log")  # Log to a file
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-handler.setFormatter(formatter)
-app.logger.addHandler(handler)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.before_request
+def bind_delivery_id():
+    # Id of the GitHub webhook delivery, to follow it in the logs
+    g.log_context = LogPipeline.bind(
+        delivery=request.headers.get("X-GitHub-Delivery")
+    )
+
+
+@app.teardown_request
+def unbind_log_context(error):
+    if "log_context" in g:
+        LogPipeline.unbind(g.log_context)
+
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.endpoint or "unknown"
+
+    Metrics.http_request_duration.observe(
+        time.perf_counter() - g.request_start, endpoint=endpoint
+    )
+    Metrics.http_requests_total.inc(endpoint=endpoint, status=response.status_code)
+
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Metrics of the server in the Prometheus text format.
+
+    """
+    db_worker = DBWorker()
+
+    # The queue is shared with remote agents, so it is read at scrape time
+    Metrics.queue_depth.set(db_worker.count_build_jobs("queued"))
+    Metrics.builds_in_flight.set(db_worker.count_build_jobs("leased"))
+    Metrics.notifications_pending.set(db_worker.count_pending_notifications())
+
+    return Metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@app.route("/events")
+def events():
+    """
+    Stream of the dashboard events (builds, batches and stats), as server-sent events.
+
+    """
+    subscriber = EventBroadcaster.subscribe()
+
+    return Response(
+        EventBroadcaster.stream(subscriber),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/")
@@ -48,14 +121,135 @@ def project(project_id):
     project: dict = db_worker.get_project_by_id(project_id)
     project_stats: dict = db_worker.get_project_statistics(project_id)
     test_batches: dict = db_worker.get_project_test_batches(project_id)
+    stage_timings: dict = db_worker.get_project_stage_timings(project_id)
+    average_timings: dict = db_worker.get_project_average_stage_timings(project_id)
+    pipeline_stages: dict = db_worker.get_project_pipeline_stages(project_id)
+    matrix_builds: list = db_worker.get_project_matrix_builds(project_id)
+    cache_hits: dict = db_worker.get_project_cache_hits(project_id)
+    flaky_tests: list = db_worker.get_project_flaky_tests(project_id)
+    batch_diffs: dict = db_worker.get_project_batch_diffs(project_id)
+
+    for matrix_build in matrix_builds:
+        for cell in matrix_build["cells"]:
+            cell["name"] = BuildMatrix.name(cell["matrix"])
 
     app.logger.info(f"accessed project: {project['name']}")
 
     return render_template(
-        "project.html", project=project, test_batches=test_batches, stats=project_stats
+        "project.html",
+        project=project,
+        test_batches=test_batches,
+        stats=project_stats,
+        stages=[stage.value for stage in BuildStage],
+        stage_timings=stage_timings,
+        average_timings=average_timings,
+        pipeline_stages=pipeline_stages,
+        matrix_builds=matrix_builds,
+        cache_hits=cache_hits,
+        flaky_tests=flaky_tests,
+        batch_diffs=batch_diffs,
     )
 
 
+@app.route("/batch/<int:batch_id>/diff")
+def batch_diff(batch_id):
+    """
+    View that displays the changes of a batch since the previous batch of its project.
+
+    """
+    db_worker = DBWorker()
+    diff = BatchDiff.load(db_worker, batch_id)
+
+    if diff is None:
+        flash(f"Batch {batch_id} is not compared with a previous batch.", "warning")
+        return redirect(url_for("index"))
+
+    batch = db_worker.get_test_batch(batch_id)
+    project = db_worker.get_project_by_id(batch["project_id"])
+
+    return render_template("batch_diff.html", project=project, batch=batch, diff=diff)
+
+
+@app.route("/project/<int:project_id>/quarantine", methods=["POST"])
+def quarantine_test(project_id):
+    """
+    Flask route to add a test to the quarantine list of a project, or to remove it.
+
+    """
+    db_worker = DBWorker()
+    test_name = request.form["test_name"]
+
+    if request.form.get("action") == "release":
+        db_worker.release_test(project_id, test_name)
+        flash(f"{test_name} released from quarantine.", "success")
+    else:
+        db_worker.quarantine_test(project_id, test_name)
+        flash(f"{test_name} quarantined, its failures do not fail the build.", "success")
+
+    app.logger.info(f"quarantine of project {project_id} changed: {test_name}")
+
+    return redirect(url_for("project", project_id=project_id))
+
+
+@app.route("/api/project/<int:project_id>/timings")
+def project_timings(project_id):
+    """
+    JSON view of the stage timings of every batch of a project.
+
+    """
+    db_worker = DBWorker()
+    stage_timings: dict = db_worker.get_project_stage_timings(project_id)
+
+    return {
+        "project_id": project_id,
+        "stages": [stage.value for stage in BuildStage],
+        "average": db_worker.get_project_average_stage_timings(project_id),
+        "batches": [
+            {"batch_id": batch_id, "timings": timings}
+            for batch_id, timings in sorted(stage_timings.items(), reverse=True)
+        ],
+    }
+
+
+@app.route("/api/project/<int:project_id>/flaky")
+def project_flaky_tests(project_id):
+    """
+    JSON view of the flaky and quarantined tests of a project.
+
+    """
+    db_worker = DBWorker()
+
+    return {
+        "project_id": project_id,
+        "tests": db_worker.get_project_flaky_tests(project_id, limit=100),
+        "quarantine": db_worker.get_quarantined_tests(project_id),
+    }
+
+
+@app.route("/api/batch/<int:batch_id>/timings")
+def batch_timings(batch_id):
+    """
+    JSON view of the stage timings of a batch.
+
+    """
+    return {
+        "batch_id": batch_id,
+        "timings": DBWorker().get_batch_stage_timings(batch_id),
+    }
+
+
+@app.route("/api/batch/<int:batch_id>/pipeline")
+def batch_pipeline(batch_id):
+    """
+    JSON view of the status and duration of the pipeline stages of a batch.
+
+    """
+    return {
+        "batch_id": batch_id,
+        "stages": DBWorker().get_batch_pipeline_stages(batch_id),
+    }
+
+
 @app.route("/test", methods=["POST"])
 def test():
     """
@@ -69,7 +263,9 @@ def test():
     json_body = request.json
     branch = json_body["ref"].split("/")[-1]
     repository_name = json_body["repository"]["name"].lower()
-    
+
+    LogPipeline.bind(project=repository_name)
+
     # pusher, pusher_email = json_body["pusher"]["name"], json_body["pusher"]["email"]
 
     project_target_branch = db_worker.get_project_target_branch(repository_name)
@@ -89,15 +285,138 @@ def test():
         signature_header=secret_header,
     ):
 
-        ProjectManager.pull_latest_changes(repository_name)
-        Tester.perform_tests(repository_name)
+        # The build runs on the first available agent, local or remote
+        job_id = JobQueue.enqueue(repository_name, branch, json_body.get("after"))
+
+        app.logger.info(f"build queued for {repository_name}: job {job_id}")
 
-        return {"status": "success", "message": "test process triggered"}
+        return {"status": "success", "message": "test process queued", "job_id": job_id}
 
     else:
         return {"status": "error", "message": "Invalid signature"}
 
 
+@app.route("/agent/lease", methods=["POST"])
+def agent_lease():
+    """
+    Lease the next build job to a remote build agent.
+
+    """
+    if not JobQueue.verify_agent_token(request.headers.get("X-Agent-Token")):
+        return {"status": "error", "message": "Invalid agent token"}, 403
+
+    agent = request.json["agent"]
+    job = JobQueue.lease(agent, request.json.get("memory_budget"))
+
+    if job is not None:
+        app.logger.info(f"job {job['id']} leased by agent {agent}")
+
+    return {"status": "success", "job": job}
+
+
+@app.route("/agent/heartbeat/<int:job_id>", methods=["POST"])
+def agent_heartbeat(job_id):
+    """
+    Extend the lease of a job while a remote build agent runs it.
+
+    """
+    if not JobQueue.verify_agent_token(request.headers.get("X-Agent-Token")):
+        return {"status": "error", "message": "Invalid agent token"}, 403
+
+    if JobQueue.heartbeat(job_id, request.json["agent"]):
+        return {"status": "success", "message": "lease extended"}
+
+    return {"status": "error", "message": "lease lost"}
+
+
+@app.route("/agent/cache/<int:job_id>", methods=["POST"])
+def agent_cache(job_id):
+    """
+    Complete a job with cached results if its content was already tested.
+
+    """
+    if not JobQueue.verify_agent_token(request.headers.get("X-Agent-Token")):
+        return {"status": "error", "message": "Invalid agent token"}, 403
+
+    db_worker = DBWorker()
+    payload = request.json
+    job = db_worker.get_build_job(job_id)
+
+    if job is None or job["status"] != "leased" or job["agent"] != payload["agent"]:
+        return {"status": "error", "message": "job is not leased by this agent"}
+
+    LogPipeline.bind(project=job["project_name"], build=job_id)
+
+    # The build stack is only imported by the routes ingesting results
+    from workers.tester import Tester
+
+    timer = StageTimer(payload.get("timings"))
+    timer.record(BuildStage.QUEUE_WAIT, job["leased_at"] - job["created_at"])
+
+    batch_id = Tester.ingest_cached_results(
+        job["project_id"], payload["cache_key"], timer
+    )
+
+    if batch_id is None:
+        return {"status": "success", "hit": False, "message": "not tested yet"}
+
+    message = "Same content already tested, results reused"
+    JobQueue.complete(job_id, True, message, batch_id, payload["agent"])
+
+    app.logger.info(f"job {job_id} reused results: batch {batch_id}")
+
+    return {"status": "success", "hit": True, "message": message}
+
+
+@app.route("/agent/result/<int:job_id>", methods=["POST"])
+def agent_result(job_id):
+    """
+    Receive the junitxml report of a build run by a remote build agent.
+
+    """
+    if not JobQueue.verify_agent_token(request.headers.get("X-Agent-Token")):
+        return {"status": "error", "message": "Invalid agent token"}, 403
+
+    db_worker = DBWorker()
+    result = request.json
+    job = db_worker.get_build_job(job_id)
+
+    if job is None or job["status"] != "leased" or job["agent"] != result["agent"]:
+        return {"status": "error", "message": "job is not leased by this agent"}
+
+    LogPipeline.bind(project=job["project_name"], build=job_id)
+
+    batch_id = None
+
+    if result["success"]:
+        from workers.tester import Tester
+
+        timer = StageTimer(result.get("timings"))
+        timer.record(BuildStage.QUEUE_WAIT, job["leased_at"] - job["created_at"])
+
+        batch_id = Tester.ingest_junitxml(
+            job["project_id"],
+            result["junitxml"],
+            timer,
+            result.get("pipeline"),
+            result.get("cache_key"),
+            job["matrix"],
+            job["stages"],
+        )
+
+    if result.get("peak_memory"):
+        db_worker.record_project_peak_memory(job["project_id"], result["peak_memory"])
+
+    # The lease may have changed hands while the report was ingested
+    JobQueue.complete(
+        job_id, result["success"], result["message"], batch_id, result["agent"]
+    )
+
+    app.logger.info(f"job {job_id} finished by agent {result['agent']}")
+
+    return {"status": "success", "message": "results saved"}
+
+
 @app.route("/add_project", methods=["GET", "POST"])
 def add_project():
     """
@@ -123,32 +442,24 @@ def add_project():
         project_exists_in_db = db_worker.project_exists(name)
         project_exists_in_folder = ProjectManager.project_exists(name)
 
+        if db_worker.has_active_project_job(name):
+            flash("Project is already being added or deleted.", "danger")
+            return redirect(url_for("add_project"))
+
         # Project does not exist in DB and hasn't been cloned yet
         if not project_exists_in_db and not project_exists_in_folder:
 
-            clone_success: bool = ProjectManager.clone_project(github_url)
+            from workers.project_jobs import ProjectJobs
 
-            db_insert_success = db_worker.insert_project_to_database(
-                name, test_file, github_url, target_branch
+            # Cloning can take minutes, it runs in the background
+            job_id = ProjectJobs.add_project(
+                db_worker, name, github_url, test_file, target_branch
             )
 
-            if clone_success and db_insert_success:
-                # If form submission is successful, display a success message
-                flash("Project added successfully.", "success")
+            flash("Project is being cloned.", "success")
+            app.logger.info(f"adding project {name} in job {job_id}")
 
-                app.logger.info(f"new project added: {name}")
-                # And redirect to the index
-                return redirect(url_for("index"))
-            else:
-                issue = "folder" if not clone_success else "database"
-
-                # One of the operations failed, so I delete both
-                db_worker.delete_project_by_name(name)
-                ProjectManager.delete_project_folder(name)
-
-                flash(f"Project could not be added to {issue}.", "danger")
-                app.logger.error(f"project could not be added to {issue}: {name}")
-                return redirect(url_for("add_project"))
+            return redirect(url_for("project_jobs", job_id=job_id))
 
         else:
             existing = "database" if project_exists_in_db else "folder"
@@ -166,16 +477,17 @@ def delete_project(project_name):
 
     """
 
-    db_worker = DBWorker()
-    db_deleted_successfully: bool = db_worker.delete_project_by_name(project_name)
-    folder_deleted_successfully = ProjectManager.delete_project_folder(project_name)
+    from workers.project_jobs import ProjectJobs
 
-    if db_deleted_successfully and folder_deleted_successfully:
+    # The folder is moved to the trash, its files are removed in the background
+    job_id = ProjectJobs.delete_project(DBWorker(), project_name)
+
+    if job_id is not None:
         flash("Project deleted successfully.", "success")
 
         app.logger.info(f"project deleted: {project_name}")
 
-        return redirect(url_for("index"))
+        return redirect(url_for("project_jobs", job_id=job_id))
 
     else:
         flash("Project could not be deleted.", "danger")
@@ -183,6 +495,65 @@ def delete_project(project_name):
         return redirect(url_for("index"))
 
 
+@app.route("/project_jobs")
+@app.route("/project_jobs/<int:job_id>")
+def project_jobs(job_id=None):
+    """
+    Status of the background jobs adding and deleting projects.
+
+    """
+    db_worker = DBWorker()
+    jobs = db_worker.get_project_jobs()
+    job = None
+
+    if job_id is not None:
+        job = next(iter(db_worker.get_project_jobs(job_id, 1)), None)
+
+        if job is None:
+            flash("Project job not found.", "danger")
+            return redirect(url_for("project_jobs"))
+
+    # The page reloads itself until the jobs are finished
+    shown = jobs + [job] if job else jobs
+    refresh = any(shown_job["status"] in ("queued", "running") for shown_job in shown)
+
+    return render_template("project_jobs.html", job=job, jobs=jobs, refresh=refresh)
+
+
+@app.route("/api/project_jobs/<int:job_id>")
+def project_job_status(job_id):
+    """
+    Status of a background job adding or deleting a project.
+
+    """
+    job = next(iter(DBWorker().get_project_jobs(job_id, 1)), None)
+
+    if job is None:
+        return {"status": "error", "message": "project job not found"}, 404
+
+    return job
+
+
+@app.route("/debug/queries", methods=["GET"])
+def debug_queries():
+    """
+    Debug page listing the database queries that took the most time.
+
+    Only filled when the server runs with CI_DB_PROFILE=1.
+
+    """
+    if request.args.get("reset"):
+        QueryProfiler.reset()
+        return redirect(url_for("debug_queries"))
+
+    return render_template(
+        "debug_queries.html",
+        enabled=QueryProfiler.enabled,
+        slow_query_ms=QueryProfiler.slow_query_ms,
+        queries=QueryProfiler.top_queries(),
+    )
+
+
 @app.route("/about", methods=["GET"])
 def about():
     return render_template("about.html")
@@ -204,6 +575,41 @@ if __name__ == "__main__":
         "--host", type=str, default="127.0.0.1", help="Host address for the server"
     )
 
+    # Local build agents
+    parser.add_argument(
+        "--local-agents",
+        type=int,
+        default=1,
+        help="Number of build agents running inside the server, 0 to only use remote agents",
+    )
+
+    # Scheduled builds
+    parser.add_argument(
+        "--no-scheduler",
+        action="store_true",
+        help="Do not queue the scheduled builds of the projects, when another server does",
+    )
+
     args = parser.parse_args()
 
+    # Only the server process runs builds, schedules and notifications,
+    # importing the app (tests, WSGI servers) does not load them
+    from workers.build_agent import LocalBuildAgent
+    from workers.notifier import Notifier
+    from workers.scheduler import Scheduler
+
+    # Jobs of a previous run are not running anymore, their trash is emptied
+    DBWorker().fail_interrupted_project_jobs()
+    ProcessRunner.run_in_background(ProjectManager.empty_trash)
+
+    for agent_number in range(args.local_agents):
+        agent = LocalBuildAgent(name=f"local-{agent_number}")
+        threading.Thread(target=agent.run_forever, daemon=True).start()
+
+    if not args.no_scheduler:
+        threading.Thread(target=Scheduler.run_forever, daemon=True).start()
+
+    # Commit statuses and build summaries, sent from the outbox
+    threading.Thread(target=Notifier.run_forever, daemon=True).start()
+
     app.run(threaded=True, host=args.host, port=args.port)
@@ -0,0 +1,145 @@
+// Live updates of the dashboard, pushed by the server on /events
+document.addEventListener("DOMContentLoaded", () => {
+    if (!window.EventSource) {
+        return;
+    }
+
+    // Empty on the global dashboard
+    const projectId = document.body.dataset.projectId;
+    const source = new EventSource("/events");
+    let connected = false;
+
+    const setText = (id, text) => {
+        const element = document.getElementById(id);
+
+        if (element) {
+            element.textContent = text;
+        }
+    };
+
+    const isShown = (event) => !projectId || String(event.project_id) === projectId;
+
+    // Badges of the changes of a batch since the previous one, like the project page
+    const diffCell = (batchId, diff) => {
+        const link = document.createElement("a");
+
+        if (!diff) {
+            return link;
+        }
+
+        link.href = `/batch/${batchId}/diff`;
+        link.className = "text-decoration-none";
+
+        const badges = [
+            [diff.new_failures, `${diff.new_failures} failing`, "bg-danger"],
+            [diff.fixed, `${diff.fixed} fixed`, "bg-success"],
+            [diff.added || diff.removed, `+${diff.added} / -${diff.removed}`, "bg-secondary"],
+            [diff.slower, `${diff.slower} slower`, "bg-warning text-dark"],
+            [diff.faster, `${diff.faster} faster`, "bg-info text-dark"],
+        ].filter(([count]) => count);
+
+        if (!badges.length) {
+            badges.push([0, "no change", "bg-light text-dark"]);
+        }
+
+        badges.forEach(([, text, color]) => {
+            const badge = document.createElement("span");
+            badge.className = `badge ${color}`;
+            badge.textContent = text;
+            link.append(badge, " ");
+        });
+
+        return link;
+    };
+
+    // Events were missed while disconnected, the page is rendered again
+    source.addEventListener("open", () => {
+        if (connected) {
+            window.location.reload();
+        }
+        connected = true;
+    });
+
+    source.addEventListener("build_started", (message) => {
+        const event = JSON.parse(message.data);
+
+        if (!projectId) {
+            const row = document.querySelector(`tr[data-project-id="${event.project_id}"] .last-batch`);
+
+            if (row) {
+                row.textContent = "Building...";
+            }
+        } else if (isShown(event)) {
+            setText("build-status", `Build ${event.job_id} running on ${event.agent}`);
+        }
+    });
+
+    source.addEventListener("build_finished", (message) => {
+        const event = JSON.parse(message.data);
+
+        if (projectId && isShown(event)) {
+            setText("build-status", `Build ${event.job_id} ${event.status}: ${event.message}`);
+        }
+    });
+
+    source.addEventListener("batch", (message) => {
+        const event = JSON.parse(message.data);
+        const batch = event.batch;
+
+        if (!projectId) {
+            const stats = event.stats;
+            setText("stat-total", stats.total);
+            setText("stat-success-rate", stats.success_rate);
+            setText("stat-failures", stats.failures);
+
+            const row = document.querySelector(`tr[data-project-id="${event.project_id}"] .last-batch`);
+
+            if (row) {
+                row.textContent = batch.datetime;
+            }
+            return;
+        }
+
+        if (!isShown(event)) {
+            return;
+        }
+
+        const stats = event.project_stats;
+        setText("stat-total", stats.total);
+        setText("stat-success-rate", stats.success_rate);
+        setText("stat-failures", stats.failures);
+
+        const body = document.getElementById("test-batches");
+
+        if (!body) {
+            return;
+        }
+
+        // Placeholder row of a project without batch
+        const first = body.querySelector("tr");
+
+        if (first && first.firstElementChild.textContent.trim() === "") {
+            first.remove();
+        }
+
+        const row = document.createElement("tr");
+        const values = [
+            batch.id, batch.errors, batch.failures, batch.skipped,
+            batch.total, batch.execution_time, batch.datetime, diffCell(batch.id, event.diff), "",
+        ];
+
+        values.forEach((value) => {
+            const cell = document.createElement("th");
+            cell.scope = "row";
+
+            if (value instanceof Node) {
+                cell.appendChild(value);
+            } else {
+                cell.textContent = value;
+            }
+            row.appendChild(cell);
+        });
+
+        body.prepend(row);
+    });
+});
@@ -0,0 +1,170 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append("../")
+
+from flask import Flask
+
+from api import api
+from workers.database import DBWorker
+from workers.tester import Tester
+
+
+class TestApi(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(api)
+        self.client = app.test_client()
+
+        # The views use the default database, like the server: a temporary one
+        self.folder = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict(
+            os.environ, {"CI_DATABASE_URL": os.path.join(self.folder.name, "api.sqlite3")}
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db_worker = DBWorker()
+
+        name = f"api project {os.getpid()}-{self.id()}"
+        self.db_worker.insert_project_to_database(name, "test_app.py", "github_url")
+        self.project_id = self.db_worker.get_project(name.lower())[0]
+
+        self.batch_ids = [
+            self.db_worker.insert_test_batch(
+                self.project_id,
+                {"tests": 3, "failures": index, "time": 1.5, "timestamp": "2024-01-01T00:00:00"},
+            )
+            for index in range(5)
+        ]
+        self.db_worker.insert_many_test_cases(
+            self.batch_ids[-1], [("test_a", 0.5, "passed"), ("test_b", 1.0, "failed")]
+        )
+
+    def tearDown(self):
+        self.db_worker.close()
+        self.folder.cleanup()
+
+    def test_batches_pages(self):
+        url = f"/api/v1/projects/{self.project_id}/batches?limit=2&fields=id,failures"
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        page = response.get_json()
+        self.assertEqual(
+            page["data"],
+            [
+                {"id": self.batch_ids[4], "failures": 4},
+                {"id": self.batch_ids[3], "failures": 3},
+            ],
+        )
+
+        ids = [batch["id"] for batch in page["data"]]
+
+        while page["next_cursor"] is not None:
+            page = self.client.get(url + f"&cursor={page['next_cursor']}").get_json()
+            ids += [batch["id"] for batch in page["data"]]
+
+        self.assertEqual(ids, self.batch_ids[::-1])
+
+        everything = self.client.get(
+            f"/api/v1/projects/{self.project_id}/batches?limit=all"
+        ).get_json()
+        self.assertEqual(len(everything["data"]), 5)
+        self.assertIsNone(everything["next_cursor"])
+
+    def test_conditional_get(self):
+        url = f"/api/v1/projects/{self.project_id}/batches"
+
+        etag = self.client.get(url).headers["ETag"]
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # A new batch changes the list
+        self.db_worker.insert_test_batch(
+            self.project_id, {"tests": 1, "timestamp": "2024-01-02T00:00:00"}
+        )
+        response = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_batch_and_cases(self):
+        batch_id = self.batch_ids[-1]
+
+        batch = self.client.get(f"/api/v1/batches/{batch_id}").get_json()
+        self.assertEqual(batch["project_id"], self.project_id)
+        self.assertEqual(batch["execution_time"], 1.5)
+        self.assertEqual(batch["timings"], {})
+
+        cases = self.client.get(
+            f"/api/v1/batches/{batch_id}/cases?fields=name,outcome"
+        ).get_json()
+        self.assertEqual(
+            cases["data"],
+            [{"name": "test_a", "outcome": "passed"}, {"name": "test_b", "outcome": "failed"}],
+        )
+
+    def test_project_tests(self):
+        self.db_worker.insert_many_test_cases(
+            self.batch_ids[-2], [("test_a", 1.5, "passed"), ("test_b", None, "error")]
+        )
+
+        tests = self.client.get(f"/api/v1/projects/{self.project_id}/tests").get_json()
+        self.assertEqual(tests["cases"], 4)
+        self.assertEqual([test["name"] for test in tests["data"]], ["test_a", "test_b"])
+        self.assertEqual(tests["data"][0]["p50"], 1.0)
+        self.assertEqual(tests["data"][1]["failure_rate"], 1.0)
+
+        tests = self.client.get(
+            f"/api/v1/projects/{self.project_id}/tests?batches=1&sort=mean&fields=name,mean&limit=1"
+        ).get_json()
+        self.assertEqual(tests["cases"], 2)
+        self.assertEqual(tests["data"], [{"name": "test_b", "mean": 1.0}])
+        self.assertIsNotNone(tests["next_cursor"])
+
+        response = self.client.get(
+            f"/api/v1/projects/{self.project_id}/tests?sort=duration"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_diff(self):
+        # The batches of setUp have no test cases, a diff needs two ingested batches
+        batch_ids = [
+            Tester.ingest_results(
+                self.project_id,
+                {"tests": 1, "time": 1.0, "timestamp": "2024-01-01T00:00:00"},
+                [("test_a", "0.5", outcome)],
+            )
+            for outcome in ("passed", "failed")
+        ]
+
+        diff = self.client.get(
+            f"/api/v1/batches/{batch_ids[1]}/diff?fields=base_batch_id,counts,new_failures"
+        ).get_json()
+        self.assertEqual(diff["base_batch_id"], batch_ids[0])
+        self.assertEqual(diff["new_failures"], ["test_a"])
+        self.assertEqual(diff["counts"]["fixed"], 0)
+
+        response = self.client.get(f"/api/v1/batches/{self.batch_ids[0]}/diff")
+        self.assertEqual(response.status_code, 404)
+
+    def test_errors(self):
+        self.assertEqual(self.client.get("/api/v1/batches/999999999").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/projects/999999999").status_code, 404)
+
+        response = self.client.get(f"/api/v1/projects/{self.project_id}?fields=secret")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("unknown fields: secret", response.get_json()["message"])
+
+        response = self.client.get("/api/v1/projects?cursor=nope")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get("/api/v1/projects?limit=0")
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append("../")
+
+from workers.batch_diff import BatchDiff
+from workers.database import DBWorker
+from workers.tester import Tester
+
+
+class TestBatchDiff(unittest.TestCase):
+    def test_compute(self):
+        previous = {
+            "test_fixed": (0.1, "failed"),
+            "test_broken": (0.1, "passed"),
+            "test_still_failing": (0.1, "error"),
+            "test_slower": (1.0, "passed"),
+            "test_faster": (2.0, "passed"),
+            "test_noise": (0.01, "passed"),
+            "test_removed": (0.1, "passed"),
+        }
+        testcases = [
+            ("test_fixed", "0.1", "flaky"),
+            ("test_broken", "0.1", "failed"),
+            ("test_still_failing", "0.1", "error"),
+            ("test_slower", "1.5", "passed"),
+            ("test_faster", "1.0", "passed"),
+            ("test_noise", "0.05", "passed"),
+            ("test_added", "0.1", "error"),
+        ]
+
+        diff = BatchDiff.compute(previous, testcases)
+
+        self.assertEqual(diff["new_failures"], ["test_broken", "test_added"])
+        self.assertEqual(diff["fixed"], ["test_fixed"])
+        self.assertEqual(diff["added"], ["test_added"])
+        self.assertEqual(diff["removed"], ["test_removed"])
+        self.assertEqual(diff["slower"], [("test_slower", 1.0, 1.5)])
+        self.assertEqual(diff["faster"], [("test_faster", 2.0, 1.0)])
+        self.assertAlmostEqual(diff["duration_delta"], -0.46)
+
+        self.assertEqual(
+            BatchDiff.counts(diff),
+            {"new_failures": 2, "fixed": 1, "added": 1, "removed": 1, "slower": 1, "faster": 1},
+        )
+
+    def test_encode_decode(self):
+        diff = BatchDiff.compute(
+            {f"test_{index}": (0.1, "passed") for index in range(10000)},
+            [(f"test_{index}", 0.1, "failed") for index in range(10000)],
+        )
+        data = BatchDiff.encode(diff)
+
+        # Names of a suite share their prefixes
+        self.assertLess(len(data), len(json.dumps(diff)) / 4)
+
+        decoded = BatchDiff.decode(data)
+        self.assertEqual(decoded["new_failures"], diff["new_failures"])
+        self.assertEqual(decoded["slower"], [])
+
+    def test_computed_on_ingest(self):
+        with tempfile.TemporaryDirectory() as folder:
+            db_worker = DBWorker(os.path.join(folder, "diff.sqlite3"))
+            db_worker.insert_project_to_database("project", "test_app.py", "url")
+            project_id = db_worker.get_project("project")[0]
+
+            batch = {"tests": 2, "time": 1.0, "timestamp": "2024-01-01T00:00:00"}
+
+            first = Tester.ingest_results(
+                project_id, batch, [("test_a", "0.1", "passed"), ("test_b", "0.2", "failed")]
+            )
+            # Cached results have no test cases, the next batch is compared with the first
+            db_worker.insert_cache_hit_batch(project_id, first, "2024-01-01T00:01:00")
+            second = Tester.ingest_results(
+                project_id, batch, [("test_a", "0.5", "failed"), ("test_c", "0.2", "passed")]
+            )
+
+            self.assertIsNone(BatchDiff.load(db_worker, first))
+
+            diff = BatchDiff.load(db_worker, second)
+            self.assertEqual(diff["base_batch_id"], first)
+            self.assertEqual(diff["new_failures"], ["test_a"])
+            self.assertEqual(diff["removed"], ["test_b"])
+            self.assertEqual(diff["slower"], [{"name": "test_a", "before": 0.1, "after": 0.5}])
+            self.assertEqual(diff["counts"]["added"], 1)
+
+            self.assertEqual(
+                db_worker.get_project_batch_diffs(project_id),
+                {second: {"base_batch_id": first, **diff["counts"]}},
+            )
+            self.assertEqual(
+                db_worker.get_batch_diff_counts(second),
+                {"base_batch_id": first, **diff["counts"]},
+            )
+            self.assertIsNone(db_worker.get_batch_diff_counts(first))
+
+    def test_compared_with_same_cell_and_stages(self):
+        with tempfile.TemporaryDirectory() as folder:
+            db_worker = DBWorker(os.path.join(folder, "diff.sqlite3"))
+            db_worker.insert_project_to_database("project", "test_app.py", "url")
+            project_id = db_worker.get_project("project")[0]
+
+            batch = {"tests": 1, "time": 1.0, "timestamp": "2024-01-01T00:00:00"}
+            py311 = {"python": "3.11", "env": {}}
+            py312 = {"python": "3.12", "env": {}}
+
+            def ingest(test_name: str, cell: dict = None, stages: list[str] = None) -> int:
+                return Tester.ingest_results(
+                    project_id, batch, [(test_name, "0.1", "passed")], cell=cell, stages=stages
+                )
+
+            push = ingest("test_a")
+            first_cell = ingest("test_py311", py311)
+            ingest("test_py312", py312)
+            smoke = ingest("test_lint", stages=["unit", "lint"])
+
+            # Cells of the next build, finished in another order
+            second_cell = ingest("test_py311", py311)
+            self.assertEqual(BatchDiff.load(db_worker, second_cell)["base_batch_id"], first_cell)
+            self.assertEqual(BatchDiff.load(db_worker, second_cell)["removed"], [])
+
+            self.assertIsNone(BatchDiff.load(db_worker, smoke))
+            self.assertEqual(
+                BatchDiff.load(db_worker, ingest("test_lint", stages=["lint", "unit"]))[
+                    "base_batch_id"
+                ],
+                smoke,
+            )
+
+            # A push of every stage is compared with the previous push
+            self.assertEqual(BatchDiff.load(db_worker, ingest("test_a"))["base_batch_id"], push)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.build_agent import LocalBuildAgent
+from workers.job_queue import JobQueue
+from workers.project_manager import ProjectManager
+from workers.tester import Tester
+
+
+class TestLocalBuildAgent(unittest.TestCase):
+    def setUp(self):
+        self.agent = LocalBuildAgent("local-1")
+        self.job = {
+            "id": 1,
+            "project_id": 1,
+            "project_name": "project",
+            "commit_sha": "a" * 40,
+            "matrix": None,
+            "stages": None,
+            "leased_at": time.time(),
+            "created_at": time.time(),
+        }
+
+        patchers = [
+            mock.patch.object(ProjectManager, "pull_latest_changes", return_value=True),
+            mock.patch.object(ProjectManager, "create_workspace", return_value="/workspace"),
+            mock.patch.object(ProjectManager, "remove_workspace", return_value=True),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_build_is_completed_by_its_agent(self):
+        result = {"status": "success", "message": "Success", "batch_id": 3}
+
+        with mock.patch.object(
+            Tester, "perform_tests", return_value=result
+        ), mock.patch.object(JobQueue, "complete") as complete:
+            self.agent.build(self.job, threading.Event())
+
+        complete.assert_called_once_with(1, True, "Success", 3, "local-1")
+
+    def test_lost_lease_is_not_completed(self):
+        lease_lost = threading.Event()
+
+        def preempted(*args):
+            # The job went back to the queue while the tests ran
+            lease_lost.set()
+            return {"status": "error", "message": "Cancelled."}
+
+        with mock.patch.object(
+            Tester, "perform_tests", side_effect=preempted
+        ), mock.patch.object(JobQueue, "complete") as complete:
+            self.agent.build(self.job, lease_lost)
+
+        complete.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
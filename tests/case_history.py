@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append("../")
+
+from workers.case_history import CaseHistory
+from workers.database import DBWorker
+
+
+ROWS = [
+    (1, "test_a", 1.0, "passed"),
+    (1, "test_b", None, "error"),
+    (2, "test_a", 2.0, "failed"),
+    (2, "test_b", 0.5, "passed"),
+    (3, "test_a", 4.0, "passed"),
+    (3, "test_c", 0.1, None),
+    (4, "test_a", 3.0, "flaky"),
+]
+
+
+class TestCaseHistory(unittest.TestCase):
+    def histories(self) -> list[CaseHistory]:
+        histories = [CaseHistory(use_numpy=False)]
+
+        # NumPy is optional, the vectorized statistics are checked when it is installed
+        if (history := CaseHistory()).vectorized:
+            histories.append(history)
+
+        for history in histories:
+            history.extend(ROWS)
+
+        return histories
+
+    def test_columns(self):
+        history = CaseHistory(use_numpy=False)
+        history.extend(ROWS[:4])
+        history.extend([])
+        history.extend(ROWS[4:])
+
+        self.assertEqual(len(history), 7)
+        self.assertEqual(history.names, ["test_a", "test_b", "test_c"])
+        self.assertEqual(list(history.name_ids), [0, 1, 0, 1, 0, 2, 0])
+        self.assertEqual(list(history.outcome_codes), [0, 2, 1, 0, 0, 255, 4])
+        self.assertNotEqual(history.durations[1], history.durations[1])
+
+    def test_stats(self):
+        for history in self.histories():
+            with self.subTest(vectorized=history.vectorized):
+                test_a, test_b, test_c = history.test_stats((0, 50, 90, 100))
+
+                self.assertEqual(test_a["name"], "test_a")
+                self.assertEqual(test_a["runs"], 4)
+                self.assertEqual((test_a["passed"], test_a["failed"], test_a["flaky"]), (2, 1, 1))
+                self.assertEqual(test_a["failure_rate"], 0.25)
+                self.assertAlmostEqual(test_a["mean"], 2.5)
+                # Interpolated between 1, 2, 3 and 4
+                self.assertAlmostEqual(test_a["p0"], 1.0)
+                self.assertAlmostEqual(test_a["p50"], 2.5)
+                self.assertAlmostEqual(test_a["p90"], 3.7)
+                self.assertAlmostEqual(test_a["p100"], 4.0)
+
+                # The error was not timed
+                self.assertEqual(test_b["runs"], 2)
+                self.assertEqual(test_b["failure_rate"], 0.5)
+                self.assertAlmostEqual(test_b["p90"], 0.5)
+
+                self.assertEqual(test_c["runs"], 1)
+                self.assertEqual(test_c["passed"], 0)
+                self.assertAlmostEqual(test_c["mean"], 0.1)
+
+    def test_untimed_and_empty(self):
+        for use_numpy in (False, True):
+            with self.subTest(use_numpy=use_numpy):
+                history = CaseHistory(use_numpy=use_numpy)
+                self.assertEqual(history.test_stats(), [])
+
+                history.extend([(1, "test_a", None, "skipped")])
+                (test_a,) = history.test_stats()
+
+                self.assertEqual(test_a["skipped"], 1)
+                self.assertIsNone(test_a["mean"])
+                self.assertIsNone(test_a["p99"])
+
+                with self.assertRaises(ValueError):
+                    history.test_stats((101,))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            db_worker = DBWorker(os.path.join(folder, "history.sqlite3"))
+
+            for project in ("project a", "project b"):
+                db_worker.insert_project_to_database(project, "test_app.py", "url")
+                project_id = db_worker.get_project(project)[0]
+
+                for index, (_, name, duration, outcome) in enumerate(ROWS):
+                    batch_id = db_worker.insert_test_batch(
+                        project_id,
+                        {"tests": 1, "time": 1.0, "timestamp": f"2024-01-0{index + 1}T00:00:00"},
+                    )
+                    db_worker.insert_many_test_cases(batch_id, [(name, duration, outcome)])
+
+            history = CaseHistory.load(db_worker, project_id)
+            self.assertEqual(len(history), 7)
+            self.assertEqual(history.names, ["test_a", "test_b", "test_c"])
+            self.assertEqual(list(history.batch_ids), sorted(history.batch_ids))
+
+            history = CaseHistory.load(db_worker, project_id, last_batches=2)
+            self.assertEqual(len(history), 2)
+            self.assertEqual(history.names, ["test_c", "test_a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
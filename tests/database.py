@@ -282,6 +282,352 @@ class TestDBWorker(unittest.TestCase):
         self.assertTrue(self.db_worker.project_exists("project 13"))
         self.assertFalse(self.db_worker.project_exists("project 14"))
 
+    def test_batch_stage_timings(self):
+        self.db_worker.insert_project_to_database(
+            "Project 17", "test_file_17.py", "github_url_17"
+        )
+
+        project = self.db_worker.get_project("project 17")
+
+        batch = {
+            "errors": 0,
+            "failures": 0,
+            "skipped": 0,
+            "tests": 1,
+            "time": 0.0,
+            "timestamp": "2024-03-03T15:34:37.859003",
+        }
+
+        first_batch_id = self.db_worker.insert_test_batch(project[0], batch)
+        second_batch_id = self.db_worker.insert_test_batch(project[0], batch)
+
+        self.db_worker.insert_batch_stage_timings(
+            first_batch_id, {"fetch": 1.0, "test_run": 4.0}
+        )
+        self.db_worker.insert_batch_stage_timings(
+            second_batch_id, {"fetch": 3.0, "test_run": 2.0}
+        )
+
+        self.assertEqual(
+            self.db_worker.get_batch_stage_timings(first_batch_id),
+            {"fetch": 1.0, "test_run": 4.0},
+        )
+
+        project_timings = self.db_worker.get_project_stage_timings(project[0])
+        self.assertEqual(len(project_timings), 2)
+        self.assertEqual(project_timings[second_batch_id]["fetch"], 3.0)
+
+        average = self.db_worker.get_project_average_stage_timings(project[0])
+        self.assertEqual(average, {"fetch": 2.0, "test_run": 3.0})
+
+    def test_batch_pipeline_stages(self):
+        self.db_worker.insert_project_to_database(
+            "Project 18", "test_file_18.py", "github_url_18"
+        )
+
+        project = self.db_worker.get_project("project 18")
+
+        batch_id = self.db_worker.insert_test_batch(project[0], {"tests": 1})
+
+        results = {
+            "unit": {"status": "failed", "duration": 2.0},
+            "lint": {"status": "passed", "duration": 1.0},
+            "integration": {"status": "skipped", "duration": 0.0},
+        }
+        self.db_worker.insert_batch_pipeline_stages(batch_id, results)
+
+        stages = self.db_worker.get_batch_pipeline_stages(batch_id)
+        self.assertEqual(stages, results)
+        self.assertEqual(list(stages), ["unit", "lint", "integration"])
+
+        project_stages = self.db_worker.get_project_pipeline_stages(project[0])
+        self.assertEqual(project_stages, {batch_id: results})
+
+    def test_lease_build_job(self):
+        self.db_worker.insert_project_to_database(
+            "Project 15", "test_file_15.py", "github_url_15"
+        )
+
+        project = self.db_worker.get_project("project 15")
+
+        first_job_id = self.db_worker.enqueue_build_job(project[0], "main", "abc")
+        second_job_id = self.db_worker.enqueue_build_job(project[0], "main", "def")
+
+        # Drain the jobs queued by other tests
+        while (job := self.db_worker.lease_build_job("agent-1", 60)) is not None:
+            if job["id"] == first_job_id:
+                break
+            self.db_worker.finish_build_job(job["id"], "done", "drained")
+
+        self.assertEqual(job["id"], first_job_id)
+        self.assertEqual(job["project_name"], "project 15")
+        self.assertEqual(job["status"], "leased")
+        self.assertEqual(job["attempts"], 1)
+
+        # Builds run in their own workspace, a second build of the project can run
+        job = self.db_worker.lease_build_job("agent-2", 60)
+        self.assertEqual(job["id"], second_job_id)
+        self.assertIsNone(self.db_worker.lease_build_job("agent-3", 60))
+
+        self.assertTrue(self.db_worker.extend_build_job_lease(first_job_id, "agent-1", 60))
+        self.assertFalse(self.db_worker.extend_build_job_lease(first_job_id, "agent-2", 60))
+
+        # Only the agent holding the lease finishes the job
+        self.assertFalse(
+            self.db_worker.finish_build_job(first_job_id, "done", "Success", agent="agent-2")
+        )
+        self.assertTrue(
+            self.db_worker.finish_build_job(first_job_id, "done", "Success", agent="agent-1")
+        )
+        self.assertFalse(self.db_worker.finish_build_job(first_job_id, "done", "Success"))
+
+        self.db_worker.finish_build_job(second_job_id, "done", "Success")
+
+    def test_expired_build_job_is_requeued(self):
+        self.db_worker.insert_project_to_database(
+            "Project 16", "test_file_16.py", "github_url_16"
+        )
+
+        project = self.db_worker.get_project("project 16")
+        job_id = self.db_worker.enqueue_build_job(project[0], "main")
+
+        while (job := self.db_worker.lease_build_job("agent-1", -1)) is not None:
+            if job["id"] == job_id:
+                break
+            self.db_worker.finish_build_job(job["id"], "done", "drained")
+
+        # Lease already expired, the job goes back to the queue
+        self.assertEqual(self.db_worker.requeue_expired_build_jobs(max_attempts=2), 1)
+        self.assertEqual(self.db_worker.get_build_job(job_id)["status"], "queued")
+
+        job = self.db_worker.lease_build_job("agent-2", -1)
+        self.assertEqual(job["attempts"], 2)
+
+        # No attempt left, the job fails
+        self.db_worker.requeue_expired_build_jobs(max_attempts=2)
+        self.assertEqual(self.db_worker.get_build_job(job_id)["status"], "failed")
+
+    def test_matrix_build_jobs_run_together(self):
+        self.db_worker.insert_project_to_database(
+            "Project 19", "test_file_19.py", "github_url_19"
+        )
+
+        project = self.db_worker.get_project("project 19")
+
+        cells = [{"python": "3.11", "env": {}}, {"python": "3.12", "env": {}}]
+        job_ids = self.db_worker.enqueue_build_job_group(project[0], "main", "abc", cells)
+
+        leased = []
+
+        while (job := self.db_worker.lease_build_job("agent", 60)) is not None:
+            if job["project_id"] == project[0]:
+                leased.append(job)
+            else:
+                self.db_worker.finish_build_job(job["id"], "done", "drained")
+
+        # Both cells are leased at the same time
+        self.assertEqual([job["id"] for job in leased], job_ids)
+        self.assertEqual([job["matrix"] for job in leased], cells)
+        self.assertEqual({job["group_id"] for job in leased}, {job_ids[0]})
+
+        batch_id = self.db_worker.insert_test_batch(
+            project[0], {"failures": 1, "tests": 3}
+        )
+        self.db_worker.finish_build_job(job_ids[0], "done", "Success", batch_id)
+        self.db_worker.finish_build_job(job_ids[1], "failed", "Could not install")
+
+        matrix_build = self.db_worker.get_project_matrix_builds(project[0])[0]
+        self.assertEqual(matrix_build["group_id"], job_ids[0])
+        self.assertEqual(matrix_build["failures"], 1)
+        self.assertEqual(matrix_build["total"], 3)
+        self.assertEqual(
+            [cell["status"] for cell in matrix_build["cells"]], ["done", "failed"]
+        )
+
+    def drain_build_jobs(self):
+        while (job := self.db_worker.lease_build_job("drain", 60)) is not None:
+            self.db_worker.finish_build_job(job["id"], "done", "drained")
+
+    def test_lease_build_job_fair_share(self):
+        for number in (22, 23):
+            self.db_worker.insert_project_to_database(
+                f"Project {number}", f"test_file_{number}.py", f"github_url_{number}"
+            )
+
+        busy_id = self.db_worker.get_project("project 22")[0]
+        small_id = self.db_worker.get_project("project 23")[0]
+
+        self.drain_build_jobs()
+
+        busy_jobs = [self.db_worker.enqueue_build_job(busy_id, "main") for _ in range(3)]
+        small_job = self.db_worker.enqueue_build_job(small_id, "main")
+
+        # The busy project is using an agent, the small project goes first
+        self.assertEqual(self.db_worker.lease_build_job("agent-1", 60)["id"], busy_jobs[0])
+        self.assertEqual(self.db_worker.lease_build_job("agent-2", 60)["id"], small_job)
+
+        # Two jobs of the busy project at most
+        self.db_worker.set_project_queue_settings(busy_id, 0, 1, 2)
+        self.assertEqual(self.db_worker.lease_build_job("agent-3", 60)["id"], busy_jobs[1])
+        self.assertIsNone(self.db_worker.lease_build_job("agent-4", 60))
+        self.assertIsNone(self.db_worker.lease_build_job("agent-4", 60, max_running=1))
+
+        self.db_worker.finish_build_job(busy_jobs[0], "done", "Success")
+        self.assertEqual(self.db_worker.lease_build_job("agent-1", 60)["id"], busy_jobs[2])
+        self.drain_build_jobs()
+
+        # Priority first, then webhook builds before scheduled builds
+        self.db_worker.set_project_queue_settings(busy_id, 0, 1, None)
+        self.db_worker.set_project_queue_settings(small_id, 1, 1, None)
+
+        scheduled = self.db_worker.enqueue_build_job(
+            busy_id, "main", trigger="schedule:nightly"
+        )
+        webhook = self.db_worker.enqueue_build_job(busy_id, "main")
+        urgent = self.db_worker.enqueue_build_job(small_id, "main")
+
+        leased = [self.db_worker.lease_build_job("agent", 60)["id"] for _ in range(3)]
+        self.assertEqual(leased, [urgent, webhook, scheduled])
+
+        self.drain_build_jobs()
+        self.db_worker.set_project_queue_settings(small_id, 0, 1, None)
+
+    def test_scheduled_build_job_is_preempted(self):
+        self.db_worker.insert_project_to_database(
+            "Project 24", "test_file_24.py", "github_url_24"
+        )
+
+        project_id = self.db_worker.get_project("project 24")[0]
+        self.drain_build_jobs()
+
+        scheduled = self.db_worker.enqueue_build_job(
+            project_id, "main", trigger="schedule:nightly"
+        )
+        self.assertEqual(self.db_worker.lease_build_job("agent-1", 60)["id"], scheduled)
+
+        # Nothing waits for an agent
+        self.assertFalse(self.db_worker.preempt_build_job(scheduled, "agent-1", 0))
+
+        webhook = self.db_worker.enqueue_build_job(project_id, "main")
+
+        self.assertFalse(self.db_worker.preempt_build_job(scheduled, "agent-1", 60))
+        self.assertTrue(self.db_worker.preempt_build_job(scheduled, "agent-1", 0))
+        self.assertFalse(self.db_worker.extend_build_job_lease(scheduled, "agent-1", 60))
+
+        job = self.db_worker.get_build_job(scheduled)
+        self.assertEqual((job["status"], job["attempts"]), ("queued", 0))
+
+        # The freed agent takes the webhook build, then the scheduled build runs again
+        self.assertEqual(self.db_worker.lease_build_job("agent-1", 60)["id"], webhook)
+        self.assertEqual(self.db_worker.lease_build_job("agent-2", 60)["id"], scheduled)
+
+        # Webhook builds are not preempted
+        self.assertFalse(self.db_worker.preempt_build_job(webhook, "agent-1", 0))
+
+        self.drain_build_jobs()
+        self.db_worker.finish_build_job(webhook, "done", "Success")
+        self.db_worker.finish_build_job(scheduled, "done", "Success")
+
+    def test_lease_build_job_memory_budget(self):
+        self.db_worker.insert_project_to_database(
+            "Project 25", "test_file_25.py", "github_url_25"
+        )
+
+        project_id = self.db_worker.get_project("project 25")[0]
+        self.drain_build_jobs()
+
+        self.assertIsNone(self.db_worker.get_project_peak_memory(project_id))
+        self.db_worker.record_project_peak_memory(project_id, 1000)
+        self.assertEqual(self.db_worker.get_project_peak_memory(project_id), 1000)
+
+        # The peak goes down slowly, up right away
+        self.db_worker.record_project_peak_memory(project_id, 500)
+        self.assertEqual(self.db_worker.get_project_peak_memory(project_id), 900)
+        self.db_worker.record_project_peak_memory(project_id, 2000)
+        self.assertEqual(self.db_worker.get_project_peak_memory(project_id), 2000)
+
+        job_id = self.db_worker.enqueue_build_job(project_id, "main")
+
+        self.assertIsNone(self.db_worker.lease_build_job("agent", 60, memory_budget=1999))
+        self.assertEqual(
+            self.db_worker.lease_build_job("agent", 60, memory_budget=2000)["id"], job_id
+        )
+
+        self.db_worker.finish_build_job(job_id, "done", "Success")
+
+    def test_result_cache(self):
+        self.db_worker.insert_project_to_database(
+            "Project 20", "test_file_20.py", "github_url_20"
+        )
+
+        project = self.db_worker.get_project("project 20")
+        self.assertIsNone(self.db_worker.get_cached_batch("key-20"))
+
+        source_id = self.db_worker.insert_test_batch(
+            project[0],
+            {
+                "errors": 1,
+                "failures": 2,
+                "tests": 5,
+                "time": 3.5,
+                "timestamp": "2024-01-01T00:00:00.000000",
+            },
+        )
+        self.db_worker.insert_cached_batch("key-20", source_id)
+        self.assertEqual(self.db_worker.get_cached_batch("key-20"), source_id)
+
+        batch_id = self.db_worker.insert_cache_hit_batch(
+            project[0], source_id, "2024-01-01T00:00:00.000000"
+        )
+
+        batch = [
+            batch
+            for batch in self.db_worker.get_project_test_batches(project[0])
+            if batch["id"] == batch_id
+        ][0]
+        self.assertEqual((batch["errors"], batch["failures"]), (1, 2))
+        self.assertEqual(batch["total"], 5)
+        self.assertEqual(batch["execution_time"], "0.0 s")
+
+        self.assertEqual(
+            self.db_worker.get_project_cache_hits(project[0]), {batch_id: source_id}
+        )
+
+    def test_flaky_tests(self):
+        self.db_worker.insert_project_to_database(
+            "Project 21", "test_file_21.py", "github_url_21"
+        )
+
+        project_id = self.db_worker.get_project("project 21")[0]
+
+        # A flip on the same content, a flaky rerun, a change of content
+        self.db_worker.update_test_flakiness(
+            project_id, [("test_a", "passed"), ("test_b", "flaky")], "key-1"
+        )
+        self.db_worker.update_test_flakiness(
+            project_id, [("test_a", "failed"), ("test_b", "passed")], "key-1"
+        )
+        self.db_worker.update_test_flakiness(
+            project_id,
+            [("test_a", "passed"), ("test_c", "failed"), ("test_d", "skipped")],
+            "key-2",
+        )
+
+        flaky_tests = self.db_worker.get_project_flaky_tests(project_id)
+
+        self.assertEqual(
+            [(test["test_name"], test["runs"], test["flips"]) for test in flaky_tests],
+            [("test_b", 2, 1), ("test_a", 3, 1)],
+        )
+        self.assertEqual(flaky_tests[1]["failures"], 1)
+
+        self.db_worker.quarantine_test(project_id, "test_c")
+        self.assertEqual(self.db_worker.get_quarantined_tests(project_id), ["test_c"])
+        self.assertTrue(self.db_worker.get_project_flaky_tests(project_id)[-1]["quarantined"])
+
+        self.db_worker.release_test(project_id, "test_c")
+        self.assertEqual(self.db_worker.get_quarantined_tests(project_id), [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,48 @@
+import sys
+import unittest
+
+sys.path.append("../")
+
+from workers.event_broadcaster import EventBroadcaster
+
+
+class TestEventBroadcaster(unittest.TestCase):
+    def setUp(self):
+        self.subscribers = [EventBroadcaster.subscribe() for _ in range(3)]
+
+    def tearDown(self):
+        for subscriber in self.subscribers:
+            EventBroadcaster.unsubscribe(subscriber)
+
+    def test_publish_reaches_every_subscriber(self):
+        self.assertTrue(EventBroadcaster.has_subscribers())
+        self.assertEqual(EventBroadcaster.publish("batch", {"project_id": 1}), 3)
+
+        for subscriber in self.subscribers:
+            self.assertEqual(
+                subscriber.get_nowait(), 'event: batch\ndata: {"project_id": 1}\n\n'
+            )
+
+    def test_stream(self):
+        stream = EventBroadcaster.stream(self.subscribers[0])
+
+        self.assertTrue(next(stream).startswith("retry: "))
+
+        EventBroadcaster.publish("build_started", {"job_id": 7})
+        self.assertEqual(next(stream), 'event: build_started\ndata: {"job_id": 7}\n\n')
+
+        # Closing the stream (page closed) removes the subscriber
+        stream.close()
+        self.assertEqual(EventBroadcaster.publish("build_started", {"job_id": 8}), 2)
+
+    def test_slow_subscriber_is_dropped(self):
+        for job_id in range(EventBroadcaster.max_queued):
+            EventBroadcaster.publish("build_started", {"job_id": job_id})
+
+        # Every queue is full, nobody reads them
+        self.assertEqual(EventBroadcaster.publish("build_started", {"job_id": -1}), 0)
+        self.assertFalse(EventBroadcaster.has_subscribers())
+
+
+if __name__ == "__main__":
+    unittest.main()
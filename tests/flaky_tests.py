@@ -0,0 +1,131 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append("../")
+
+from workers.flaky_tests import FlakyTests
+from workers.runners import TestRunner
+from workers.tester import Tester
+
+
+FLAKY_TEST_FILE = """
+import os
+
+
+def test_stable():
+    assert True
+
+
+def test_flaky():
+    # Fails on the first run only
+    if not os.path.exists("ran_once"):
+        open("ran_once", "w").close()
+        assert False
+
+
+def test_broken():
+    assert False
+"""
+
+
+class TestFlakyTests(unittest.TestCase):
+    def setUp(self):
+        self.project_folder = tempfile.mkdtemp()
+
+        with open(os.path.join(self.project_folder, "test_app.py"), "w") as file:
+            file.write(FLAKY_TEST_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.project_folder)
+
+    def run_command(self, command: list[str]) -> int:
+        return subprocess.call(
+            [sys.executable] + command[1:],
+            cwd=self.project_folder,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def test_reruns_mark_flaky_tests(self):
+        runner = TestRunner.for_project(
+            self.project_folder, "test_app.py", {"reruns": 2}, stage="test"
+        )
+        runner.clear_reports()
+
+        self.assertNotEqual(self.run_command(runner.command()), 0)
+        self.assertEqual(
+            FlakyTests.failed_tests(runner.report_files()),
+            {"test_app.test_flaky", "test_app.test_broken"},
+        )
+
+        # Each stage keeps the last failed tests in its own cache
+        self.assertTrue(os.path.isdir(runner.cache_dir))
+        self.assertFalse(os.path.exists(os.path.join(self.project_folder, ".pytest_cache")))
+
+        # Only the failed tests run again
+        self.assertNotEqual(self.run_command(runner.rerun_command(1)), 0)
+
+        flaky = FlakyTests.apply_reruns(
+            runner.report_files(), FlakyTests.rerun_files(runner.rerun_dir)
+        )
+
+        self.assertEqual(flaky, {"test_app.test_flaky"})
+        self.assertEqual(
+            FlakyTests.failed_tests(runner.report_files()), {"test_app.test_broken"}
+        )
+
+        root = Tester.merge_junitxml_files(runner.report_files())
+        test_result, testcases = Tester.parse_junitxml(root)
+
+        self.assertEqual(test_result["failures"], "1")
+        self.assertEqual(
+            sorted((name, outcome) for name, _, outcome in testcases),
+            [
+                ("test_app.test_broken", "failed"),
+                ("test_app.test_flaky", "flaky"),
+                ("test_app.test_stable", "passed"),
+            ],
+        )
+
+        # The reruns are not parsed again by the next build
+        runner.clear_reports()
+        self.assertEqual(FlakyTests.rerun_files(runner.rerun_dir), [])
+
+    def test_reruns_match_tests_by_class(self):
+        report = os.path.join(self.project_folder, "junit.xml")
+        rerun = os.path.join(self.project_folder, "rerun.xml")
+
+        with open(report, "w") as file:
+            file.write(
+                """<testsuite failures="2" tests="2">
+                    <testcase classname="TestA" name="test_save" time="0.1"><failure /></testcase>
+                    <testcase classname="TestB" name="test_save" time="0.1"><failure /></testcase>
+                </testsuite>"""
+            )
+
+        # Only the test of TestA passes again
+        with open(rerun, "w") as file:
+            file.write(
+                """<testsuite failures="1" tests="2">
+                    <testcase classname="TestA" name="test_save" time="0.1" />
+                    <testcase classname="TestB" name="test_save" time="0.1"><failure /></testcase>
+                </testsuite>"""
+            )
+
+        self.assertEqual(FlakyTests.apply_reruns([report], [rerun]), {"TestA.test_save"})
+        self.assertEqual(FlakyTests.failed_tests([report]), {"TestB.test_save"})
+
+    def test_reruns_need_a_supporting_backend(self):
+        runner = TestRunner.for_project(
+            self.project_folder, "test_app.py", {"backend": "tox", "reruns": 1}
+        )
+
+        self.assertEqual(runner.check(), "reruns are not supported by the tox backend")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import glob
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.append("../")
+
+from workers.batch_diff import BatchDiff
+from workers.database import DBWorker
+from workers.history import History
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "source.sqlite3")
+
+        db_worker = DBWorker(self.source)
+
+        for project in range(2):
+            db_worker.insert_project_to_database(f"project {project}", "test_app.py", "url")
+            project_id = db_worker.get_project(f"project {project}")[0]
+
+            for batch in range(3):
+                batch_id = db_worker.insert_test_batch(
+                    project_id,
+                    {"tests": 4, "failures": batch, "time": 1.5, "timestamp": "2024-01-01T00:00:00"},
+                    # Batches of a matrix cell, and of the default build
+                    BatchDiff.variant({"python": "3.12", "env": {}}) if batch else None,
+                )
+                db_worker.insert_many_test_cases(
+                    batch_id,
+                    [(f"test_{case}", 0.25, "passed") for case in range(3)]
+                    + [("test_broken", 0.25, "failed")],
+                )
+                db_worker.insert_batch_stage_timings(batch_id, {"test_run": 1.5})
+                db_worker.update_test_flakiness(
+                    project_id,
+                    [(f"test_{case}", "passed") for case in range(3)]
+                    + [("test_broken", "failed" if batch else "flaky")],
+                )
+
+            db_worker.quarantine_test(project_id, "test_broken")
+
+    def tearDown(self):
+        for file in glob.glob(os.path.join(self.folder, "*")):
+            os.remove(file)
+        os.rmdir(self.folder)
+
+    def dump(self, path: str) -> dict:
+        connection = sqlite3.connect(path)
+
+        try:
+            return {
+                table: connection.execute(
+                    f"SELECT {', '.join(columns)} FROM {table}"
+                    f" ORDER BY {columns[0]}, {columns[1]}"
+                ).fetchall()
+                for table, columns in DBWorker.history_tables.items()
+            }
+        finally:
+            connection.close()
+
+    def test_export_import(self):
+        for format_, file_name in (("ndjson", "history.ndjson"), ("columnar", "history.gz")):
+            with self.subTest(format_):
+                path = os.path.join(self.folder, file_name)
+                target = os.path.join(self.folder, f"{format_}.sqlite3")
+
+                # Small chunks, several of them per table
+                counts = History.export(DBWorker(self.source), path, format_, chunk_size=5)
+                self.assertEqual(counts["test_cases"], 24)
+                self.assertEqual(counts["test_flakiness"], 8)
+
+                counts = History.import_(DBWorker(target), path, chunk_size=5)
+                self.assertEqual(counts["test_batches"], 6)
+                self.assertEqual(self.dump(target), self.dump(self.source))
+
+                # Importing again does not duplicate the history
+                counts = History.import_(DBWorker(target), path)
+                self.assertEqual(sum(counts.values()), 0)
+
+    def test_import_rejects_other_files(self):
+        path = os.path.join(self.folder, "other.ndjson")
+
+        with open(path, "w") as file:
+            file.write('{"table": "projects", "id": 1}\n')
+
+        with self.assertRaises(ValueError):
+            History.import_(DBWorker(self.source), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.host_resources import HostResources
+from workers.process_runner import ProcessRunner
+
+
+MB = 1024 * 1024
+
+
+class TestHostResources(unittest.TestCase):
+    def resources(self, load=0.5, free_memory=4096 * MB, free_disk=10240 * MB):
+        return mock.patch.object(
+            HostResources,
+            "sample",
+            return_value={"load": load, "free_memory": free_memory, "free_disk": free_disk},
+        )
+
+    def setUp(self):
+        for name, value in (
+            ("max_load", 1.5),
+            ("min_free_memory", 512 * MB),
+            ("min_free_disk", 2048 * MB),
+        ):
+            patcher = mock.patch.object(HostResources, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sample(self):
+        resources = HostResources.sample()
+
+        self.assertEqual(set(resources), {"load", "free_memory", "free_disk"})
+        self.assertGreater(resources["free_memory"], 0)
+        self.assertGreater(resources["free_disk"], 0)
+
+    def test_memory_budget(self):
+        with self.resources():
+            self.assertEqual(HostResources.memory_budget(), (3584 * MB, None))
+
+        for resources in (
+            self.resources(load=2),
+            self.resources(free_memory=256 * MB),
+            self.resources(free_disk=1024 * MB),
+        ):
+            with self.subTest(), resources:
+                budget, reason = HostResources.memory_budget()
+                self.assertIsNone(budget)
+                self.assertIsNotNone(reason)
+
+        # A disabled check does not refuse builds
+        with self.resources(load=2), mock.patch.object(HostResources, "max_load", 0):
+            self.assertIsNone(HostResources.memory_budget()[1])
+
+    def test_reserved_memory(self):
+        HostResources.reserve(1024 * MB)
+
+        with self.resources():
+            self.assertEqual(HostResources.memory_budget(), (2560 * MB, None))
+
+        with mock.patch.object(HostResources, "warmup_seconds", 0):
+            self.assertEqual(HostResources.reserved_memory(), 0)
+
+    def test_peak_memory_of_commands(self):
+        with ProcessRunner.measure_memory() as memory:
+            ProcessRunner.call(
+                [
+                    sys.executable,
+                    "-c",
+                    "import time; data = bytearray(64 * 1024 * 1024); time.sleep(1.5)",
+                ]
+            )
+
+        self.assertGreater(memory.peak, 64 * MB)
+
+        # Outside the block, the commands are not measured
+        ProcessRunner.call(["true"])
+        self.assertLess(memory.peak, 256 * MB)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append("../")
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Entry points and workers must import fast and without side effects:
+    agents and CLI tools are short lived processes.
+
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    # Milliseconds an entry point may take to import, CI_IMPORT_BUDGET_MS
+    budget = float(os.getenv("CI_IMPORT_BUDGET_MS", 150))
+
+    # The server also imports Flask, CI_SERVER_IMPORT_BUDGET_MS
+    server_budget = float(os.getenv("CI_SERVER_IMPORT_BUDGET_MS", 300))
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.database = os.path.join(self.folder, "import.sqlite3")
+
+    def tearDown(self):
+        for name in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, name))
+        os.rmdir(self.folder)
+
+    def import_module(self, module: str) -> tuple[float, set[str], tuple[int, int]]:
+        """
+        Import a module in a new interpreter.
+
+        Returns:
+            The import time of the module in milliseconds, the modules loaded,
+            and the number of threads and of root logger handlers after it
+
+        """
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"import sys, {module}, logging, threading; "
+                "print(' '.join(sys.modules)); "
+                "print(threading.active_count(), len(logging.getLogger().handlers))",
+            ],
+            cwd=self.folder,
+            env={**os.environ, "PYTHONPATH": self.root, "CI_DATABASE_URL": self.database},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        # import time: self [us] | cumulative | imported package
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                modules, counts = result.stdout.splitlines()
+                threads, handlers = map(int, counts.split())
+
+                return int(fields[1]) / 1000, set(modules.split()), (threads, handlers)
+
+        self.fail(f"no import time for {module}")
+
+    def test_entry_points_import_fast(self):
+        for module in ("agent", "history", "workers.build_agent", "workers.scheduler"):
+            with self.subTest(module=module):
+                # The best of 3 runs, the first one also warms the disk cache
+                elapsed = min(self.import_module(module)[0] for _ in range(3))
+                self.assertLess(elapsed, self.budget)
+
+    def test_server_imports_only_the_web_app(self):
+        runs = [self.import_module("main") for _ in range(3)]
+        self.assertLess(min(elapsed for elapsed, _, _ in runs), self.server_budget)
+
+        # The builds and the schedules are loaded when the server runs
+        modules = runs[0][1]
+        self.assertFalse(os.path.exists(self.database))
+        self.assertNotIn("workers.build_agent", modules)
+        self.assertNotIn("workers.tester", modules)
+        self.assertNotIn("workers.scheduler", modules)
+        self.assertNotIn("workers.project_jobs", modules)
+        self.assertNotIn("numpy", modules)
+
+    def test_imports_have_no_side_effects(self):
+        for module in ("agent", "history", "workers.tester", "workers.job_queue"):
+            with self.subTest(module=module):
+                _, modules, (threads, handlers) = self.import_module(module)
+
+                # No database is opened, no web or PostgreSQL stack is loaded
+                self.assertFalse(os.path.exists(self.database))
+                self.assertNotIn("flask", modules)
+                self.assertNotIn("psycopg2", modules)
+                self.assertNotIn("urllib.request", modules)
+
+                # Logging is set up by the entry point, not on import
+                self.assertEqual(threads, 1)
+                self.assertEqual(handlers, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
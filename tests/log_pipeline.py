@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+import sys
+
+sys.path.append("../")
+
+from workers.log_pipeline import (
+    ContextFilter,
+    JsonFormatter,
+    LogPipeline,
+    SizeAndTimeRotatingFileHandler,
+)
+
+
+class TestLogPipeline(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.folder.name, "ci.log")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def make_record(self, message: str) -> logging.LogRecord:
+        record = logging.LogRecord("ci", logging.INFO, __file__, 1, message, None, None)
+        ContextFilter().filter(record)
+        return record
+
+    def test_json_record_carries_context(self):
+        with LogPipeline.context(project="demo", build=4, delivery=None):
+            record = self.make_record("build started")
+
+        entry = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(entry["message"], "build started")
+        self.assertEqual(entry["project"], "demo")
+        self.assertEqual(entry["build"], 4)
+        self.assertNotIn("delivery", entry)
+
+        # The context is restored after the block
+        self.assertEqual(self.make_record("done").context, {})
+
+    def test_rotate_on_size(self):
+        handler = SizeAndTimeRotatingFileHandler(
+            self.log_file, max_bytes=100, max_age=3600, backup_count=2
+        )
+
+        for _ in range(5):
+            handler.emit(self.make_record("x" * 60))
+        handler.close()
+
+        self.assertTrue(os.path.exists(self.log_file + ".1"))
+
+    def test_rotate_on_age(self):
+        handler = SizeAndTimeRotatingFileHandler(
+            self.log_file, max_bytes=10**6, max_age=3600, backup_count=2
+        )
+
+        handler.emit(self.make_record("first"))
+        self.assertFalse(os.path.exists(self.log_file + ".1"))
+
+        # Pretend the file was opened two hours ago
+        handler.opened_at -= 7200
+        handler.emit(self.make_record("second"))
+        handler.close()
+
+        self.assertTrue(os.path.exists(self.log_file + ".1"))
+
+    def test_age_of_existing_file_survives_restart(self):
+        with open(self.log_file, "w") as file:
+            file.write("before the restart\n")
+
+        two_hours_ago = time.time() - 7200
+        os.utime(self.log_file, (two_hours_ago, two_hours_ago))
+
+        handler = SizeAndTimeRotatingFileHandler(
+            self.log_file, max_bytes=10**6, max_age=3600, backup_count=2
+        )
+        handler.emit(self.make_record("after the restart"))
+        handler.close()
+
+        self.assertTrue(os.path.exists(self.log_file + ".1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import sys
+
+sys.path.append("../")
+
+from workers.matrix import BuildMatrix
+
+
+class TestBuildMatrix(unittest.TestCase):
+    def test_no_matrix(self):
+        self.assertEqual(BuildMatrix.cells({}), [])
+        self.assertEqual(BuildMatrix.venv_name(None), ".venv")
+        self.assertEqual(BuildMatrix.python_executable(None), "python3")
+
+    def test_cells_are_the_product_of_pythons_and_env_sets(self):
+        cells = BuildMatrix.cells(
+            {
+                "matrix": {
+                    "python": ["3.11", 3.12],
+                    "env": [{"DJANGO": "4.2"}, {"DJANGO": 5}],
+                }
+            }
+        )
+
+        self.assertEqual(len(cells), 4)
+        self.assertEqual(cells[0], {"python": "3.11", "env": {"DJANGO": "4.2"}})
+        self.assertEqual(cells[3], {"python": "3.12", "env": {"DJANGO": "5"}})
+
+    def test_cells_get_their_own_venv(self):
+        first, second = BuildMatrix.cells(
+            {"matrix": {"python": ["3.12"], "env": [{"A": "1"}, {"A": "2"}]}}
+        )
+
+        self.assertNotEqual(BuildMatrix.venv_name(first), BuildMatrix.venv_name(second))
+        self.assertTrue(BuildMatrix.venv_name(first).startswith(".venv-py3.12-"))
+        self.assertEqual(BuildMatrix.name(first), "python 3.12, A=1")
+
+    def test_python_executable(self):
+        self.assertEqual(BuildMatrix.python_executable({"python": "3.12"}), "python3.12")
+        self.assertEqual(BuildMatrix.python_executable({"python": "pypy3"}), "pypy3")
+
+
+if __name__ == "__main__":
+    unittest.main()
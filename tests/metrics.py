@@ -0,0 +1,97 @@
+import time
+import unittest
+import sys
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.metrics import Counter, Gauge, Histogram, Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_with_labels(self):
+        counter = Counter("ci_test_total", "Test counter.", ("status",))
+
+        counter.inc(status="done")
+        counter.inc(2, status="done")
+        counter.inc(status="failed")
+
+        self.assertEqual(
+            counter.samples(),
+            ['ci_test_total{status="done"} 3', 'ci_test_total{status="failed"} 1'],
+        )
+
+    def test_gauge_set(self):
+        gauge = Gauge("ci_test_depth", "Test gauge.")
+
+        gauge.set(5)
+        gauge.set(2)
+
+        self.assertEqual(gauge.samples(), ["ci_test_depth 2"])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram(
+            "ci_test_seconds", "Test histogram.", ("stage",), buckets=(1, 5)
+        )
+
+        histogram.observe(0.5, stage="fetch")
+        histogram.observe(3, stage="fetch")
+        histogram.observe(10, stage="fetch")
+
+        self.assertEqual(
+            histogram.samples(),
+            [
+                'ci_test_seconds_bucket{stage="fetch",le="1"} 1',
+                'ci_test_seconds_bucket{stage="fetch",le="5"} 2',
+                'ci_test_seconds_bucket{stage="fetch",le="+Inf"} 3',
+                'ci_test_seconds_sum{stage="fetch"} 13.5',
+                'ci_test_seconds_count{stage="fetch"} 3',
+            ],
+        )
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("ci_test_total", "Test counter.", ("project",))
+
+        counter.inc(project='my "project"')
+
+        self.assertEqual(counter.samples(), ['ci_test_total{project="my \\"project\\""} 1'])
+
+    def test_generator_methods_are_timed_while_iterated(self):
+        class Worker:
+            def iter_rows(self):
+                return self.__rows()
+
+            def __rows(self):
+                for row in range(3):
+                    time.sleep(0.02)
+                    yield row
+
+        histogram = Histogram("ci_test_db_seconds", "Test histogram.", ("method",))
+
+        with mock.patch.object(Metrics, "db_query_duration", histogram):
+            Metrics.time_db_methods(Worker)
+            rows = Worker().iter_rows()
+
+            self.assertEqual(histogram.samples(), [])
+
+            for row in rows:
+                # The time of the caller is not counted
+                time.sleep(0.05)
+
+        ((count, total),) = [
+            (state[-1], state[-2]) for state in histogram._values.values()
+        ]
+        self.assertEqual(count, 1)
+        self.assertTrue(0.06 <= total < 0.15, total)
+
+        # A generator closed early is observed too
+        with mock.patch.object(Metrics, "db_query_duration", histogram):
+            rows = Worker().iter_rows()
+            next(rows)
+            rows.close()
+
+        self.assertEqual(histogram._values[("iter_rows",)][-1], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
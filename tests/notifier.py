@@ -0,0 +1,294 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.database import DBWorker
+from workers.job_queue import JobQueue
+from workers.notifier import HttpPool, Notifier
+from workers.project_manager import ProjectManager
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local endpoint recording the requests it gets, answering the statuses
+    of self.statuses in turn, then 200.
+
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.statuses = []
+        self.drop_connections = False
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(
+            {
+                "path": self.path,
+                "headers": dict(self.headers),
+                "body": json.loads(body),
+                "client": self.client_address,
+            }
+        )
+
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "120")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHttpPool(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.pool = HttpPool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for index in range(3):
+            status, _ = self.pool.post(
+                f"{self.server.url}/hook?n={index}", b"{}", {"Content-Type": "application/json"}
+            )
+            self.assertEqual(status, 200)
+
+        self.assertEqual([request["path"] for request in self.server.requests][-1], "/hook?n=2")
+        self.assertEqual(len({request["client"] for request in self.server.requests}), 1)
+
+    def test_closed_connection_is_replaced(self):
+        # The server closes each connection, without telling the client
+        self.server.drop_connections = True
+
+        for _ in range(2):
+            status, _ = self.pool.post(f"{self.server.url}/hook", b"{}", {})
+            self.assertEqual(status, 200)
+
+        self.assertEqual(len({request["client"] for request in self.server.requests}), 2)
+
+
+class TestNotifier(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+
+        # The notifier and the job queue use the default database
+        patchers = [
+            mock.patch.dict(os.environ, {"CI_DATABASE_URL": "tests.sqlite3"}),
+            mock.patch.object(Notifier, "github_token", "token"),
+            mock.patch.object(Notifier, "github_api_url", self.server.url),
+            mock.patch.object(Notifier, "retry_seconds", 0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.db_worker = DBWorker()
+        self.name = f"test-notifier-{os.getpid()}"
+        self.folder = os.path.join(ProjectManager.parent_dir, "projects", self.name)
+        os.makedirs(self.folder)
+
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write(
+                f'[[notifications]]\nurl = "{self.server.url}/chat"\n\n'
+                f'[[notifications]]\nurl = "{self.server.url}/alerts"\non = "failure"\n'
+            )
+
+        self.db_worker.insert_project_to_database(
+            self.name, "test_app.py", f"https://github.com/ci/{self.name}.git", "main"
+        )
+        self.project_id = self.db_worker.get_project(self.name)[0]
+
+    def tearDown(self):
+        # Other tests expect an empty queue and outbox
+        while (job := self.db_worker.lease_build_job("test-notifier", 60)) is not None:
+            self.db_worker.finish_build_job(job["id"], "done", "")
+
+        self.db_worker.finish_notifications(
+            [
+                notification["id"]
+                for notification in self.db_worker.get_notifications()
+                if notification["status"] == "pending"
+            ],
+            "failed",
+        )
+
+        self.db_worker.delete_project_by_name(self.name)
+        shutil.rmtree(self.folder)
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def build(self, commit_sha: str, failures: int = 0) -> int:
+        job_id = self.db_worker.enqueue_build_job(self.project_id, "main", commit_sha)
+        job = JobQueue.lease("test-notifier")
+        self.assertEqual(job["id"], job_id)
+
+        batch_id = self.db_worker.insert_test_batch(
+            self.project_id,
+            {"tests": 2, "failures": failures, "time": 1.0, "timestamp": "2024-01-01T00:00:00"},
+        )
+        JobQueue.complete(job_id, True, "Success", batch_id)
+
+        return job_id
+
+    def test_endpoints(self):
+        self.assertEqual(
+            Notifier.endpoints({"notifications": [{"url": "https://chat/hook"}]}),
+            [{"url": "https://chat/hook", "on": "always"}],
+        )
+
+        for endpoint in ({}, {"url": "ftp://chat"}, {"url": "https://chat", "on": "never"}):
+            with self.subTest(endpoint=endpoint):
+                with self.assertRaises(ValueError):
+                    Notifier.endpoints({"notifications": [endpoint]})
+
+    def test_statuses_and_summaries(self):
+        first = self.build("a" * 40)
+        second = self.build("b" * 40, failures=1)
+
+        # The pending statuses were superseded by the final ones when queued
+        self.assertEqual(Notifier.dispatch(), 5)
+
+        statuses = [
+            request for request in self.server.requests if "/statuses/" in request["path"]
+        ]
+        self.assertEqual(
+            sorted((request["path"], request["body"]["state"]) for request in statuses),
+            [
+                (f"/repos/ci/{self.name}/statuses/{'a' * 40}", "success"),
+                (f"/repos/ci/{self.name}/statuses/{'b' * 40}", "failure"),
+            ],
+        )
+        self.assertEqual(statuses[0]["headers"]["Authorization"], "Bearer token")
+
+        # The summaries of both builds in one request
+        (chat,) = [request for request in self.server.requests if request["path"] == "/chat"]
+        self.assertEqual([build["job_id"] for build in chat["body"]["builds"]], [first, second])
+        self.assertEqual(chat["body"]["builds"][1]["batch"]["failures"], 1)
+
+        (alerts,) = [request for request in self.server.requests if request["path"] == "/alerts"]
+        self.assertEqual([build["job_id"] for build in alerts["body"]["builds"]], [second])
+
+        self.assertEqual(
+            {n["status"] for n in self.db_worker.get_notifications(self.project_id)},
+            {"sent", "superseded"},
+        )
+        self.assertEqual(Notifier.dispatch(), 0)
+
+    def test_late_retry_does_not_overwrite_final_status(self):
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write("")
+
+        job_id = self.db_worker.enqueue_build_job(self.project_id, "main", "a" * 40)
+        JobQueue.lease("test-notifier")
+
+        # The pending status fails, and waits for its retry
+        self.server.statuses = [503]
+        with mock.patch.object(Notifier, "retry_seconds", 1):
+            self.assertEqual(Notifier.dispatch(), 1)
+
+        # The final status is sent before the retry is due
+        JobQueue.complete(job_id, False, "Tests could not run", None)
+        self.assertEqual(Notifier.dispatch(), 1)
+
+        time.sleep(1.1)
+        self.assertEqual(Notifier.dispatch(), 0)
+
+        self.assertEqual(
+            [request["body"]["state"] for request in self.server.requests],
+            ["pending", "error"],
+        )
+        self.assertEqual(
+            [n["status"] for n in self.db_worker.get_notifications(self.project_id)],
+            ["sent", "superseded"],
+        )
+
+    def test_retries(self):
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write(f'[[notifications]]\nurl = "{self.server.url}/chat"\n')
+
+        with mock.patch.object(Notifier, "github_token", None):
+            self.server.statuses = [503, 500]
+            self.build("c" * 40)
+
+            # Retried right away with retry_seconds = 0
+            for _ in range(3):
+                Notifier.dispatch()
+
+        (notification,) = self.db_worker.get_notifications(self.project_id)
+        self.assertEqual(notification["status"], "sent")
+        self.assertEqual(notification["attempts"], 3)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # A rejected request is not sent again
+        with mock.patch.object(Notifier, "github_token", None):
+            self.server.statuses = [404]
+            self.build("d" * 40)
+            Notifier.dispatch()
+
+        notification = self.db_worker.get_notifications(self.project_id)[0]
+        self.assertEqual(notification["status"], "failed")
+        self.assertEqual(notification["last_error"], "HTTP 404")
+
+        # Rate limited, the endpoint asks to wait
+        with mock.patch.object(Notifier, "github_token", None):
+            self.server.statuses = [429]
+            self.build("e" * 40)
+            Notifier.dispatch()
+
+        notification = self.db_worker.get_notifications(self.project_id)[0]
+        self.assertEqual(notification["status"], "pending")
+        self.assertGreater(notification["next_attempt_at"], time.time() + 100)
+
+    def test_retry_delay(self):
+        with mock.patch.object(Notifier, "retry_seconds", 10):
+            for attempts, high in ((1, 10), (2, 20), (5, 160), (20, 3600)):
+                delay = Notifier.retry_delay(attempts)
+                self.assertTrue(high / 2 <= delay <= high, (attempts, delay))
+
+            self.assertGreaterEqual(Notifier.retry_delay(1, "60"), 60)
+
+    def test_unreachable_endpoint_does_not_fail_the_build(self):
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write('[[notifications]]\nurl = "http://127.0.0.1:1/chat"\n')
+
+        with mock.patch.object(Notifier, "github_token", None):
+            start = time.monotonic()
+            self.build("f" * 40)
+            self.assertLess(time.monotonic() - start, 1)
+
+            Notifier.dispatch()
+
+        (notification,) = self.db_worker.get_notifications(self.project_id)
+        self.assertEqual(notification["status"], "pending")
+        self.assertIn("ConnectionRefusedError", notification["last_error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append("../")
+
+from workers.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.project_folder = tempfile.mkdtemp()
+
+    def pipeline(self, stages: dict, **config) -> Pipeline:
+        return Pipeline.for_project(
+            self.project_folder, "test_app.py", {"stages": stages, **config}
+        )
+
+    def test_default_pipeline(self):
+        pipeline = Pipeline.for_project(self.project_folder, "test_app.py", {})
+
+        self.assertEqual(pipeline.order, ["test"])
+        self.assertEqual(pipeline.runners["test"].command()[-1], "test_app.py")
+
+    def test_stages_are_sorted(self):
+        pipeline = self.pipeline(
+            {
+                "integration": {"tests": "tests/integration", "needs": ["unit"]},
+                "unit": {"tests": "tests/unit", "needs": ["lint"]},
+                "lint": {"command": "ruff check ."},
+            }
+        )
+
+        self.assertEqual(pipeline.order, ["lint", "unit", "integration"])
+        self.assertEqual(pipeline.runners["lint"].command(), ["bash", "-c", "ruff check ."])
+
+    def test_requirements_of_every_stage(self):
+        for name, content in (("requirements.txt", "pytest\n"), ("lint.txt", "ruff\n")):
+            with open(os.path.join(self.project_folder, name), "w") as file:
+                file.write(content)
+
+        single = self.pipeline({"unit": {}, "integration": {"needs": ["unit"]}})
+        self.assertEqual(single.requirements, ["requirements.txt"])
+        self.assertEqual(
+            single.requirements_hash(), single.runners["unit"].requirements_hash()
+        )
+
+        pipeline = self.pipeline(
+            {"lint": {"command": "ruff check .", "requirements": "lint.txt"}, "unit": {}}
+        )
+        self.assertEqual(sorted(pipeline.requirements), ["lint.txt", "requirements.txt"])
+
+        before = pipeline.requirements_hash()
+        self.assertNotEqual(before, single.requirements_hash())
+
+        with open(os.path.join(self.project_folder, "lint.txt"), "a") as file:
+            file.write("mypy\n")
+
+        self.assertNotEqual(pipeline.requirements_hash(), before)
+
+    def test_invalid_needs(self):
+        with self.assertRaises(ValueError):
+            self.pipeline({"unit": {"needs": ["lint"]}})
+
+        with self.assertRaises(ValueError):
+            self.pipeline({"a": {"needs": ["b"]}, "b": {"needs": ["a"]}})
+
+    def test_independent_stages_run_concurrently(self):
+        pipeline = self.pipeline(
+            {
+                "lint": {"command": "lint"},
+                "unit": {"command": "unit"},
+                "integration": {"command": "integration", "needs": ["unit"]},
+            }
+        )
+
+        # lint and unit both wait for the other one to start
+        barrier = threading.Barrier(2, timeout=5)
+
+        def execute(runner) -> int:
+            command = runner.config["command"]
+
+            if command in ("lint", "unit"):
+                barrier.wait()
+
+            return 0
+
+        results = pipeline.run(execute)
+
+        self.assertEqual(
+            {stage: result["status"] for stage, result in results.items()},
+            {"lint": "passed", "unit": "passed", "integration": "passed"},
+        )
+
+    def test_downstream_stages_are_skipped(self):
+        pipeline = self.pipeline(
+            {
+                "lint": {"command": "lint"},
+                "unit": {"command": "unit"},
+                "integration": {"command": "integration", "needs": ["unit"]},
+                "deploy": {"command": "deploy", "needs": ["integration", "lint"]},
+            }
+        )
+
+        executed = []
+
+        def execute(runner) -> int:
+            executed.append(runner.config["command"])
+            return 1 if runner.config["command"] == "unit" else 0
+
+        results = pipeline.run(execute)
+
+        self.assertEqual(results["lint"]["status"], "passed")
+        self.assertEqual(results["unit"]["status"], "failed")
+        self.assertEqual(results["integration"]["status"], "skipped")
+        self.assertEqual(results["deploy"]["status"], "skipped")
+        self.assertEqual(sorted(executed), ["lint", "unit"])
+
+    def test_stage_reports_are_separated(self):
+        pipeline = self.pipeline(
+            {"unit": {"tests": "tests/unit"}, "integration": {"tests": "tests/it"}}
+        )
+
+        self.assertNotEqual(
+            pipeline.runners["unit"].report_path,
+            pipeline.runners["integration"].report_path,
+        )
+        self.assertTrue(
+            pipeline.runners["unit"].report_path.startswith(
+                os.path.join(self.project_folder, ".ci-reports", "unit")
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
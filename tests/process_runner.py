@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append("../")
+
+from workers.enums import ExitCodes
+from workers.process_runner import ProcessRunner
+
+
+class TestProcessRunner(unittest.TestCase):
+    def test_output_is_streamed(self):
+        chunks = []
+
+        return_code = ProcessRunner.call(
+            ["bash", "-c", "echo out; echo err >&2; exit 3"], on_output=chunks.append
+        )
+
+        self.assertEqual(return_code, 3)
+        self.assertEqual(b"".join(chunks).split(), [b"out", b"err"])
+
+    def test_timeout_stops_the_process_group(self):
+        folder = tempfile.mkdtemp()
+        marker = os.path.join(folder, "marker")
+
+        # The child of bash would write the marker after the timeout
+        start = time.monotonic()
+        return_code = ProcessRunner.call(
+            ["bash", "-c", f"(sleep 1 && touch {marker}) & wait"],
+            timeout=0.2,
+            on_output=lambda chunk: None,
+        )
+
+        self.assertEqual(return_code, ExitCodes.TIMEOUT.value)
+        self.assertLess(time.monotonic() - start, 1)
+
+        time.sleep(1.2)
+        self.assertFalse(os.path.exists(marker))
+        os.rmdir(folder)
+
+    def test_commands_run_concurrently(self):
+        start = time.monotonic()
+
+        futures = [
+            ProcessRunner.submit(ProcessRunner.run(["sleep", "0.5"])) for _ in range(50)
+        ]
+
+        self.assertEqual([future.result(timeout=10) for future in futures], [0] * 50)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_cancel_on_event(self):
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+
+        start = time.monotonic()
+        with ProcessRunner.cancel_on(cancel):
+            return_code = ProcessRunner.call(["sleep", "10"])
+
+            self.assertTrue(ProcessRunner.cancelled())
+            # Once cancelled, the next commands do not start
+            self.assertEqual(ProcessRunner.call(["true"]), ExitCodes.CANCELLED.value)
+
+            with ProcessRunner.cancel_on(None):
+                self.assertEqual(ProcessRunner.call(["true"]), 0)
+
+        self.assertEqual(return_code, ExitCodes.CANCELLED.value)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertFalse(ProcessRunner.cancelled())
+
+    def test_missing_program(self):
+        self.assertEqual(ProcessRunner.call(["does-not-exist-ci"]), 127)
+
+    def test_run_in_background(self):
+        future = ProcessRunner.run_in_background(sum, [1, 2, 3])
+
+        self.assertEqual(future.result(timeout=10), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append("../")
+
+from workers.database import DBWorker
+from workers.project_jobs import ProjectJobs
+from workers.project_manager import ProjectManager
+
+
+class TestProjectJobs(unittest.TestCase):
+    def setUp(self):
+        self.db_worker = DBWorker("tests.sqlite3")
+
+        # A local repository stands for the github project
+        self.folder = tempfile.mkdtemp()
+        self.name = f"test-project-jobs-{os.getpid()}"
+        self.url = os.path.join(self.folder, self.name)
+
+        os.makedirs(self.url)
+        subprocess.check_call(["git", "init", "--quiet"], cwd=self.url)
+        subprocess.check_call(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@localhost",
+             "commit", "--quiet", "--allow-empty", "-m", "first"],
+            cwd=self.url,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        shutil.rmtree(os.path.join(ProjectManager.parent_dir, "projects", self.name), True)
+        self.db_worker.delete_project_by_name(self.name)
+
+    def wait(self, job_id: int) -> dict:
+        for _ in range(100):
+            job = self.db_worker.get_project_jobs(job_id, 1)[0]
+
+            if job["status"] in ("done", "failed"):
+                return job
+            time.sleep(0.1)
+
+        self.fail(f"project job {job_id} did not finish")
+
+    def test_add_and_delete_project(self):
+        job_id = ProjectJobs.add_project(self.db_worker, self.name, self.url, "test_app.py", "main")
+
+        job = self.wait(job_id)
+        self.assertEqual((job["kind"], job["status"]), ("add", "done"))
+        self.assertTrue(self.db_worker.project_exists(self.name))
+        self.assertTrue(ProjectManager.project_exists(self.name))
+
+        job_id = ProjectJobs.delete_project(self.db_worker, self.name)
+
+        # Gone right away, the folder is removed in the background
+        self.assertFalse(self.db_worker.project_exists(self.name))
+        self.assertFalse(ProjectManager.project_exists(self.name))
+
+        job = self.wait(job_id)
+        self.assertEqual((job["kind"], job["status"]), ("delete", "done"))
+        self.assertFalse(
+            any(name.startswith(self.name) for name in os.listdir(ProjectManager.trash_dir))
+        )
+
+    def test_failed_clone(self):
+        job_id = ProjectJobs.add_project(
+            self.db_worker, self.name, self.url + "-missing", "test_app.py", "main"
+        )
+
+        job = self.wait(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertFalse(self.db_worker.project_exists(self.name))
+        self.assertFalse(self.db_worker.has_active_project_job(self.name))
+
+    def test_delete_unknown_project(self):
+        self.assertIsNone(ProjectJobs.delete_project(self.db_worker, self.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
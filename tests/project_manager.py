@@ -0,0 +1,89 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+import unittest
+
+sys.path.append("../")
+
+from workers.project_manager import ProjectManager
+
+
+class TestProjectManager(unittest.TestCase):
+    def setUp(self):
+        self.project_name = f"test-workspaces-{os.getpid()}"
+        self.project_folder = os.path.join(
+            ProjectManager.parent_dir, "projects", self.project_name
+        )
+        os.makedirs(self.project_folder)
+
+        self.commits = [self.commit("first"), self.commit("second")]
+
+    def tearDown(self):
+        shutil.rmtree(self.project_folder, ignore_errors=True)
+
+    def git(self, *args) -> str:
+        return subprocess.check_output(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@localhost", *args],
+            cwd=self.project_folder,
+            text=True,
+        ).strip()
+
+    def commit(self, content: str) -> str:
+        if not os.path.isdir(os.path.join(self.project_folder, ".git")):
+            self.git("init", "--quiet")
+
+        with open(os.path.join(self.project_folder, "version.txt"), "w") as file:
+            file.write(content)
+
+        self.git("add", "version.txt")
+        self.git("commit", "--quiet", "-m", content)
+
+        return self.git("rev-parse", "HEAD")
+
+    def test_workspaces_check_out_their_commit(self):
+        first = ProjectManager.create_workspace(self.project_name, self.commits[0])
+        second = ProjectManager.create_workspace(self.project_name)
+
+        try:
+            self.assertNotEqual(first, second)
+
+            with open(os.path.join(first, "version.txt")) as file:
+                self.assertEqual(file.read(), "first")
+            with open(os.path.join(second, "version.txt")) as file:
+                self.assertEqual(file.read(), "second")
+
+            # A dirty workspace does not leak in the project clone
+            with open(os.path.join(first, "version.txt"), "w") as file:
+                file.write("dirty")
+            self.assertEqual(self.git("status", "--porcelain"), "")
+        finally:
+            self.assertTrue(ProjectManager.remove_workspace(self.project_name, first))
+            self.assertTrue(ProjectManager.remove_workspace(self.project_name, second))
+
+        self.assertEqual(len(self.git("worktree", "list").splitlines()), 1)
+
+    def test_unknown_commit(self):
+        self.assertIsNone(ProjectManager.create_workspace(self.project_name, "0" * 40))
+
+    def test_delete_project_folder(self):
+        self.assertTrue(ProjectManager.delete_project_folder(self.project_name))
+
+        # The name is free right away, the folder is removed in the background
+        self.assertFalse(ProjectManager.project_exists(self.project_name))
+        self.assertFalse(ProjectManager.delete_project_folder(self.project_name))
+
+        for _ in range(50):
+            if not any(
+                name.startswith(self.project_name)
+                for name in os.listdir(ProjectManager.trash_dir)
+            ):
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("the deleted project is still in the trash")
+
+
+if __name__ == "__main__":
+    unittest.main()
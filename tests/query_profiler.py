@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.database import DBWorker
+from workers.query_profiler import ProfiledCursor, QueryProfiler
+
+
+class TestQueryProfiler(unittest.TestCase):
+    def setUp(self):
+        QueryProfiler.reset()
+        self.slow_query_ms = QueryProfiler.slow_query_ms
+
+        self.conn = sqlite3.connect(":memory:")
+        self.cursor = self.conn.cursor(ProfiledCursor)
+        self.cursor.execute("CREATE TABLE test_cases (id INTEGER, test_name TEXT)")
+        self.cursor.executemany(
+            "INSERT INTO test_cases VALUES (?, ?)", [(1, "a"), (2, "b"), (3, "c")]
+        )
+
+    def tearDown(self):
+        QueryProfiler.slow_query_ms = self.slow_query_ms
+        QueryProfiler.reset()
+        self.conn.close()
+
+    def get_stats(self, query: str) -> dict:
+        return next(
+            stats for stats in QueryProfiler.top_queries() if stats["query"] == query
+        )
+
+    def test_rows_and_calls_are_recorded(self):
+        query = "SELECT * FROM test_cases WHERE id > ?"
+
+        self.cursor.execute(query, (1,)).fetchall()
+        self.cursor.execute(query, (0,)).fetchall()
+
+        stats = self.get_stats(query)
+
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["rows"], 5)
+        self.assertEqual(stats["method"], "test_rows_and_calls_are_recorded")
+
+        inserts = self.get_stats("INSERT INTO test_cases VALUES (?, ?)")
+        self.assertEqual(inserts["rows"], 3)
+
+    def test_slow_query_plan_is_captured(self):
+        QueryProfiler.slow_query_ms = 0
+
+        query = "SELECT * FROM test_cases WHERE test_name = ?"
+
+        with self.assertLogs("workers.query_profiler", level="WARNING"):
+            self.cursor.execute(query, ("a",)).fetchone()
+
+        stats = self.get_stats(query)
+
+        self.assertEqual(stats["slow_calls"], 1)
+        self.assertTrue(stats["plan"][0].startswith("SCAN"))
+
+    def test_rows_fetched_in_chunks_are_recorded_once(self):
+        query = "SELECT * FROM test_cases WHERE id > ?"
+
+        self.cursor.execute(query, (0,))
+        while self.cursor.fetchmany(2):
+            pass
+
+        # Closed before the last rows were read
+        self.cursor.execute(query, (1,)).fetchmany(1)
+        self.cursor.close()
+
+        stats = self.get_stats(query)
+
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["rows"], 4)
+
+    def test_streamed_queries_of_db_worker_are_recorded(self):
+        with tempfile.TemporaryDirectory() as folder, mock.patch.object(
+            QueryProfiler, "enabled", True
+        ):
+            db_worker = DBWorker(os.path.join(folder, "profiler.sqlite3"))
+
+            for project in ("project a", "project b"):
+                db_worker.insert_project_to_database(project, "test_app.py", "url")
+
+            self.assertEqual(len(list(db_worker.iter_projects())), 2)
+
+            (stats,) = [
+                stats
+                for stats in QueryProfiler.top_queries()
+                if stats["method"] == "iter_projects"
+            ]
+            self.assertEqual(stats["rows"], 2)
+
+            # The queries of a private helper are named after the public method
+            db_worker.lease_build_job("agent", 60)
+
+            methods = {stats["method"] for stats in QueryProfiler.top_queries()}
+            self.assertIn("lease_build_job", methods)
+            self.assertNotIn("__leasable_build_jobs", methods)
+
+            db_worker.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append("../")
+
+from workers.process_runner import ProcessRunner
+from workers.result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.write("requirements.txt", "pytest\n")
+        self.write("test_app.py", "def test_app():\n    assert True\n")
+        self.commit("first")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def git(self, *args) -> str:
+        return subprocess.check_output(
+            ["git", "-c", "user.name=ci", "-c", "user.email=ci@localhost", *args],
+            cwd=self.folder,
+            text=True,
+        ).strip()
+
+    def write(self, name: str, content: str) -> None:
+        with open(os.path.join(self.folder, name), "w") as file:
+            file.write(content)
+
+    def commit(self, message: str) -> None:
+        if not os.path.isdir(os.path.join(self.folder, ".git")):
+            self.git("init", "--quiet")
+
+        self.git("add", "-A")
+        self.git("commit", "--quiet", "--allow-empty", "-m", message)
+
+    def test_same_content_same_key(self):
+        key = ResultCache.key(self.folder, "test_app.py")
+        self.assertIsNotNone(key)
+
+        # A commit with the same tree, like a revert or an empty commit
+        self.commit("empty")
+        self.assertEqual(ResultCache.key(self.folder, "test_app.py"), key)
+
+        self.assertNotEqual(ResultCache.key(self.folder, "other.py"), key)
+        self.assertNotEqual(
+            ResultCache.key(self.folder, "test_app.py", {"python": "3.12", "env": {}}),
+            key,
+        )
+
+        self.write("requirements.txt", "pytest\nrequests\n")
+        self.commit("requirements")
+        self.assertNotEqual(ResultCache.key(self.folder, "test_app.py"), key)
+
+    def test_dirty_workspace_has_no_key(self):
+        self.write("test_app.py", "def test_app():\n    assert False\n")
+
+        self.assertIsNone(ResultCache.key(self.folder, "test_app.py"))
+
+    def test_cancelled_build_has_no_key(self):
+        cancel = threading.Event()
+        cancel.set()
+
+        # The git commands are not run once the build is cancelled
+        with ProcessRunner.cancel_on(cancel):
+            self.assertIsNone(ResultCache.key(self.folder, "test_app.py"))
+
+        self.assertIsNotNone(ResultCache.key(self.folder, "test_app.py"))
+
+
+if __name__ == "__main__":
+    unittest.main()
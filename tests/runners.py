@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+sys.path.append("../")
+
+from workers.runners import (
+    CommandRunner,
+    PytestRunner,
+    TestRunner,
+    ToxRunner,
+    UnittestRunner,
+)
+
+
+class TestRunners(unittest.TestCase):
+    def setUp(self):
+        self.project_folder = tempfile.mkdtemp()
+
+    def write(self, name: str, content: str) -> None:
+        with open(os.path.join(self.project_folder, name), "w") as file:
+            file.write(content)
+
+    def test_default_backend_is_pytest(self):
+        runner = TestRunner.for_project(self.project_folder, "test_app.py")
+
+        self.assertIsInstance(runner, PytestRunner)
+        self.assertEqual(runner.command()[-1], "test_app.py")
+        self.assertEqual(runner.check(), "test file does not exist")
+
+    def test_config_file(self):
+        self.write(
+            ".simple-ci.toml",
+            '[runner]\nbackend = "tox"\nworkers = 3\nenvs = ["py311", "py312"]\n',
+        )
+
+        runner = TestRunner.for_project(self.project_folder, "test_app.py")
+
+        self.assertIsInstance(runner, ToxRunner)
+        self.assertEqual(
+            runner.command(), ["tox", "run-parallel", "-p", "3", "-e", "py311,py312"]
+        )
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            TestRunner.for_project(self.project_folder, None, {"backend": "ant"})
+
+    def test_pytest_workers_and_extras(self):
+        runner = TestRunner.for_project(
+            self.project_folder, "tests", {"workers": 4, "extras": ["test"]}
+        )
+
+        self.assertIn("-n", runner.command())
+        self.assertEqual(
+            runner.pip_arguments(),
+            ["pytest", "pytest-xdist", "-e", f"{self.project_folder}[test]"],
+        )
+
+    def test_command_with_braces(self):
+        command = (
+            "find . -name '*.xml' -exec cat {} \\; | awk '{print $1}' "
+            "${REPORT:-{report}} -n {workers}"
+        )
+        runner = TestRunner.for_project(
+            self.project_folder,
+            None,
+            {"backend": "command", "workers": 2, "command": command},
+        )
+
+        self.assertIsInstance(runner, CommandRunner)
+        self.assertEqual(
+            runner.command()[-1],
+            "find . -name '*.xml' -exec cat {} \\; | awk '{print $1}' "
+            f"${{REPORT:-{runner.report_path}}} -n 2",
+        )
+
+    def test_unittest_backend_writes_report(self):
+        for module in ("test_one", "test_two"):
+            self.write(
+                f"{module}.py",
+                "import unittest\n\n"
+                "class TestCase(unittest.TestCase):\n"
+                "    def test_pass(self):\n        pass\n\n"
+                "    def test_fail(self):\n        self.fail('boom')\n",
+            )
+
+        runner = TestRunner.for_project(
+            self.project_folder, None, {"backend": "unittest", "workers": 2}
+        )
+        self.assertIsInstance(runner, UnittestRunner)
+
+        runner.clear_reports()
+        return_code = subprocess.call(
+            [sys.executable] + runner.command()[1:],
+            cwd=runner.working_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        self.assertEqual(return_code, 1)
+        self.assertEqual(len(runner.report_files()), 1)
+
+        testsuite = ET.parse(runner.report_files()[0]).getroot()[0]
+        self.assertEqual(testsuite.get("tests"), "4")
+        self.assertEqual(testsuite.get("failures"), "2")
+
+
+if __name__ == "__main__":
+    unittest.main()
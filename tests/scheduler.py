@@ -0,0 +1,185 @@
+import datetime
+import os
+import shutil
+import sys
+import unittest
+from unittest import mock
+
+sys.path.append("../")
+
+from workers.database import DBWorker
+from workers.project_manager import ProjectManager
+from workers.scheduler import CronExpression, Scheduler
+
+
+class TestCronExpression(unittest.TestCase):
+    def test_fields(self):
+        cron = CronExpression("*/15 9-17 * * 1-5")
+
+        # Monday 2024-01-01
+        self.assertTrue(cron.matches(datetime.datetime(2024, 1, 1, 9, 0)))
+        self.assertTrue(cron.matches(datetime.datetime(2024, 1, 1, 17, 45)))
+        self.assertFalse(cron.matches(datetime.datetime(2024, 1, 1, 9, 10)))
+        self.assertFalse(cron.matches(datetime.datetime(2024, 1, 1, 18, 0)))
+        # Sunday
+        self.assertFalse(cron.matches(datetime.datetime(2024, 1, 7, 9, 0)))
+
+    def test_lists_and_sunday(self):
+        cron = CronExpression("0,30 2 * * 7")
+
+        self.assertTrue(cron.matches(datetime.datetime(2024, 1, 7, 2, 30)))
+        self.assertFalse(cron.matches(datetime.datetime(2024, 1, 8, 2, 30)))
+        self.assertEqual(CronExpression("0 2 * * 0").weekdays, cron.weekdays)
+
+    def test_day_of_month_or_day_of_week(self):
+        # The 1st of the month and every Friday
+        cron = CronExpression("0 0 1 * 5")
+
+        self.assertTrue(cron.matches(datetime.datetime(2024, 1, 1)))
+        self.assertTrue(cron.matches(datetime.datetime(2024, 1, 5)))
+        self.assertFalse(cron.matches(datetime.datetime(2024, 1, 2)))
+
+    def test_macros(self):
+        self.assertTrue(CronExpression("@daily").matches(datetime.datetime(2024, 3, 9)))
+        self.assertFalse(
+            CronExpression("@monthly").matches(datetime.datetime(2024, 3, 9))
+        )
+        self.assertTrue(
+            CronExpression("@hourly").matches(datetime.datetime(2024, 3, 9, 13))
+        )
+
+    def test_invalid(self):
+        for expression in ("* * * *", "60 * * * *", "* * 0 * *", "5-1 * * * *", "a * * * *", "*/0 * * * *"):
+            with self.subTest(expression=expression):
+                with self.assertRaises(ValueError):
+                    CronExpression(expression)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        # The scheduler and the job queue use the default database
+        patcher = mock.patch.dict(os.environ, {"CI_DATABASE_URL": "tests.sqlite3"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.db_worker = DBWorker()
+        self.name = f"test-scheduler-{os.getpid()}"
+        self.folder = os.path.join(ProjectManager.parent_dir, "projects", self.name)
+        os.makedirs(self.folder)
+
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write(
+                '[[schedules]]\n'
+                'name = "nightly"\n'
+                'cron = "0 2 * * *"\n'
+                'stages = ["unit"]\n'
+                '\n'
+                '[[schedules]]\n'
+                'name = "weekly"\n'
+                'cron = "@weekly"\n'
+                'branch = "develop"\n'
+            )
+
+        self.db_worker.insert_project_to_database(
+            self.name, "test_app.py", f"https://github.com/ci/{self.name}", "main"
+        )
+        self.project_id = self.db_worker.get_project(self.name)[0]
+
+    def tearDown(self):
+        # Other tests expect an empty queue
+        while (job := self.db_worker.lease_build_job("test-scheduler", 60)) is not None:
+            self.db_worker.finish_build_job(job["id"], "done", "")
+
+        self.db_worker.delete_project_by_name(self.name)
+        shutil.rmtree(self.folder)
+
+    def timestamp(self, *args) -> float:
+        return datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()
+
+    def test_schedules(self):
+        schedules = Scheduler.schedules(
+            {"schedules": [{"name": "idle", "idle_hours": 6, "timezone": "Europe/Paris"}]}
+        )
+
+        self.assertEqual(len(schedules), 1)
+        self.assertIsNone(schedules[0]["cron"])
+        self.assertEqual(str(schedules[0]["timezone"]), "Europe/Paris")
+
+        for schedule in (
+            {"cron": "@daily"},
+            {"name": "nothing"},
+            {"name": "idle", "idle_hours": 0},
+            {"name": "nightly", "cron": "@daily", "stages": []},
+            {"name": "nightly", "cron": "@daily", "timezone": "Nowhere/Town"},
+            {"name": "nightly", "cron": "0 25 * * *"},
+        ):
+            with self.subTest(schedule=schedule):
+                with self.assertRaises(ValueError):
+                    Scheduler.schedules({"schedules": [schedule]})
+
+    def test_is_due(self):
+        idle = Scheduler.schedules({"schedules": [{"name": "idle", "idle_hours": 2}]})[0]
+        now = self.timestamp(2024, 1, 1, 12, 0)
+
+        self.assertTrue(Scheduler.is_due(idle, now, None))
+        self.assertTrue(Scheduler.is_due(idle, now, now - 2 * 3600))
+        self.assertFalse(Scheduler.is_due(idle, now, now - 3600))
+
+        # At 2:00 in Paris, when idle
+        both = Scheduler.schedules(
+            {
+                "schedules": [
+                    {
+                        "name": "nightly",
+                        "cron": "0 2 * * *",
+                        "idle_hours": 2,
+                        "timezone": "Europe/Paris",
+                    }
+                ]
+            }
+        )[0]
+        now = self.timestamp(2024, 1, 1, 1, 0)
+
+        self.assertTrue(Scheduler.is_due(both, now, None))
+        self.assertFalse(Scheduler.is_due(both, now, now - 3600))
+        self.assertFalse(Scheduler.is_due(both, now + 3600, None))
+
+    def test_tick(self):
+        # Monday 2024-01-01 at 2:00:30
+        now = self.timestamp(2024, 1, 1, 2, 0, 30)
+
+        job_ids = Scheduler.tick(now)
+        self.assertEqual(len(job_ids), 1)
+
+        job = self.db_worker.get_build_job(job_ids[0])
+        self.assertEqual(job["project_id"], self.project_id)
+        self.assertEqual(job["trigger"], "schedule:nightly")
+        self.assertEqual(job["branch"], "main")
+        self.assertEqual(job["stages"], ["unit"])
+
+        # Still queued
+        self.assertEqual(Scheduler.tick(now), [])
+
+        # Finished, but this run is already claimed
+        while (job := self.db_worker.lease_build_job("test-scheduler", 60)) is not None:
+            self.db_worker.finish_build_job(job["id"], "done", "")
+        self.assertEqual(Scheduler.tick(now + 10), [])
+
+        # Sunday at midnight
+        job_ids = Scheduler.tick(self.timestamp(2024, 1, 7))
+        self.assertEqual(len(job_ids), 1)
+
+        job = self.db_worker.get_build_job(job_ids[0])
+        self.assertEqual(job["trigger"], "schedule:weekly")
+        self.assertEqual(job["branch"], "develop")
+        self.assertIsNone(job["stages"])
+
+    def test_invalid_schedules_are_skipped(self):
+        with open(os.path.join(self.folder, ".simple-ci.toml"), "w") as file:
+            file.write('[[schedules]]\nname = "nightly"\ncron = "0 2 * *"\n')
+
+        self.assertEqual(Scheduler.tick(self.timestamp(2024, 1, 1, 2, 0)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,14 @@
+import os
+import subprocess
+import tempfile
 import unittest
 import sys
+import xml.etree.ElementTree as ET
 
 sys.path.append("../")
 
+from workers.enums import ExitCodes
+from workers.file_lock import FileLock
 from workers.tester import Tester
 
 
@@ -10,6 +16,89 @@ class TestTesterWorker(unittest.TestCase):
     def setUp(self):
         pass
 
+    def test_parse_junitxml_sums_testsuites(self):
+        root = ET.fromstring(
+            """<testsuites>
+                <testsuite errors="0" failures="1" skipped="0" tests="2" time="1.5" timestamp="2024-06-01T10:00:00">
+                    <testcase name="test_a" time="1.0" />
+                    <testcase name="test_b" time="0.5"><failure message="boom" /></testcase>
+                </testsuite>
+                <testsuite errors="1" failures="0" skipped="1" tests="2" time="0.5" timestamp="2024-06-01T10:00:01">
+                    <testcase name="test_c" time="0.5"><error message="boom" /></testcase>
+                    <testcase name="test_d" time="0.0"><skipped /></testcase>
+                </testsuite>
+            </testsuites>"""
+        )
+
+        test_result, testcases = Tester.parse_junitxml(root)
+
+        self.assertEqual(test_result["tests"], "4")
+        self.assertEqual(test_result["failures"], "1")
+        self.assertEqual(test_result["errors"], "1")
+        self.assertEqual(test_result["time"], "2.0")
+        self.assertEqual(test_result["timestamp"], "2024-06-01T10:00:00")
+        self.assertEqual(
+            [(name, outcome) for name, _, outcome in testcases],
+            [
+                ("test_a", "passed"),
+                ("test_b", "failed"),
+                ("test_c", "error"),
+                ("test_d", "skipped"),
+            ],
+        )
+
+    def test_parse_junitxml_single_testsuite(self):
+        root = ET.fromstring(
+            '<testsuite tests="1" failures="0"><testcase name="test_a" time="0.1" /></testsuite>'
+        )
+
+        test_result, testcases = Tester.parse_junitxml(root)
+
+        self.assertEqual(test_result["tests"], "1")
+        self.assertEqual(list(testcases), [("test_a", "0.1", "passed")])
+
+    def test_install_needs_something_to_install(self):
+        script = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "bash_scripts",
+            "install_dependencies.sh",
+        )
+
+        # No requirements file, no runner package and no extras
+        result = subprocess.run(["bash", script, "project", ".venv"], capture_output=True)
+        self.assertEqual(result.returncode, ExitCodes.MISSING_REQUIREMENTS.value)
+
+    def test_remove_old_venvs_of_the_cell(self):
+        with tempfile.TemporaryDirectory() as project_folder:
+            venvs = [
+                ".venv-py3.12-000000000000",
+                ".venv-py3.12-111111111111",
+                ".venv-py3.12-none",
+                ".venv-py3.12-222222222222",
+                ".venv-py3.12-1f2e3d4c-000000000000",
+                ".venv-000000000000",
+            ]
+            for venv in venvs:
+                os.mkdir(os.path.join(project_folder, venv))
+
+            # A build still runs its tests in this one
+            in_use = os.path.join(project_folder, ".venv-py3.12-222222222222.use")
+
+            with FileLock(in_use, shared=True):
+                Tester.remove_old_venvs(
+                    project_folder, ".venv-py3.12", ".venv-py3.12-111111111111"
+                )
+
+            self.assertEqual(
+                sorted(name for name in os.listdir(project_folder) if name in venvs),
+                [
+                    ".venv-000000000000",
+                    ".venv-py3.12-111111111111",
+                    ".venv-py3.12-1f2e3d4c-000000000000",
+                    ".venv-py3.12-222222222222",
+                ],
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
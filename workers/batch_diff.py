@@ -0,0 +1,189 @@
+import json
+import os
+import zlib
+
+from dotenv import load_dotenv
+
+from workers.database import DBWorker
+from workers.matrix import BuildMatrix
+
+
+class BatchDiff:
+    """
+    Changes of the test cases of a batch since the previous batch of its
+    project which ran the same matrix cell and pipeline stages (its
+    variant), computed once when the batch is ingested:
+
+        new_failures    tests failed or in error, which were not failing before
+        fixed           tests failing before, passed (or flaky) now
+        added           tests which were not in the previous batch
+        removed         tests of the previous batch which did not run
+        slower, faster  (name, before, after) durations of the tests whose
+                        duration changed by more than min_delta seconds and
+                        min_ratio times, the max_duration_changes greatest
+
+    A test added by the batch and failing is both added and a new failure.
+
+    The lists are stored as zlib compressed json, the counts beside them so
+    the batch list shows them without reading the lists.
+
+    """
+
+    load_dotenv()
+
+    # A duration change smaller than this is noise
+    min_delta = float(os.getenv("CI_DIFF_MIN_DELTA", 0.1))
+    min_ratio = float(os.getenv("CI_DIFF_MIN_RATIO", 1.25))
+
+    # Duration changes kept of each kind, the greatest first
+    max_duration_changes = 50
+
+    kinds = ("new_failures", "fixed", "added", "removed", "slower", "faster")
+
+    __failing = ("failed", "error")
+    __passing = ("passed", "flaky")
+
+    @classmethod
+    def __duration(cls, duration) -> float:
+        try:
+            return float(duration)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def variant(cls, cell: dict = None, stages: list[str] = None) -> str:
+        """
+        What a batch ran: the cells of a matrix build are ingested in the
+        order they finish, and a scheduled run of some stages runs fewer
+        tests, each is only compared with the batches of the same variant.
+
+        Params:
+            cell: the matrix cell built, see matrix.py
+            stages: the pipeline stages run, all of them if None
+
+        Returns:
+            The variant, None for a build of every stage without matrix,
+            like the batches saved before variants
+
+        """
+        if cell is None and stages is None:
+            return None
+
+        return json.dumps(
+            {
+                "matrix": BuildMatrix.name(cell),
+                "stages": None if stages is None else sorted(stages),
+            },
+            sort_keys=True,
+        )
+
+    @classmethod
+    def compute(cls, previous: dict[str, tuple], testcases: list[tuple]) -> dict:
+        """
+        Compare the test cases of a batch with those of the previous batch.
+
+        Params:
+            previous: the (duration, outcome) of each test of the previous batch
+            testcases: (test name, duration, outcome) tuples of the batch
+
+        Returns:
+            A dict of the name lists of each kind, and "duration_delta", the
+            change of the total duration of the tests in both batches
+
+        """
+        diff = {kind: [] for kind in cls.kinds}
+        duration_delta = 0.0
+        seen = set()
+
+        for test_name, duration, *outcome in testcases:
+            outcome = outcome[0] if outcome else None
+            seen.add(test_name)
+
+            if test_name not in previous:
+                diff["added"].append(test_name)
+
+                if outcome in cls.__failing:
+                    diff["new_failures"].append(test_name)
+                continue
+
+            previous_duration, previous_outcome = previous[test_name]
+
+            if outcome in cls.__failing and previous_outcome not in cls.__failing:
+                diff["new_failures"].append(test_name)
+            elif outcome in cls.__passing and previous_outcome in cls.__failing:
+                diff["fixed"].append(test_name)
+
+            before, after = cls.__duration(previous_duration), cls.__duration(duration)
+
+            if before is None or after is None:
+                continue
+
+            duration_delta += after - before
+
+            if abs(after - before) < cls.min_delta:
+                continue
+
+            if after > before * cls.min_ratio:
+                diff["slower"].append((test_name, before, after))
+            elif before > after * cls.min_ratio:
+                diff["faster"].append((test_name, before, after))
+
+        diff["removed"] = [test_name for test_name in previous if test_name not in seen]
+
+        for kind in ("slower", "faster"):
+            diff[kind] = sorted(
+                diff[kind], key=lambda change: abs(change[2] - change[1]), reverse=True
+            )[: cls.max_duration_changes]
+
+        diff["duration_delta"] = round(duration_delta, 6)
+
+        return diff
+
+    @classmethod
+    def counts(cls, diff: dict) -> dict[str, int]:
+        """
+        Number of tests of each kind of a diff.
+
+        """
+        return {kind: len(diff[kind]) for kind in cls.kinds}
+
+    @classmethod
+    def encode(cls, diff: dict) -> bytes:
+        return zlib.compress(json.dumps(diff, separators=(",", ":")).encode(), 6)
+
+    @classmethod
+    def load(cls, db_worker: DBWorker, test_batch_id: int) -> dict:
+        """
+        Get the diff of a batch.
+
+        Returns:
+            A dict with the batch_id, the base_batch_id, the count of each
+            kind, the duration_delta and the lists of tests, slower and
+            faster as {"name", "before", "after"} dicts, or None if the batch
+            has no diff (first batch of its project, or cached results)
+
+        """
+        if (diff := db_worker.get_batch_diff(test_batch_id)) is None:
+            return None
+
+        data = diff.pop("data")
+        counts = {kind: diff.pop(kind) for kind in cls.kinds}
+
+        return {
+            "batch_id": test_batch_id,
+            **diff,
+            "counts": counts,
+            **cls.decode(data),
+        }
+
+    @classmethod
+    def decode(cls, data: bytes) -> dict:
+        diff = json.loads(zlib.decompress(data))
+
+        for kind in ("slower", "faster"):
+            diff[kind] = [
+                {"name": name, "before": before, "after": after}
+                for name, before, after in diff[kind]
+            ]
+
+        return diff
@@ -0,0 +1,384 @@
+import contextvars
+import json
+import logging
+import threading
+import urllib.error
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from workers.database import DBWorker
+from workers.enums import BuildStage
+from workers.host_resources import HostResources
+from workers.job_queue import JobQueue
+from workers.log_pipeline import LogPipeline
+from workers.process_runner import ProcessRunner
+from workers.project_manager import ProjectManager
+from workers.result_cache import ResultCache
+from workers.stage_timer import StageTimer
+from workers.tester import Tester
+
+
+logger = logging.getLogger(__name__)
+
+
+class BuildAgent:
+    """
+    Lease build jobs from the queue and run them, one at a time.
+
+    While a job runs, a background thread sends heartbeats to keep the lease.
+    Subclasses define how jobs are leased and how builds are reported.
+
+    No job is leased while the host is short of CPU, memory or disk, see
+    HostResources. The agents of a process share the host: when none of
+    them runs a build, a job is leased whatever the peak memory of its
+    project, it could not run with more memory anyway.
+
+    """
+
+    # Project name -> lock, cells of a matrix build fetch the same checkout
+    __fetch_locks: dict[str, threading.Lock] = {}
+    __fetch_locks_lock = threading.Lock()
+
+    # Builds running in the agents of this process
+    __running_builds = 0
+    __running_builds_lock = threading.Lock()
+
+    def __init__(self, name: str, poll_interval: float = 5):
+        self.name = name
+        self.poll_interval = poll_interval
+        self.__stop = threading.Event()
+
+    @classmethod
+    def fetch_lock(cls, project_name: str) -> threading.Lock:
+        """
+        Lock held while fetching a project, shared by the agents of the process.
+
+        """
+        with cls.__fetch_locks_lock:
+            return cls.__fetch_locks.setdefault(project_name, threading.Lock())
+
+    def lease(self, memory_budget: int = None) -> dict:
+        """
+        Lease the next job whose project fits in memory_budget (bytes, None
+        for no limit), returns None if the queue is empty.
+
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, job: dict) -> bool:
+        """
+        Extend the lease of a job, returns False if the lease was lost.
+
+        """
+        raise NotImplementedError
+
+    def build(self, job: dict, lease_lost: threading.Event) -> None:
+        """
+        Run the build of a job and report its result.
+
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def workspace(self, job: dict, timer: StageTimer) -> Iterator[str]:
+        """
+        Check out the commit of a job in its own workspace, for the duration of a block.
+
+        Yields the path of the workspace, or None if it could not be created.
+        The workspace is removed once the block is done.
+
+        """
+        project_name = job["project_name"]
+
+        with timer.stage(BuildStage.FETCH), self.fetch_lock(project_name):
+            workspace = ProjectManager.create_workspace(project_name, job["commit_sha"])
+
+        try:
+            yield workspace
+        finally:
+            # A cancelled build still removes its workspace
+            if workspace is not None:
+                with self.fetch_lock(project_name), ProcessRunner.cancel_on(None):
+                    ProjectManager.remove_workspace(project_name, workspace)
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def run_forever(self) -> None:
+        """
+        Poll the queue and run the leased jobs until the agent is stopped.
+
+        """
+        logger.info(f"build agent started: {self.name}")
+        host_full = None
+
+        while not self.__stop.is_set():
+            memory_budget, reason = HostResources.memory_budget()
+
+            if reason is not None:
+                # Logged once, the host stays full for a while
+                if host_full is None:
+                    logger.warning(f"host full, no job leased: {reason}")
+                host_full = reason
+                self.__stop.wait(self.poll_interval)
+                continue
+
+            if host_full is not None:
+                logger.info("host has room again, leasing jobs")
+                host_full = None
+
+            with self.__running_builds_lock:
+                if self.__running_builds == 0:
+                    memory_budget = None
+
+            try:
+                job = self.lease(memory_budget)
+            except (urllib.error.URLError, OSError) as error:
+                logger.error(f"could not lease a job: {error}")
+                job = None
+            except Exception:
+                # The agent keeps polling, the database may only be busy
+                logger.exception("could not lease a job")
+                job = None
+
+            if job is None:
+                self.__stop.wait(self.poll_interval)
+                continue
+
+            HostResources.reserve(job.get("peak_memory"))
+            self.__count_running_build(1)
+
+            try:
+                with LogPipeline.context(project=job["project_name"], build=job["id"]):
+                    self.__run_job(job)
+            finally:
+                self.__count_running_build(-1)
+
+    @classmethod
+    def __count_running_build(cls, increment: int) -> None:
+        with cls.__running_builds_lock:
+            cls.__running_builds += increment
+
+    def __run_job(self, job: dict) -> None:
+        logger.info(f"job {job['id']} leased: {job['project_name']}")
+
+        lease_lost = threading.Event()
+        build_done = threading.Event()
+
+        # The heartbeat thread logs with the same project and build ids
+        heartbeat_thread = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self.__send_heartbeats, job, build_done, lease_lost),
+            daemon=True,
+        )
+        heartbeat_thread.start()
+
+        try:
+            # A lost lease stops the commands of the build
+            with ProcessRunner.cancel_on(lease_lost):
+                self.build(job, lease_lost)
+        except Exception:
+            logger.exception(f"job {job['id']} crashed")
+        finally:
+            build_done.set()
+            heartbeat_thread.join()
+
+    def __send_heartbeats(
+        self, job: dict, build_done: threading.Event, lease_lost: threading.Event
+    ) -> None:
+        # Three heartbeats per lease, so one lost request does not expire it
+        interval = JobQueue.lease_seconds / 3
+
+        while not build_done.wait(interval):
+            try:
+                if not self.heartbeat(job):
+                    logger.error(f"lease lost for job {job['id']}")
+                    lease_lost.set()
+                    return
+            except (urllib.error.URLError, OSError) as error:
+                logger.error(f"heartbeat failed for job {job['id']}: {error}")
+
+
+class LocalBuildAgent(BuildAgent):
+    """
+    Build agent running inside the CI server process.
+
+    Leases jobs directly from the database and ingests the results itself.
+
+    """
+
+    def lease(self, memory_budget: int = None) -> dict:
+        return JobQueue.lease(self.name, memory_budget)
+
+    def heartbeat(self, job: dict) -> bool:
+        return JobQueue.heartbeat(job["id"], self.name)
+
+    def build(self, job: dict, lease_lost: threading.Event) -> None:
+        timer = StageTimer()
+        timer.record(BuildStage.QUEUE_WAIT, job["leased_at"] - job["created_at"])
+
+        # The server checkout is kept up to date, matrix configs are read there
+        with timer.stage(BuildStage.FETCH), self.fetch_lock(job["project_name"]):
+            ProjectManager.pull_latest_changes(job["project_name"])
+
+        with self.workspace(job, timer) as workspace:
+            if workspace is None:
+                result = {"status": "error", "message": "could not check out the commit"}
+            else:
+                with ProcessRunner.measure_memory() as memory:
+                    result = Tester.perform_tests(
+                        job["project_name"], timer, job["matrix"], workspace, job["stages"]
+                    )
+
+                if memory.peak:
+                    DBWorker().record_project_peak_memory(job["project_id"], memory.peak)
+
+        # The job was preempted or given to another agent, it is not ours to complete
+        if lease_lost.is_set():
+            return
+
+        JobQueue.complete(
+            job["id"],
+            result["status"] == "success",
+            result["message"],
+            result.get("batch_id"),
+            self.name,
+        )
+
+
+class RemoteBuildAgent(BuildAgent):
+    """
+    Build agent running on another host.
+
+    Leases jobs from the CI server over HTTP, runs the clone / test pipeline
+    in its own projects/ folder and uploads the junitxml report to the server.
+
+    """
+
+    def __init__(
+        self, name: str, server_url: str, token: str, poll_interval: float = 5
+    ):
+        super().__init__(name, poll_interval)
+        self.server_url = server_url.rstrip("/")
+        self.token = token
+
+    def __request(self, path: str, payload: dict = None) -> dict:
+        """
+        POST a json payload to the CI server and return the json response.
+
+        """
+        # Only remote agents talk HTTP, the server does not import it
+        import urllib.request
+
+        request = urllib.request.Request(
+            self.server_url + path,
+            data=json.dumps(payload or {}).encode(),
+            headers={"Content-Type": "application/json", "X-Agent-Token": self.token},
+            method="POST",
+        )
+
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+
+    def lease(self, memory_budget: int = None) -> dict:
+        return self.__request(
+            "/agent/lease", {"agent": self.name, "memory_budget": memory_budget}
+        ).get("job")
+
+    def heartbeat(self, job: dict) -> bool:
+        response = self.__request(f"/agent/heartbeat/{job['id']}", {"agent": self.name})
+
+        return response["status"] == "success"
+
+    def build(self, job: dict, lease_lost: threading.Event) -> None:
+        project_name = job["project_name"]
+
+        # Queue wait is measured by the server, we time the stages run here
+        timer = StageTimer()
+
+        with timer.stage(BuildStage.FETCH), self.fetch_lock(project_name):
+            if ProjectManager.project_exists(project_name):
+                fetched = ProjectManager.pull_latest_changes(project_name)
+            else:
+                fetched = ProjectManager.clone_project(job["github_url"])
+
+        result = {
+            "agent": self.name,
+            "success": False,
+            "junitxml": None,
+            "timings": timer.timings,
+            "pipeline": {},
+        }
+
+        if not fetched:
+            result["message"] = "could not fetch the project"
+        else:
+            with self.workspace(job, timer) as workspace:
+                if workspace is None:
+                    result["message"] = "could not check out the commit"
+                elif self.__reuse_results(job, workspace, timer, result):
+                    # The server completed the job with the cached results
+                    return
+                else:
+                    self.__run_tests(job, workspace, timer, result)
+
+        # The job was given to another agent, our results are outdated
+        if lease_lost.is_set():
+            return
+
+        response = self.__request(f"/agent/result/{job['id']}", result)
+        logger.info(f"job {job['id']} reported: {response['message']}")
+
+    def __reuse_results(
+        self, job: dict, workspace: str, timer: StageTimer, result: dict
+    ) -> bool:
+        """
+        Ask the server whether the content of the workspace was already tested.
+
+        Returns True if the server reused the cached results for the job.
+
+        """
+        cache_key = ResultCache.key(
+            workspace, job["test_file"], job["matrix"], job.get("stages")
+        )
+
+        # The key is sent with the results even when the cache is disabled
+        result["cache_key"] = cache_key
+
+        if cache_key is None or not ResultCache.enabled:
+            return False
+
+        response = self.__request(
+            f"/agent/cache/{job['id']}",
+            {"agent": self.name, "cache_key": cache_key, "timings": timer.timings},
+        )
+
+        if response.get("hit"):
+            logger.info(f"job {job['id']} reused results: {response['message']}")
+            return True
+
+        return False
+
+    def __run_tests(
+        self, job: dict, workspace: str, timer: StageTimer, result: dict
+    ) -> None:
+        with ProcessRunner.measure_memory() as memory:
+            success, message = Tester.run_test_script(
+                job["project_name"],
+                job["test_file"],
+                timer,
+                result["pipeline"],
+                job["matrix"],
+                workspace,
+                job.get("quarantine"),
+                job.get("stages"),
+            )
+        result["message"] = message
+        result["peak_memory"] = memory.peak
+
+        if success:
+            result["junitxml"] = Tester.read_junitxml_report(
+                job["project_name"], job["matrix"], workspace, job.get("stages")
+            )
+            result["success"] = True
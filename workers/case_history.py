@@ -0,0 +1,275 @@
+import math
+
+from array import array
+from typing import Iterable
+
+from workers.database import DBWorker
+
+
+class CaseHistory:
+    """
+    Test case history of a project loaded in columns, for analytics over
+    many batches (durations, failure rates).
+
+    Each case is a row of 4 typed arrays, 21 bytes per case instead of a
+    tuple and a str per case:
+
+        name_ids        index of the test name in names, interned once
+        batch_ids       id of the batch of the case
+        durations       duration in seconds, NaN when unknown
+        outcome_codes   index of the outcome in OUTCOMES, 255 when unknown
+
+    The statistics use NumPy when it is installed, the arrays are then
+    viewed without a copy and each statistic is computed for every test at
+    once. Without NumPy the same statistics are computed in pure Python.
+
+    """
+
+    OUTCOMES = ("passed", "failed", "error", "skipped", "flaky")
+    UNKNOWN_OUTCOME = 255
+
+    # Outcomes counted as failures in the failure rate
+    FAILED_OUTCOMES = ("failed", "error")
+
+    def __init__(self, use_numpy: bool = True):
+        """
+        Params:
+            use_numpy: compute the statistics with NumPy if it is installed
+
+        """
+        self.names: list[str] = []
+        self.name_ids = array("I")
+        self.batch_ids = array("q")
+        self.durations = array("d")
+        self.outcome_codes = array("B")
+
+        self.__name_index: dict[str, int] = {}
+        self.__outcome_index = {outcome: code for code, outcome in enumerate(self.OUTCOMES)}
+        self.__numpy = self.__import_numpy() if use_numpy else None
+
+    @staticmethod
+    def __import_numpy():
+        # NumPy is optional, and slow to import: only when analytics are asked
+        try:
+            import numpy
+        except ImportError:
+            return None
+
+        return numpy
+
+    @property
+    def vectorized(self) -> bool:
+        return self.__numpy is not None
+
+    @classmethod
+    def load(
+        cls, db_worker: DBWorker, project_id: int, last_batches: int = None, **kwargs
+    ) -> "CaseHistory":
+        """
+        Load the test cases of a project from the database.
+
+        Params:
+            db_worker: the database to read
+            project_id: the id of the project
+            last_batches: only the cases of the last batches, all of them if None
+
+        """
+        history = cls(**kwargs)
+
+        for rows in db_worker.iter_test_case_history(project_id, last_batches):
+            history.extend(rows)
+
+        return history
+
+    def extend(self, rows: Iterable[tuple]) -> None:
+        """
+        Append cases to the history.
+
+        Params:
+            rows: (test_batch_id, test_name, duration, outcome) tuples
+
+        """
+        names, name_index = self.names, self.__name_index
+        outcome_index, unknown = self.__outcome_index, self.UNKNOWN_OUTCOME
+        nan = math.nan
+
+        columns = list(zip(*rows))
+        if not columns:
+            return
+
+        batch_ids, test_names, durations, outcomes = columns
+
+        for name in test_names:
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+
+        self.batch_ids.extend(batch_ids)
+        self.name_ids.extend(name_index[name] for name in test_names)
+        self.durations.extend(nan if duration is None else duration for duration in durations)
+        self.outcome_codes.extend(outcome_index.get(outcome, unknown) for outcome in outcomes)
+
+    def __len__(self) -> int:
+        return len(self.name_ids)
+
+    def test_stats(self, percentiles: tuple[float] = (50, 90, 99)) -> list[dict]:
+        """
+        Statistics of each test of the history.
+
+        Params:
+            percentiles: the percentiles of the durations, between 0 and 100
+
+        Returns:
+            A dict per test, by name: its "name", number of "runs", count of
+            each outcome, "failure_rate", "mean" duration and "p<N>"
+            durations, interpolated linearly like numpy.percentile. The
+            durations are None when no run of the test was timed.
+
+        Raises:
+            ValueError: if a percentile is not between 0 and 100
+
+        """
+        for percentile in percentiles:
+            if not 0 <= percentile <= 100:
+                raise ValueError(f"percentile {percentile} is not between 0 and 100")
+
+        if self.__numpy is not None:
+            columns = self.__numpy_stats(percentiles)
+        else:
+            columns = self.__python_stats(percentiles)
+
+        stats = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+        return sorted(stats, key=lambda test: test["name"])
+
+    def __percentile_key(self, percentile: float) -> str:
+        return f"p{percentile:g}"
+
+    def __numpy_stats(self, percentiles: tuple[float]) -> dict[str, list]:
+        np = self.__numpy
+        tests = len(self.names)
+
+        name_ids = np.frombuffer(self.name_ids, dtype=np.uint32).astype(np.intp)
+        durations = np.frombuffer(self.durations, dtype=np.float64)
+        outcome_codes = np.frombuffer(self.outcome_codes, dtype=np.uint8)
+
+        # One column per outcome, and a last one for the unknown outcomes
+        codes = np.minimum(outcome_codes, len(self.OUTCOMES)).astype(np.intp)
+        outcome_counts = np.bincount(
+            name_ids * (len(self.OUTCOMES) + 1) + codes,
+            minlength=tests * (len(self.OUTCOMES) + 1),
+        ).reshape(tests, len(self.OUTCOMES) + 1)
+
+        runs = outcome_counts.sum(axis=1)
+        failures = outcome_counts[
+            :, [self.OUTCOMES.index(outcome) for outcome in self.FAILED_OUTCOMES]
+        ].sum(axis=1)
+
+        # The timed runs, sorted by test then duration: sorted by duration
+        # then stably by test, the narrowest type of test ids is radix sorted
+        timed = ~np.isnan(durations)
+        timed_ids, timed_durations = name_ids[timed], durations[timed]
+
+        order = np.argsort(timed_durations)
+        ids_by_duration = timed_ids[order].astype(np.min_scalar_type(tests))
+        sorted_durations = timed_durations[order][
+            np.argsort(ids_by_duration, kind="stable")
+        ]
+
+        timed_runs = np.bincount(timed_ids, minlength=tests)
+        starts = np.cumsum(timed_runs) - timed_runs
+        has_runs = timed_runs > 0
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.bincount(timed_ids, weights=timed_durations, minlength=tests) / timed_runs
+
+        columns = {
+            "name": self.names,
+            "runs": runs.tolist(),
+            **{
+                outcome: outcome_counts[:, code].tolist()
+                for code, outcome in enumerate(self.OUTCOMES)
+            },
+            "failure_rate": (failures / np.maximum(runs, 1)).tolist(),
+            "mean": self.__nan_to_none(means, has_runs),
+        }
+
+        if not len(sorted_durations):
+            sorted_durations = np.zeros(1)
+
+        for percentile in percentiles:
+            position = np.maximum(timed_runs - 1, 0) * (percentile / 100)
+            lower = np.floor(position).astype(np.intp)
+            upper = np.ceil(position).astype(np.intp)
+
+            # Tests without timed runs read any index, their value is dropped
+            lower_values = sorted_durations[np.where(has_runs, starts + lower, 0)]
+            upper_values = sorted_durations[np.where(has_runs, starts + upper, 0)]
+            values = lower_values + (upper_values - lower_values) * (position - lower)
+
+            columns[self.__percentile_key(percentile)] = self.__nan_to_none(values, has_runs)
+
+        return columns
+
+    def __nan_to_none(self, values, has_runs) -> list:
+        return [
+            value if has_value else None
+            for value, has_value in zip(values.tolist(), has_runs.tolist())
+        ]
+
+    def __python_stats(self, percentiles: tuple[float]) -> dict[str, list]:
+        tests = len(self.names)
+        unknown = len(self.OUTCOMES)
+
+        outcome_counts = [[0] * (unknown + 1) for _ in range(tests)]
+        test_durations = [[] for _ in range(tests)]
+
+        for name_id, duration, code in zip(
+            self.name_ids, self.durations, self.outcome_codes
+        ):
+            outcome_counts[name_id][min(code, unknown)] += 1
+
+            if duration == duration:
+                test_durations[name_id].append(duration)
+
+        failed_codes = [self.OUTCOMES.index(outcome) for outcome in self.FAILED_OUTCOMES]
+        runs = [sum(counts) for counts in outcome_counts]
+
+        columns = {
+            "name": self.names,
+            "runs": runs,
+            **{
+                outcome: [counts[code] for counts in outcome_counts]
+                for code, outcome in enumerate(self.OUTCOMES)
+            },
+            "failure_rate": [
+                sum(counts[code] for code in failed_codes) / max(test_runs, 1)
+                for counts, test_runs in zip(outcome_counts, runs)
+            ],
+            "mean": [
+                math.fsum(durations) / len(durations) if durations else None
+                for durations in test_durations
+            ],
+        }
+
+        for durations in test_durations:
+            durations.sort()
+
+        for percentile in percentiles:
+            values = []
+
+            for durations in test_durations:
+                if not durations:
+                    values.append(None)
+                    continue
+
+                position = (len(durations) - 1) * (percentile / 100)
+                lower, upper = math.floor(position), math.ceil(position)
+                values.append(
+                    durations[lower]
+                    + (durations[upper] - durations[lower]) * (position - lower)
+                )
+
+            columns[self.__percentile_key(percentile)] = values
+
+        return columns
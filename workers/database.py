@@ -1,7 +1,16 @@
-import sqlite3
+import json
+import os
+import time
 from datetime import datetime
+from typing import Iterator
 
+from workers.metrics import Metrics
+from workers.query_profiler import QueryProfiler
+from workers.storage import StorageBackend
 
+
+@Metrics.time_db_methods
+@QueryProfiler.name_db_methods
 class DBWorker:
     """
     Worker object for the database.
@@ -27,16 +36,88 @@ class DBWorker:
 
     __instance = None
 
+    # Tables of the CI history moved by history.py, with their exported columns
+    history_tables = {
+        "projects": ("id", "name", "test_file", "github_url", "target_branch"),
+        "test_batches": (
+            "id",
+            "project_id",
+            "errors",
+            "failures",
+            "skipped",
+            "total",
+            "execution_time",
+            "datetime",
+            "variant",
+        ),
+        "test_cases": ("id", "test_batch_id", "test_name", "duration", "outcome"),
+        "batch_stage_timings": ("id", "test_batch_id", "stage", "duration"),
+        "batch_pipeline_stages": ("id", "test_batch_id", "stage", "status", "duration"),
+        # Tables without id hold a row per test of a project, read in the
+        # order of their primary key
+        "test_flakiness": (
+            "project_id",
+            "test_name",
+            "runs",
+            "failures",
+            "flips",
+            "last_outcome",
+            "last_content_key",
+            "updated_at",
+        ),
+        "quarantined_tests": ("project_id", "test_name", "created_at"),
+    }
+
     # Enforcing usage of a singleton
     def __new__(cls, *args, **kwargs):
         if cls.__instance is None:
             cls.__instance = super().__new__(cls)
         return cls.__instance
 
-    def __init__(self, db_file: str = "data.sqlite3"):
-        self.__conn = sqlite3.connect(db_file)
-        self.__cursor = self.__conn.cursor()
+    def __init__(self, db_file: str = None):
+        # A sqlite file or a PostgreSQL url, see storage.py. Each thread
+        # (web request, local build agent ...) gets its own connection.
+        db_file = db_file or os.getenv("CI_DATABASE_URL", "data.sqlite3")
+
+        if getattr(self, "_DBWorker__db_file", None) != db_file:
+            if hasattr(self, "_DBWorker__backend"):
+                self.__backend.dispose()
+
+            self.__backend = StorageBackend.from_url(db_file)
+
+            # The schema is checked once per database, not on every DBWorker(),
+            # and again on the next one if it could not be
+            self.__create_tables()
+            self.__db_file = db_file
+        elif self.__backend.closed:
+            # Connection of this thread was closed, we open a new one
+            self.__backend.reopen()
+
+    @classmethod
+    def instance(cls) -> "DBWorker":
+        """
+        Get the DBWorker with the database in use, opened on first use with
+        the default database.
+
+        Unlike DBWorker(), it does not switch back to the default database
+        when another one is in use.
 
+        """
+        instance = cls.__instance
+
+        if instance is None or not hasattr(instance, "_DBWorker__db_file"):
+            return cls()
+
+        if instance.__backend.closed:
+            instance.__backend.reopen()
+
+        return instance
+
+    def __create_tables(self) -> None:
+        """
+        Create the tables, and the columns added since, missing in the database.
+
+        """
         # Project table
         self.__cursor.execute(
             """CREATE TABLE IF NOT EXISTS projects (
@@ -70,11 +151,266 @@ class DBWorker:
                     test_batch_id INTEGER,
                     test_name TEXT,
                     duration REAL,
+                    outcome TEXT,
+                    FOREIGN KEY (test_batch_id) REFERENCES test_batches(id)
+                )"""
+        )
+
+        # The cases of a batch are read without scanning the whole table
+        self.__cursor.execute(
+            """CREATE INDEX IF NOT EXISTS test_cases_test_batch_id
+                ON test_cases (test_batch_id)"""
+        )
+
+        # Flakiness table, updated with the outcomes of each new batch
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS test_flakiness (
+                    project_id INTEGER,
+                    test_name TEXT,
+                    runs INTEGER DEFAULT 0,
+                    failures INTEGER DEFAULT 0,
+                    flips INTEGER DEFAULT 0,
+                    last_outcome TEXT,
+                    last_content_key TEXT,
+                    updated_at REAL,
+                    PRIMARY KEY (project_id, test_name),
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Quarantine table, failures of these tests do not fail the build
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS quarantined_tests (
+                    project_id INTEGER,
+                    test_name TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (project_id, test_name),
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Build job table, the queue leased by build agents
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS build_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id INTEGER,
+                    branch TEXT,
+                    commit_sha TEXT,
+                    status TEXT DEFAULT 'queued',
+                    agent TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    message TEXT,
+                    test_batch_id INTEGER,
+                    created_at REAL,
+                    leased_at REAL,
+                    lease_expires_at REAL,
+                    finished_at REAL,
+                    group_id INTEGER,
+                    matrix TEXT,
+                    trigger TEXT,
+                    stages TEXT,
+                    preempted_at REAL,
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Queue settings table, the [queue] config of each project
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS project_queue_settings (
+                    project_id INTEGER PRIMARY KEY,
+                    priority INTEGER,
+                    weight REAL,
+                    max_running INTEGER,
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Resource usage table, the peak memory of the builds of each project
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS project_resource_usage (
+                    project_id INTEGER PRIMARY KEY,
+                    peak_memory INTEGER,
+                    updated_at REAL,
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Schedule run table, the last time each schedule of a project enqueued a build
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS schedule_runs (
+                    project_id INTEGER,
+                    name TEXT,
+                    last_run_at REAL,
+                    PRIMARY KEY (project_id, name),
+                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                )"""
+        )
+
+        # Result cache table, the batch that tested a content hash
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS result_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    test_batch_id INTEGER,
+                    created_at REAL,
+                    FOREIGN KEY (test_batch_id) REFERENCES test_batches(id)
+                )"""
+        )
+
+        # Cache hit table, batches recorded from the results of a previous batch
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS batch_cache_hits (
+                    test_batch_id INTEGER PRIMARY KEY,
+                    source_batch_id INTEGER,
+                    FOREIGN KEY (test_batch_id) REFERENCES test_batches(id),
+                    FOREIGN KEY (source_batch_id) REFERENCES test_batches(id)
+                )"""
+        )
+
+        # Project job table, background clones and deletions of projects
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS project_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT,
+                    project_name TEXT,
+                    status TEXT DEFAULT 'queued',
+                    message TEXT,
+                    created_at REAL,
+                    finished_at REAL
+                )"""
+        )
+
+        # Batch diff table, changes of the test cases since the previous batch
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS batch_diffs (
+                    test_batch_id INTEGER PRIMARY KEY,
+                    base_batch_id INTEGER,
+                    new_failures INTEGER,
+                    fixed INTEGER,
+                    added INTEGER,
+                    removed INTEGER,
+                    slower INTEGER,
+                    faster INTEGER,
+                    data BLOB,
+                    FOREIGN KEY (test_batch_id) REFERENCES test_batches(id)
+                )"""
+        )
+
+        # Notification outbox, commit statuses and build summaries to send
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id INTEGER,
+                    kind TEXT,
+                    url TEXT,
+                    payload TEXT,
+                    status_key TEXT,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL,
+                    last_error TEXT,
+                    created_at REAL,
+                    sent_at REAL
+                )"""
+        )
+
+        # The dispatcher only reads the pending notifications which are due
+        self.__cursor.execute(
+            """CREATE INDEX IF NOT EXISTS notifications_status
+                ON notifications (status, next_attempt_at)"""
+        )
+
+        # Column added to test_cases after its creation, for flaky tests
+        self.__add_missing_columns("test_cases", {"outcome": "TEXT"})
+
+        # Columns added to build_jobs after its creation, for matrix builds
+        self.__add_missing_columns(
+            "build_jobs", {"group_id": "INTEGER", "matrix": "TEXT"}
+        )
+
+        # Columns added to build_jobs after its creation, for scheduled builds
+        self.__add_missing_columns("build_jobs", {"trigger": "TEXT", "stages": "TEXT"})
+
+        # Column added to build_jobs after its creation, for preemption
+        self.__add_missing_columns("build_jobs", {"preempted_at": "REAL"})
+
+        # Column added to test_batches after its creation, for batch diffs
+        self.__add_missing_columns("test_batches", {"variant": "TEXT"})
+
+        # Stage timing table, how long each stage of a batch took
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS batch_stage_timings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    test_batch_id INTEGER,
+                    stage TEXT,
+                    duration REAL,
+                    FOREIGN KEY (test_batch_id) REFERENCES test_batches(id)
+                )"""
+        )
+
+        # Pipeline stage table, result of each stage of the project pipeline (lint, unit ...)
+        self.__cursor.execute(
+            """CREATE TABLE IF NOT EXISTS batch_pipeline_stages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    test_batch_id INTEGER,
+                    stage TEXT,
+                    status TEXT,
+                    duration REAL,
                     FOREIGN KEY (test_batch_id) REFERENCES test_batches(id)
                 )"""
         )
         self.__conn.commit()
 
+    def __add_missing_columns(self, table: str, columns: dict[str, str]) -> None:
+        """
+        Add columns to a table created by an older version.
+
+        Params:
+            table: the name of the table
+            columns: a dict with the column name as key and its type as value
+
+        """
+        existing = self.__backend.table_columns(table)
+
+        for column, column_type in columns.items():
+            if column not in existing:
+                self.__cursor.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                )
+
+    @property
+    def __conn(self):
+        return self.__backend.connection
+
+    @property
+    def __cursor(self):
+        return self.__backend.cursor
+
+    @staticmethod
+    def __limit(limit: int) -> str:
+        """
+        LIMIT clause of a query, empty if limit is None.
+
+        """
+        return "" if limit is None else f"LIMIT {int(limit)}"
+
+    def __iter_rows(self, query: str, params: tuple, columns: tuple) -> Iterator[dict]:
+        """
+        Iterate over the rows of a query as dicts, a few hundred rows at a time.
+
+        A cursor of its own is used, so other queries can run while iterating.
+
+        """
+        cursor = self.__backend.new_cursor()
+
+        try:
+            cursor.execute(query, params)
+
+            while rows := cursor.fetchmany(500):
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+
     ####### PROJECTS #######
     def insert_project_to_database(
         self, name: str, test_file: str, github_url: str, target_branch: str = "main"
@@ -94,8 +430,8 @@ class DBWorker:
 
         """
         success = self.__cursor.execute(
-            """INSERT OR IGNORE INTO projects (name, test_file, github_url, target_branch)
-                VALUES (?, ?, ?, ?)""",
+            """INSERT INTO projects (name, test_file, github_url, target_branch)
+                VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING""",
             (name.lower(), test_file, github_url, target_branch),
         )
         self.__conn.commit()
@@ -170,6 +506,37 @@ class DBWorker:
 
         return projects
 
+    def iter_projects(self, after_id: int = None, limit: int = None) -> Iterator[dict]:
+        """
+        Iterate over the projects, by id.
+
+        Params:
+            after_id: only the projects with a greater id
+            limit: the maximum number of projects, all of them if None
+
+        Returns:
+            An iterator of dicts with the project data and the id of its last batch
+
+        """
+        return self.__iter_rows(
+            f"""SELECT id, name, test_file, github_url, target_branch,
+                    (SELECT MAX(id) FROM test_batches WHERE project_id = projects.id)
+                FROM projects WHERE id > ? ORDER BY id {self.__limit(limit)}""",
+            (after_id or 0,),
+            ("id", "name", "test_file", "github_url", "target_branch", "last_batch_id"),
+        )
+
+    def get_projects_version(self) -> str:
+        """
+        Value changing whenever a project is added or deleted, for conditional requests.
+
+        """
+        count, max_id = self.__cursor.execute(
+            """SELECT COUNT(*), MAX(id) FROM projects"""
+        ).fetchone()
+
+        return f"{count}-{max_id}"
+
     def get_project_by_id(self, project_id: int) -> dict:
         """
         Get a project from the database by its id.
@@ -242,13 +609,14 @@ class DBWorker:
         return self.__cursor.fetchone() is not None
 
     ####### BATCHES #######
-    def insert_test_batch(self, project_id: int, batch: tuple) -> int:
+    def insert_test_batch(self, project_id: int, batch: tuple, variant: str = None) -> int:
         """
         Insert a test batch into the database.
 
         Params:
             project_id: the id of the project
             batch: a tuple with the batch data (errors, failures, skipped, total, execution_time, datetime)
+            variant: the matrix cell and stages run, see BatchDiff.variant
 
         Returns:
             The id of the last inserted row to be able to insert test cases to
@@ -262,8 +630,8 @@ class DBWorker:
         timestamp = batch.get("timestamp", None)
 
         self.__cursor.execute(
-            """INSERT OR IGNORE INTO test_batches (project_id, errors, failures, skipped, total, execution_time, datetime) VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (project_id, errors, failures, skipped, total, execution_time, timestamp),
+            """INSERT INTO test_batches (project_id, errors, failures, skipped, total, execution_time, datetime, variant) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING""",
+            (project_id, errors, failures, skipped, total, execution_time, timestamp, variant),
         )
         self.__conn.commit()
 
@@ -283,44 +651,119 @@ class DBWorker:
 
         """
 
-        batches = []
         self.__cursor.execute(
-            """SELECT * FROM test_batches WHERE project_id = ?""",
+            """SELECT id, project_id, errors, failures, skipped, total, execution_time, datetime
+                FROM test_batches WHERE project_id = ?""",
             (project_id,),
         )
 
-        for batch in self.__cursor.fetchall():
-            # Unpack the batch data
-            (
-                id_,
-                _,
-                errors,
-                failures,
-                skipped,
-                total,
-                execution_time,
-                batch_datetime,
-            ) = batch
-
-            datetime_obj = datetime.strptime(batch_datetime, "%Y-%m-%dT%H:%M:%S.%f")
-
-            batches.append(
-                {
-                    "id": id_,
-                    "errors": errors,
-                    "failures": failures,
-                    "skipped": skipped,
-                    "total": total,
-                    "execution_time": str(execution_time) + " s",
-                    "datetime": datetime_obj.strftime("%Y-%m-%d | %H:%M"),
-                }
-            )
+        batches = [self.__batch_to_dict(batch) for batch in self.__cursor.fetchall()]
 
         # Sort the batches by datetime
         batches = sorted(batches, key=lambda x: x["datetime"], reverse=True)
 
         return batches if batches else [{"datetime": "No tests yet."}]
 
+    def iter_test_batches(
+        self, project_id: int = None, before_id: int = None, limit: int = None
+    ) -> Iterator[dict]:
+        """
+        Iterate over the test batches, the most recent first.
+
+        Params:
+            project_id: only the batches of this project, all of them if None
+            before_id: only the batches with a smaller id
+            limit: the maximum number of batches, all of them if None
+
+        Returns:
+            An iterator of dicts with the raw batch data (execution time in
+            seconds, datetime as saved) and the batch it reuses, if any.
+
+        """
+        return self.__iter_rows(
+            f"""SELECT test_batches.id, project_id, errors, failures, skipped, total,
+                    execution_time, datetime, batch_cache_hits.source_batch_id
+                FROM test_batches
+                LEFT JOIN batch_cache_hits ON batch_cache_hits.test_batch_id = test_batches.id
+                WHERE (? IS NULL OR project_id = ?) AND (? IS NULL OR test_batches.id < ?)
+                ORDER BY test_batches.id DESC {self.__limit(limit)}""",
+            (project_id, project_id, before_id, before_id),
+            (
+                "id",
+                "project_id",
+                "errors",
+                "failures",
+                "skipped",
+                "total",
+                "execution_time",
+                "datetime",
+                "cached_from",
+            ),
+        )
+
+    def get_test_batches_version(self, project_id: int = None) -> str:
+        """
+        Value changing whenever a batch is added or deleted, for conditional requests.
+
+        Params:
+            project_id: only the batches of this project, all of them if None
+
+        """
+        count, max_id = self.__cursor.execute(
+            """SELECT COUNT(*), MAX(id) FROM test_batches WHERE ? IS NULL OR project_id = ?""",
+            (project_id, project_id),
+        ).fetchone()
+
+        return f"{count}-{max_id}"
+
+    def get_test_batch(self, batch_id: int) -> dict:
+        """
+        Get a test batch by its id.
+
+        Params:
+            batch_id: the id of the test batch
+
+        Returns:
+            A dict with the test batch data and its project id, or None if it does not exist.
+
+        """
+        batch = self.__cursor.execute(
+            """SELECT id, project_id, errors, failures, skipped, total, execution_time, datetime
+                FROM test_batches WHERE id = ?""",
+            (batch_id,),
+        ).fetchone()
+
+        if batch is None:
+            return None
+
+        return {**self.__batch_to_dict(batch), "project_id": batch[1]}
+
+    def __batch_to_dict(self, batch: tuple) -> dict:
+        # Unpack the batch data
+        (
+            id_,
+            _,
+            errors,
+            failures,
+            skipped,
+            total,
+            execution_time,
+            batch_datetime,
+        ) = batch
+
+        # Recent pytest versions add the UTC offset to the timestamp
+        datetime_obj = datetime.fromisoformat(batch_datetime)
+
+        return {
+            "id": id_,
+            "errors": errors,
+            "failures": failures,
+            "skipped": skipped,
+            "total": total,
+            "execution_time": str(execution_time) + " s",
+            "datetime": datetime_obj.strftime("%Y-%m-%d | %H:%M"),
+        }
+
     def delete_test_batch_by_id(self, batch_id: int) -> None:
         """
         Delete a test batch from the database by its id.
@@ -340,16 +783,16 @@ class DBWorker:
         Insert multiple test cases to a batch of tests.
 
         Params:
-            project_id: the id of the project
-            test_name: the name of the test
-            duration: the duration of the test
+            test_batch_id: the id of the test batch
+            test_cases: (test_name, duration) or (test_name, duration, outcome)
+                tuples, the outcome is passed, failed, error, skipped or flaky
 
         """
-        for test_name, duration in test_cases:
+        for test_name, duration, *outcome in test_cases:
             self.__cursor.execute(
-                """INSERT INTO test_cases (test_batch_id, test_name, duration)
-                    VALUES (?, ?, ?)""",
-                (test_batch_id, test_name, duration),
+                """INSERT INTO test_cases (test_batch_id, test_name, duration, outcome)
+                    VALUES (?, ?, ?, ?)""",
+                (test_batch_id, test_name, duration, outcome[0] if outcome else None),
             )
         self.__conn.commit()
 
@@ -361,15 +804,1646 @@ class DBWorker:
             test_batch_id: the id of the test batch
 
         Returns:
-            A tuple with the test case data
+            A tuple with the test case data (id, test_batch_id, test_name, duration)
 
         """
         self.__cursor.execute(
-            """SELECT * FROM test_cases WHERE test_batch_id = ?""",
+            """SELECT id, test_batch_id, test_name, duration FROM test_cases
+                WHERE test_batch_id = ?""",
             (test_batch_id,),
         )
         return self.__cursor.fetchall()
 
+    def iter_test_cases(
+        self, test_batch_id: int, after_id: int = None, limit: int = None
+    ) -> Iterator[dict]:
+        """
+        Iterate over the test cases of a batch, by id.
+
+        Params:
+            test_batch_id: the id of the test batch
+            after_id: only the test cases with a greater id
+            limit: the maximum number of test cases, all of them if None
+
+        Returns:
+            An iterator of dicts with the test case data
+
+        """
+        return self.__iter_rows(
+            f"""SELECT id, test_name, duration, outcome FROM test_cases
+                WHERE test_batch_id = ? AND id > ? ORDER BY id {self.__limit(limit)}""",
+            (test_batch_id, after_id or 0),
+            ("id", "name", "duration", "outcome"),
+        )
+
+    def get_test_case_outcomes(self, test_batch_id: int) -> dict[str, str]:
+        """
+        Get the outcome of each test case of a batch.
+
+        Params:
+            test_batch_id: the id of the test batch
+
+        Returns:
+            A dict with the test name as key and its outcome as value
+
+        """
+        self.__cursor.execute(
+            """SELECT test_name, outcome FROM test_cases WHERE test_batch_id = ?""",
+            (test_batch_id,),
+        )
+
+        return dict(self.__cursor.fetchall())
+
+    def iter_test_case_history(
+        self, project_id: int, last_batches: int = None, batches_per_chunk: int = 50
+    ) -> Iterator[list[tuple]]:
+        """
+        Iterate over the test cases of the batches of a project, a chunk of
+        batches at a time, for the analytics of case_history.py.
+
+        Params:
+            project_id: the id of the project
+            last_batches: only the cases of the last batches, all of them if None
+            batches_per_chunk: the number of batches whose cases are read by query
+
+        Returns:
+            An iterator of lists of (test_batch_id, test_name, duration, outcome)
+            rows, by batch
+
+        """
+        batch_ids = [
+            batch_id
+            for (batch_id,) in self.__cursor.execute(
+                f"""SELECT id FROM test_batches WHERE project_id = ?
+                    ORDER BY id DESC {self.__limit(last_batches)}""",
+                (project_id,),
+            ).fetchall()
+        ]
+        batch_ids.reverse()
+
+        for start in range(0, len(batch_ids), batches_per_chunk):
+            chunk = batch_ids[start : start + batches_per_chunk]
+
+            rows = self.__cursor.execute(
+                f"""SELECT test_batch_id, test_name, duration, outcome FROM test_cases
+                    WHERE test_batch_id IN ({", ".join("?" * len(chunk))})
+                    ORDER BY test_batch_id, id""",
+                chunk,
+            ).fetchall()
+
+            if rows:
+                yield rows
+
+    ####### BATCH DIFFS #######
+    def get_diff_base(
+        self, project_id: int, test_batch_id: int, variant: str = None
+    ) -> tuple[(int, dict)]:
+        """
+        Get the test cases of the batch a new batch is compared with: the
+        previous batch of the project with test cases which ran the same
+        matrix cell and stages, the batches reusing cached results have none.
+
+        Params:
+            project_id: the id of the project
+            test_batch_id: the id of the new batch
+            variant: the matrix cell and stages run by the new batch
+
+        Returns:
+            A tuple with the id of the previous batch and the (duration,
+            outcome) of each of its tests, (None, {}) for the first batch
+
+        """
+        self.__cursor.execute(
+            """SELECT id FROM test_batches WHERE project_id = ? AND id < ?
+                    AND COALESCE(variant, '') = ?
+                    AND id NOT IN (SELECT test_batch_id FROM batch_cache_hits)
+                ORDER BY id DESC LIMIT 1""",
+            (project_id, test_batch_id, variant or ""),
+        )
+
+        if (base := self.__cursor.fetchone()) is None:
+            return (None, {})
+
+        self.__cursor.execute(
+            """SELECT test_name, duration, outcome FROM test_cases WHERE test_batch_id = ?""",
+            (base[0],),
+        )
+
+        return (
+            base[0],
+            {
+                test_name: (duration, outcome)
+                for test_name, duration, outcome in self.__cursor.fetchall()
+            },
+        )
+
+    def insert_batch_diff(
+        self, test_batch_id: int, base_batch_id: int, counts: dict[str, int], data: bytes
+    ) -> None:
+        """
+        Save the changes of a batch since its base batch, see batch_diff.py.
+
+        Params:
+            test_batch_id: the id of the batch
+            base_batch_id: the id of the batch it is compared with
+            counts: the number of tests of each kind of change
+            data: the compressed lists of tests
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO batch_diffs
+                    (test_batch_id, base_batch_id, new_failures, fixed, added, removed, slower, faster, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                test_batch_id,
+                base_batch_id,
+                counts["new_failures"],
+                counts["fixed"],
+                counts["added"],
+                counts["removed"],
+                counts["slower"],
+                counts["faster"],
+                data,
+            ),
+        )
+        self.__conn.commit()
+
+    def get_batch_diff(self, test_batch_id: int) -> dict:
+        """
+        Get the changes of a batch since its base batch.
+
+        Returns:
+            A dict with the base_batch_id, the count of each kind of change
+            and the compressed "data", or None if the batch has no diff
+
+        """
+        self.__cursor.execute(
+            """SELECT base_batch_id, new_failures, fixed, added, removed, slower, faster, data
+                FROM batch_diffs WHERE test_batch_id = ?""",
+            (test_batch_id,),
+        )
+
+        if (diff := self.__cursor.fetchone()) is None:
+            return None
+
+        keys = (
+            "base_batch_id",
+            "new_failures",
+            "fixed",
+            "added",
+            "removed",
+            "slower",
+            "faster",
+            "data",
+        )
+
+        return {**dict(zip(keys, diff)), "data": bytes(diff[-1])}
+
+    def get_batch_diff_counts(self, test_batch_id: int) -> dict:
+        """
+        Get the count of each kind of change of a batch, without the lists.
+
+        Returns:
+            A dict of the base_batch_id and the counts, or None if the batch
+            has no diff
+
+        """
+        self.__cursor.execute(
+            """SELECT base_batch_id, new_failures, fixed, added, removed, slower, faster
+                FROM batch_diffs WHERE test_batch_id = ?""",
+            (test_batch_id,),
+        )
+
+        if (diff := self.__cursor.fetchone()) is None:
+            return None
+
+        keys = ("base_batch_id", "new_failures", "fixed", "added", "removed", "slower", "faster")
+
+        return dict(zip(keys, diff))
+
+    def get_project_batch_diffs(self, project_id: int) -> dict[int, dict]:
+        """
+        Get the count of each kind of change of the batches of a project.
+
+        Returns:
+            A dict with the batch id as key and a dict of the base_batch_id
+            and the counts as value
+
+        """
+        self.__cursor.execute(
+            """SELECT batch_diffs.test_batch_id, base_batch_id, new_failures, fixed, added,
+                    removed, slower, faster
+                FROM batch_diffs
+                JOIN test_batches ON test_batches.id = batch_diffs.test_batch_id
+                WHERE test_batches.project_id = ?""",
+            (project_id,),
+        )
+
+        keys = ("base_batch_id", "new_failures", "fixed", "added", "removed", "slower", "faster")
+
+        return {row[0]: dict(zip(keys, row[1:])) for row in self.__cursor.fetchall()}
+
+    ####### FLAKY TESTS #######
+    def update_test_flakiness(
+        self, project_id: int, outcomes: list[(str, str)], content_key: str = None
+    ) -> None:
+        """
+        Add the outcomes of a new batch to the flakiness counters of its tests.
+
+        Only the counters of the tests of the batch are read and written, the
+        history of the project is never scanned again.
+
+        A test flips when it fails then passes on a rerun of the same build
+        (the "flaky" outcome), or when its outcome differs from its previous
+        run on the same content (same content_key, see result_cache.py).
+
+        Params:
+            project_id: the id of the project
+            outcomes: (test_name, outcome) tuples of the batch
+            content_key: the content hash tested by the batch, None if unknown
+
+        """
+        # Skipped tests did not run, they say nothing about flakiness
+        outcomes = {
+            test_name: outcome
+            for test_name, outcome in outcomes
+            if outcome in ("passed", "failed", "error", "flaky")
+        }
+
+        previous = {}
+        names = list(outcomes)
+
+        # Chunks stay below the limit of sqlite variables
+        for start in range(0, len(names), 500):
+            chunk = names[start : start + 500]
+            self.__cursor.execute(
+                f"""SELECT test_name, last_outcome, last_content_key FROM test_flakiness
+                    WHERE project_id = ? AND test_name IN ({", ".join("?" * len(chunk))})""",
+                (project_id, *chunk),
+            )
+            previous.update(
+                (test_name, (last_outcome, last_content_key))
+                for test_name, last_outcome, last_content_key in self.__cursor.fetchall()
+            )
+
+        rows = []
+
+        for test_name, outcome in outcomes.items():
+            last_outcome, last_content_key = previous.get(test_name, (None, None))
+            passed = outcome in ("passed", "flaky")
+
+            flipped = outcome == "flaky" or (
+                last_outcome is not None
+                and content_key is not None
+                and content_key == last_content_key
+                and passed != (last_outcome in ("passed", "flaky"))
+            )
+
+            rows.append(
+                (
+                    project_id,
+                    test_name,
+                    0 if outcome == "passed" else 1,
+                    int(flipped),
+                    outcome,
+                    content_key,
+                    time.time(),
+                )
+            )
+
+        self.__cursor.executemany(
+            """INSERT INTO test_flakiness
+                    (project_id, test_name, runs, failures, flips, last_outcome, last_content_key, updated_at)
+                VALUES (?, ?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (project_id, test_name) DO UPDATE SET
+                    runs = test_flakiness.runs + 1,
+                    failures = test_flakiness.failures + excluded.failures,
+                    flips = test_flakiness.flips + excluded.flips,
+                    last_outcome = excluded.last_outcome,
+                    last_content_key = excluded.last_content_key,
+                    updated_at = excluded.updated_at""",
+            rows,
+        )
+        self.__conn.commit()
+
+    def get_project_flaky_tests(self, project_id: int, limit: int = 20) -> list[dict]:
+        """
+        Get the tests of a project that flipped or are quarantined, the flakiest first.
+
+        Params:
+            project_id: the id of the project
+            limit: the maximum number of tests
+
+        Returns:
+            A list of dicts with the test name, its counters, its score (flips
+            per run) and whether it is quarantined.
+
+        """
+        self.__cursor.execute(
+            """SELECT test_flakiness.test_name, runs, failures, flips,
+                    CAST(flips AS REAL) / runs AS score,
+                    quarantined_tests.test_name IS NOT NULL
+                FROM test_flakiness
+                LEFT JOIN quarantined_tests
+                    ON quarantined_tests.project_id = test_flakiness.project_id
+                    AND quarantined_tests.test_name = test_flakiness.test_name
+                WHERE test_flakiness.project_id = ?
+                    AND (flips > 0 OR quarantined_tests.test_name IS NOT NULL)
+                ORDER BY score DESC, flips DESC, test_flakiness.test_name
+                LIMIT ?""",
+            (project_id, limit),
+        )
+
+        return [
+            {
+                "test_name": test_name,
+                "runs": runs,
+                "failures": failures,
+                "flips": flips,
+                "score": round(score, 3),
+                "quarantined": bool(quarantined),
+            }
+            for test_name, runs, failures, flips, score, quarantined in self.__cursor.fetchall()
+        ]
+
+    def quarantine_test(self, project_id: int, test_name: str) -> None:
+        """
+        Add a test to the quarantine list of a project.
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO quarantined_tests (project_id, test_name, created_at)
+                VALUES (?, ?, ?) ON CONFLICT DO NOTHING""",
+            (project_id, test_name, time.time()),
+        )
+        self.__conn.commit()
+
+    def release_test(self, project_id: int, test_name: str) -> None:
+        """
+        Remove a test from the quarantine list of a project.
+
+        """
+        self.__cursor.execute(
+            """DELETE FROM quarantined_tests WHERE project_id = ? AND test_name = ?""",
+            (project_id, test_name),
+        )
+        self.__conn.commit()
+
+    def get_quarantined_tests(self, project_id: int) -> list[str]:
+        """
+        Get the names of the quarantined tests of a project.
+
+        """
+        self.__cursor.execute(
+            """SELECT test_name FROM quarantined_tests WHERE project_id = ?
+                ORDER BY test_name""",
+            (project_id,),
+        )
+
+        return [row[0] for row in self.__cursor.fetchall()]
+
+    ####### STAGE TIMINGS #######
+    def insert_batch_stage_timings(
+        self, test_batch_id: int, timings: dict[str, float]
+    ) -> None:
+        """
+        Insert the duration of each stage of a batch.
+
+        Params:
+            test_batch_id: the id of the test batch
+            timings: a dict with the stage name as key and its duration in seconds as value
+
+        """
+        self.__cursor.executemany(
+            """INSERT INTO batch_stage_timings (test_batch_id, stage, duration)
+                VALUES (?, ?, ?)""",
+            [(test_batch_id, stage, duration) for stage, duration in timings.items()],
+        )
+        self.__conn.commit()
+
+    def get_batch_stage_timings(self, test_batch_id: int) -> dict[str, float]:
+        """
+        Get the duration of each stage of a batch.
+
+        Params:
+            test_batch_id: the id of the test batch
+
+        Returns:
+            A dict with the stage name as key and its duration in seconds as value
+
+        """
+        self.__cursor.execute(
+            """SELECT stage, duration FROM batch_stage_timings WHERE test_batch_id = ?""",
+            (test_batch_id,),
+        )
+
+        return dict(self.__cursor.fetchall())
+
+    def get_project_stage_timings(self, project_id: int) -> dict[int, dict]:
+        """
+        Get the duration of each stage for all the batches of a project.
+
+        Params:
+            project_id: the id of the project
+
+        Returns:
+            A dict with the batch id as key and a dict of stage durations as value
+
+        """
+        self.__cursor.execute(
+            """SELECT batch_stage_timings.test_batch_id, batch_stage_timings.stage, batch_stage_timings.duration
+                FROM batch_stage_timings
+                JOIN test_batches ON test_batches.id = batch_stage_timings.test_batch_id
+                WHERE test_batches.project_id = ?""",
+            (project_id,),
+        )
+
+        timings = {}
+
+        for batch_id, stage, duration in self.__cursor.fetchall():
+            timings.setdefault(batch_id, {})[stage] = duration
+
+        return timings
+
+    def get_project_average_stage_timings(self, project_id: int) -> dict[str, float]:
+        """
+        Get the average duration of each stage over all the batches of a project.
+
+        Params:
+            project_id: the id of the project
+
+        Returns:
+            A dict with the stage name as key and its average duration in seconds as value
+
+        """
+        self.__cursor.execute(
+            """SELECT batch_stage_timings.stage, AVG(batch_stage_timings.duration)
+                FROM batch_stage_timings
+                JOIN test_batches ON test_batches.id = batch_stage_timings.test_batch_id
+                WHERE test_batches.project_id = ?
+                GROUP BY batch_stage_timings.stage""",
+            (project_id,),
+        )
+
+        return dict(self.__cursor.fetchall())
+
+    ####### PIPELINE STAGES #######
+    def insert_batch_pipeline_stages(
+        self, test_batch_id: int, results: dict[str, dict]
+    ) -> None:
+        """
+        Insert the result of each pipeline stage of a batch.
+
+        Params:
+            test_batch_id: the id of the test batch
+            results: a dict with the stage name as key and a dict with its status and duration as value
+
+        """
+        self.__cursor.executemany(
+            """INSERT INTO batch_pipeline_stages (test_batch_id, stage, status, duration)
+                VALUES (?, ?, ?, ?)""",
+            [
+                (test_batch_id, stage, result["status"], result["duration"])
+                for stage, result in results.items()
+            ],
+        )
+        self.__conn.commit()
+
+    def get_batch_pipeline_stages(self, test_batch_id: int) -> dict[str, dict]:
+        """
+        Get the result of each pipeline stage of a batch.
+
+        Params:
+            test_batch_id: the id of the test batch
+
+        Returns:
+            A dict with the stage name as key and a dict with its status and duration as value,
+            in the order of the pipeline
+
+        """
+        self.__cursor.execute(
+            """SELECT stage, status, duration FROM batch_pipeline_stages
+                WHERE test_batch_id = ? ORDER BY id""",
+            (test_batch_id,),
+        )
+
+        return {
+            stage: {"status": status, "duration": duration}
+            for stage, status, duration in self.__cursor.fetchall()
+        }
+
+    def get_project_pipeline_stages(self, project_id: int) -> dict[int, dict]:
+        """
+        Get the result of each pipeline stage for all the batches of a project.
+
+        Params:
+            project_id: the id of the project
+
+        Returns:
+            A dict with the batch id as key and a dict of stage results as value
+
+        """
+        self.__cursor.execute(
+            """SELECT batch_pipeline_stages.test_batch_id, batch_pipeline_stages.stage,
+                    batch_pipeline_stages.status, batch_pipeline_stages.duration
+                FROM batch_pipeline_stages
+                JOIN test_batches ON test_batches.id = batch_pipeline_stages.test_batch_id
+                WHERE test_batches.project_id = ?
+                ORDER BY batch_pipeline_stages.id""",
+            (project_id,),
+        )
+
+        results = {}
+
+        for batch_id, stage, status, duration in self.__cursor.fetchall():
+            results.setdefault(batch_id, {})[stage] = {
+                "status": status,
+                "duration": duration,
+            }
+
+        return results
+
+    ####### RESULT CACHE #######
+    def get_cached_batch(self, cache_key: str) -> int:
+        """
+        Get the batch that tested a content hash.
+
+        Params:
+            cache_key: the key computed by ResultCache
+
+        Returns:
+            The id of the batch, or None if the key was never tested
+
+        """
+        row = self.__cursor.execute(
+            """SELECT result_cache.test_batch_id FROM result_cache
+                JOIN test_batches ON test_batches.id = result_cache.test_batch_id
+                WHERE result_cache.cache_key = ?""",
+            (cache_key,),
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def insert_cached_batch(self, cache_key: str, test_batch_id: int) -> None:
+        """
+        Save the batch that tested a content hash.
+
+        Params:
+            cache_key: the key computed by ResultCache
+            test_batch_id: the id of the batch
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO result_cache (cache_key, test_batch_id, created_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    test_batch_id = excluded.test_batch_id,
+                    created_at = excluded.created_at""",
+            (cache_key, test_batch_id, time.time()),
+        )
+        self.__conn.commit()
+
+    def insert_cache_hit_batch(
+        self, project_id: int, source_batch_id: int, timestamp: str
+    ) -> int:
+        """
+        Insert a batch with the results of a previous batch, without its test cases.
+
+        Params:
+            project_id: the id of the project
+            source_batch_id: the id of the batch whose results are reused
+            timestamp: the datetime of the new batch
+
+        Returns:
+            The id of the new batch
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO test_batches (project_id, errors, failures, skipped, total, execution_time, datetime)
+                SELECT ?, errors, failures, skipped, total, 0, ? FROM test_batches WHERE id = ?""",
+            (project_id, timestamp, source_batch_id),
+        )
+        batch_id = self.__cursor.lastrowid
+
+        self.__cursor.execute(
+            """INSERT INTO batch_cache_hits (test_batch_id, source_batch_id) VALUES (?, ?)""",
+            (batch_id, source_batch_id),
+        )
+        self.__conn.commit()
+
+        return batch_id
+
+    def get_project_cache_hits(self, project_id: int) -> dict[int, int]:
+        """
+        Get the batches of a project recorded from the results of a previous batch.
+
+        Params:
+            project_id: the id of the project
+
+        Returns:
+            A dict with the batch id as key and the id of the batch it reuses as value
+
+        """
+        self.__cursor.execute(
+            """SELECT batch_cache_hits.test_batch_id, batch_cache_hits.source_batch_id
+                FROM batch_cache_hits
+                JOIN test_batches ON test_batches.id = batch_cache_hits.test_batch_id
+                WHERE test_batches.project_id = ?""",
+            (project_id,),
+        )
+
+        return dict(self.__cursor.fetchall())
+
+    ####### BUILD JOBS #######
+    def enqueue_build_job(
+        self,
+        project_id: int,
+        branch: str,
+        commit_sha: str = None,
+        trigger: str = "webhook",
+        stages: list[str] = None,
+    ) -> int:
+        """
+        Add a build job to the queue.
+
+        Params:
+            project_id: the id of the project to build
+            branch: the branch that triggered the build
+            commit_sha: the commit that triggered the build, if known
+            trigger: what queued the build, "webhook" or "schedule:<name>"
+            stages: the pipeline stages to run, all of them if None
+
+        Returns:
+            The id of the queued job
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO build_jobs (project_id, branch, commit_sha, status, created_at, trigger, stages)
+                VALUES (?, ?, ?, 'queued', ?, ?, ?)""",
+            (
+                project_id,
+                branch,
+                commit_sha,
+                time.time(),
+                trigger,
+                json.dumps(stages) if stages is not None else None,
+            ),
+        )
+        self.__conn.commit()
+
+        return self.__cursor.lastrowid
+
+    def enqueue_build_job_group(
+        self,
+        project_id: int,
+        branch: str,
+        commit_sha: str,
+        cells: list[dict],
+        trigger: str = "webhook",
+        stages: list[str] = None,
+    ) -> list[int]:
+        """
+        Add one build job per matrix cell to the queue, as a group.
+
+        The id of the group is the id of its first job.
+
+        Params:
+            project_id: the id of the project to build
+            branch: the branch that triggered the build
+            commit_sha: the commit that triggered the build, if known
+            cells: the matrix cells to build, see matrix.py
+            trigger: what queued the build, "webhook" or "schedule:<name>"
+            stages: the pipeline stages to run, all of them if None
+
+        Returns:
+            The ids of the queued jobs, in the order of the cells
+
+        """
+        job_ids = []
+        now = time.time()
+
+        for cell in cells:
+            self.__cursor.execute(
+                """INSERT INTO build_jobs (project_id, branch, commit_sha, status, created_at, group_id, matrix, trigger, stages)
+                    VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)""",
+                (
+                    project_id,
+                    branch,
+                    commit_sha,
+                    now,
+                    job_ids[0] if job_ids else None,
+                    json.dumps(cell),
+                    trigger,
+                    json.dumps(stages) if stages is not None else None,
+                ),
+            )
+            job_ids.append(self.__cursor.lastrowid)
+
+        self.__cursor.execute(
+            """UPDATE build_jobs SET group_id = ? WHERE id = ?""",
+            (job_ids[0], job_ids[0]),
+        )
+
+        # Committed at once, so agents never lease a partial group
+        self.__conn.commit()
+
+        return job_ids
+
+    def set_project_queue_settings(
+        self, project_id: int, priority: int, weight: float, max_running: int
+    ) -> None:
+        """
+        Save the queue settings of a project, read from its config when a build is queued.
+
+        Params:
+            project_id: the id of the project
+            priority: jobs with a higher priority are leased first
+            weight: the share of the agents of the project, relative to the other projects
+            max_running: the maximum number of jobs of the project leased at
+            the same time, None for the default of the queue
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO project_queue_settings (project_id, priority, weight, max_running)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (project_id) DO UPDATE SET priority = excluded.priority,
+                    weight = excluded.weight, max_running = excluded.max_running""",
+            (project_id, priority, weight, max_running),
+        )
+        self.__conn.commit()
+
+    def record_project_peak_memory(self, project_id: int, peak_memory: int) -> None:
+        """
+        Save the peak memory of a build of a project.
+
+        The peak of the project is the peak of its last build when higher,
+        otherwise it goes down by 10% per build: one build using less memory
+        does not make the next ones fit in less.
+
+        Params:
+            project_id: the id of the project
+            peak_memory: the peak memory of the build, in bytes
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO project_resource_usage (project_id, peak_memory, updated_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (project_id) DO UPDATE SET
+                    peak_memory = CASE
+                        WHEN excluded.peak_memory > project_resource_usage.peak_memory * 0.9
+                        THEN excluded.peak_memory
+                        ELSE CAST(project_resource_usage.peak_memory * 0.9 AS INTEGER)
+                    END,
+                    updated_at = excluded.updated_at""",
+            (project_id, int(peak_memory), time.time()),
+        )
+        self.__conn.commit()
+
+    def get_project_peak_memory(self, project_id: int) -> int:
+        """
+        Get the peak memory of the builds of a project, in bytes.
+
+        Returns:
+            The peak memory, or None if no build of the project was measured
+
+        """
+        row = self.__cursor.execute(
+            """SELECT peak_memory FROM project_resource_usage WHERE project_id = ?""",
+            (project_id,),
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def __leasable_build_jobs(
+        self, fair_share_window: float, max_running: int, memory_budget: int = None
+    ) -> list[dict]:
+        """
+        Get the queued jobs that can be leased, in the order they should be.
+
+        Jobs are ordered by the priority of their project, then webhook builds
+        before scheduled builds, then by the agent time used by their project
+        in the fair share window divided by its weight, then by age. The jobs
+        of a project running max_running jobs, and of a project whose builds
+        peaked above memory_budget, are left out.
+
+        """
+        now = time.time()
+        window_start = now - fair_share_window
+
+        # Agent seconds used by each project during the window
+        usage = {}
+        running = {}
+
+        for project_id, status, leased_at, finished_at in self.__cursor.execute(
+            """SELECT project_id, status, leased_at, finished_at FROM build_jobs
+                WHERE status = 'leased' OR (leased_at IS NOT NULL AND finished_at > ?)""",
+            (window_start,),
+        ).fetchall():
+            end = finished_at if status != "leased" and finished_at else now
+            usage[project_id] = usage.get(project_id, 0) + end - max(leased_at, window_start)
+
+            if status == "leased":
+                running[project_id] = running.get(project_id, 0) + 1
+
+        keys = (
+            "id",
+            "project_id",
+            "trigger",
+            "created_at",
+            "priority",
+            "weight",
+            "max_running",
+            "peak_memory",
+        )
+
+        jobs = [
+            dict(zip(keys, row))
+            for row in self.__cursor.execute(
+                """SELECT build_jobs.id, build_jobs.project_id, build_jobs.trigger, build_jobs.created_at,
+                        COALESCE(settings.priority, 0), COALESCE(settings.weight, 1), settings.max_running,
+                        resources.peak_memory
+                    FROM build_jobs
+                    LEFT JOIN project_queue_settings AS settings
+                        ON settings.project_id = build_jobs.project_id
+                    LEFT JOIN project_resource_usage AS resources
+                        ON resources.project_id = build_jobs.project_id
+                    WHERE build_jobs.status = 'queued'"""
+            ).fetchall()
+        ]
+
+        jobs = [
+            job
+            for job in jobs
+            if (
+                not (limit := job["max_running"] or max_running)
+                or running.get(job["project_id"], 0) < limit
+            )
+            and (
+                memory_budget is None
+                or job["peak_memory"] is None
+                or job["peak_memory"] <= memory_budget
+            )
+        ]
+
+        for job in jobs:
+            job["scheduled"] = (job["trigger"] or "webhook") != "webhook"
+            job["share"] = usage.get(job["project_id"], 0) / job["weight"]
+
+        return sorted(
+            jobs,
+            key=lambda job: (-job["priority"], job["scheduled"], job["share"], job["id"]),
+        )
+
+    def lease_build_job(
+        self,
+        agent: str,
+        lease_seconds: int,
+        fair_share_window: float = 3600,
+        max_running: int = 0,
+        memory_budget: int = None,
+    ) -> dict:
+        """
+        Lease the next queued build job to an agent.
+
+        Builds run in their own workspace, so builds of a project can be
+        leased at the same time, up to the max_running of the project.
+
+        Params:
+            agent: the name of the agent leasing the job
+            lease_seconds: seconds before the lease expires without heartbeat
+            fair_share_window: seconds of history used to share the agents
+            between the projects
+            max_running: the maximum number of jobs of a project leased at the
+            same time, for the projects not setting theirs, 0 for no limit
+            memory_budget: the memory free on the host of the agent, in bytes,
+            the projects whose builds peaked above are skipped, None for no limit
+
+        Returns:
+            A dict with the job data, or None if no job can be leased
+
+        """
+        for job in self.__leasable_build_jobs(fair_share_window, max_running, memory_budget):
+            job_id = job["id"]
+            now = time.time()
+
+            # The status check makes the lease atomic between agents
+            leased = self.__cursor.execute(
+                """UPDATE build_jobs
+                    SET status = 'leased', agent = ?, attempts = attempts + 1,
+                        leased_at = ?, lease_expires_at = ?
+                    WHERE id = ? AND status = 'queued'""",
+                (agent, now, now + lease_seconds, job_id),
+            )
+            self.__conn.commit()
+
+            if leased.rowcount > 0:
+                return self.get_build_job(job_id)
+
+        return None
+
+    def extend_build_job_lease(
+        self, job_id: int, agent: str, lease_seconds: int
+    ) -> bool:
+        """
+        Extend the lease of a job, called on each agent heartbeat.
+
+        Params:
+            job_id: the id of the job
+            agent: the name of the agent holding the lease
+            lease_seconds: seconds before the lease expires without heartbeat
+
+        Returns:
+            True if the agent still holds the lease
+            False otherwise
+
+        """
+        success = self.__cursor.execute(
+            """UPDATE build_jobs SET lease_expires_at = ?
+                WHERE id = ? AND agent = ? AND status = 'leased'""",
+            (time.time() + lease_seconds, job_id, agent),
+        )
+        self.__conn.commit()
+
+        return success.rowcount > 0
+
+    def finish_build_job(
+        self,
+        job_id: int,
+        status: str,
+        message: str,
+        test_batch_id: int = None,
+        agent: str = None,
+    ) -> bool:
+        """
+        Mark a leased job as done or failed.
+
+        Params:
+            job_id: the id of the job
+            status: "done" or "failed"
+            message: a message describing the result
+            test_batch_id: the id of the batch created from the results, if any
+            agent: the agent which built the job, the job is only finished if
+                it still holds the lease (expired and leased again, or
+                preempted, it belongs to another agent); any agent if None
+
+        Returns:
+            True if the job was leased and is now finished
+            False otherwise
+
+        """
+        success = self.__cursor.execute(
+            """UPDATE build_jobs SET status = ?, message = ?, test_batch_id = ?, finished_at = ?
+                WHERE id = ? AND status = 'leased' AND (? IS NULL OR agent = ?)""",
+            (status, message, test_batch_id, time.time(), job_id, agent, agent),
+        )
+        self.__conn.commit()
+
+        return success.rowcount > 0
+
+    def preempt_build_job(
+        self,
+        job_id: int,
+        agent: str,
+        wait_seconds: float,
+        fair_share_window: float = 3600,
+        max_running: int = 0,
+    ) -> bool:
+        """
+        Put a scheduled build back in the queue when webhook builds wait for an agent.
+
+        A scheduled job is preempted when more webhook jobs of at least its
+        priority waited wait_seconds than scheduled jobs were preempted during
+        the last wait_seconds, the agents freed by these preemptions being
+        about to lease them. The preemption does not count as an attempt.
+
+        Params:
+            job_id: the id of the job
+            agent: the name of the agent holding the lease
+            wait_seconds: how long webhook jobs wait before preempting
+            fair_share_window: see lease_build_job
+            max_running: see lease_build_job
+
+        Returns:
+            True if the job was put back in the queue
+            False otherwise
+
+        """
+        job = self.__cursor.execute(
+            """SELECT build_jobs.trigger, COALESCE(settings.priority, 0)
+                FROM build_jobs
+                LEFT JOIN project_queue_settings AS settings
+                    ON settings.project_id = build_jobs.project_id
+                WHERE build_jobs.id = ? AND build_jobs.agent = ? AND build_jobs.status = 'leased'""",
+            (job_id, agent),
+        ).fetchone()
+
+        if job is None or (job[0] or "webhook") == "webhook":
+            return False
+
+        now = time.time()
+
+        waiting = sum(
+            1
+            for queued in self.__leasable_build_jobs(fair_share_window, max_running)
+            if not queued["scheduled"]
+            and queued["priority"] >= job[1]
+            and queued["created_at"] < now - wait_seconds
+        )
+
+        preempted = self.__cursor.execute(
+            """SELECT COUNT(*) FROM build_jobs WHERE preempted_at > ?""",
+            (now - wait_seconds,),
+        ).fetchone()[0]
+
+        if waiting <= preempted:
+            return False
+
+        success = self.__cursor.execute(
+            """UPDATE build_jobs
+                SET status = 'queued', agent = NULL, attempts = attempts - 1, preempted_at = ?
+                WHERE id = ? AND agent = ? AND status = 'leased'""",
+            (now, job_id, agent),
+        )
+        self.__conn.commit()
+
+        return success.rowcount > 0
+
+    def requeue_expired_build_jobs(self, max_attempts: int) -> int:
+        """
+        Put back in the queue the jobs whose agent stopped sending heartbeats.
+
+        Jobs that already used all their attempts are marked as failed.
+
+        Params:
+            max_attempts: the number of leases a job is allowed
+
+        Returns:
+            The number of expired jobs
+
+        """
+        now = time.time()
+
+        failed = self.__cursor.execute(
+            """UPDATE build_jobs SET status = 'failed', message = 'lease expired', finished_at = ?
+                WHERE status = 'leased' AND lease_expires_at < ? AND attempts >= ?""",
+            (now, now, max_attempts),
+        ).rowcount
+
+        requeued = self.__cursor.execute(
+            """UPDATE build_jobs SET status = 'queued', agent = NULL
+                WHERE status = 'leased' AND lease_expires_at < ?""",
+            (now,),
+        ).rowcount
+        self.__conn.commit()
+
+        return failed + requeued
+
+    def get_build_job(self, job_id: int) -> dict:
+        """
+        Get a build job and the project it builds.
+
+        Params:
+            job_id: the id of the job
+
+        Returns:
+            A dict with the job data, or None if the job does not exist
+
+        """
+        self.__cursor.execute(
+            """SELECT build_jobs.id, build_jobs.project_id, projects.name, projects.test_file,
+                    projects.github_url, build_jobs.branch, build_jobs.commit_sha,
+                    build_jobs.status, build_jobs.agent, build_jobs.attempts, build_jobs.message,
+                    build_jobs.test_batch_id, build_jobs.created_at, build_jobs.leased_at,
+                    build_jobs.group_id, build_jobs.matrix, build_jobs.trigger, build_jobs.stages
+                FROM build_jobs JOIN projects ON projects.id = build_jobs.project_id
+                WHERE build_jobs.id = ?""",
+            (job_id,),
+        )
+
+        if (job := self.__cursor.fetchone()) is None:
+            return None
+
+        keys = (
+            "id",
+            "project_id",
+            "project_name",
+            "test_file",
+            "github_url",
+            "branch",
+            "commit_sha",
+            "status",
+            "agent",
+            "attempts",
+            "message",
+            "test_batch_id",
+            "created_at",
+            "leased_at",
+            "group_id",
+            "matrix",
+            "trigger",
+            "stages",
+        )
+
+        job = dict(zip(keys, job))
+
+        # The matrix cell built by the job, None if the project has no matrix
+        job["matrix"] = json.loads(job["matrix"]) if job["matrix"] else None
+
+        # Jobs queued before triggers were saved came from webhooks
+        job["trigger"] = job["trigger"] or "webhook"
+        job["stages"] = json.loads(job["stages"]) if job["stages"] else None
+
+        return job
+
+    def get_project_matrix_builds(self, project_id: int) -> list[dict]:
+        """
+        Get the matrix builds of a project, each one grouping the jobs of its cells.
+
+        Params:
+            project_id: the id of the project
+
+        Returns:
+            A list of dicts with the group id, the commit, the added up failures,
+            errors and total of the cells, and the cells themselves, newest first
+
+        """
+        self.__cursor.execute(
+            """SELECT build_jobs.group_id, build_jobs.commit_sha, build_jobs.id, build_jobs.matrix,
+                    build_jobs.status, build_jobs.test_batch_id, test_batches.errors,
+                    test_batches.failures, test_batches.total
+                FROM build_jobs LEFT JOIN test_batches ON test_batches.id = build_jobs.test_batch_id
+                WHERE build_jobs.project_id = ? AND build_jobs.group_id IS NOT NULL
+                ORDER BY build_jobs.group_id DESC, build_jobs.id""",
+            (project_id,),
+        )
+
+        groups = {}
+
+        for row in self.__cursor.fetchall():
+            group_id, commit_sha, job_id, matrix, status, batch_id = row[:6]
+            errors, failures, total = (value or 0 for value in row[6:])
+
+            if group_id not in groups:
+                groups[group_id] = {
+                    "group_id": group_id,
+                    "commit_sha": commit_sha,
+                    "errors": 0,
+                    "failures": 0,
+                    "total": 0,
+                    "cells": [],
+                }
+
+            group = groups[group_id]
+            group["errors"] += errors
+            group["failures"] += failures
+            group["total"] += total
+            group["cells"].append(
+                {
+                    "job_id": job_id,
+                    "matrix": json.loads(matrix),
+                    "status": status,
+                    "batch_id": batch_id,
+                    "errors": errors,
+                    "failures": failures,
+                    "total": total,
+                }
+            )
+
+        return list(groups.values())
+
+    def count_build_jobs(self, status: str) -> int:
+        """
+        Count the build jobs with a given status.
+
+        Params:
+            status: "queued", "leased", "done" or "failed"
+
+        """
+        return self.__cursor.execute(
+            """SELECT COUNT(*) FROM build_jobs WHERE status = ?""", (status,)
+        ).fetchone()[0]
+
+    def get_project_last_build_time(self, project_id: int) -> float:
+        """
+        Get when the last build of a project was queued.
+
+        Returns:
+            A timestamp, or None if the project was never built
+
+        """
+        return self.__cursor.execute(
+            """SELECT MAX(created_at) FROM build_jobs WHERE project_id = ?""",
+            (project_id,),
+        ).fetchone()[0]
+
+    def has_pending_build_job(self, project_id: int, trigger: str) -> bool:
+        """
+        Check if a build of a project queued by a trigger is queued or running.
+
+        """
+        self.__cursor.execute(
+            """SELECT id FROM build_jobs
+                WHERE project_id = ? AND trigger = ? AND status IN ('queued', 'leased')""",
+            (project_id, trigger),
+        )
+
+        return self.__cursor.fetchone() is not None
+
+    ####### SCHEDULES #######
+    def claim_schedule_run(self, project_id: int, name: str, run_at: float) -> bool:
+        """
+        Record a run of a schedule, unless it already ran at that time.
+
+        Several server processes can evaluate the schedules, only the one
+        claiming the run enqueues the build.
+
+        Params:
+            project_id: the id of the project
+            name: the name of the schedule
+            run_at: the minute of the run, as a timestamp
+
+        Returns:
+            True if the run was claimed
+            False if the schedule already ran at or after run_at
+
+        """
+        claimed = self.__cursor.execute(
+            """INSERT INTO schedule_runs (project_id, name, last_run_at) VALUES (?, ?, ?)
+                ON CONFLICT (project_id, name) DO UPDATE SET last_run_at = excluded.last_run_at
+                WHERE schedule_runs.last_run_at < excluded.last_run_at""",
+            (project_id, name, run_at),
+        ).rowcount
+        self.__conn.commit()
+
+        return claimed > 0
+
+    ####### NOTIFICATIONS #######
+    def insert_notifications(self, notifications: list[tuple]) -> None:
+        """
+        Add notifications to the outbox, due right away.
+
+        A notification with a status key supersedes the pending ones with
+        the same key, even those waiting for a retry: an older commit status
+        sent late would overwrite the newer one.
+
+        Params:
+            notifications: (project_id, kind, url, payload, status_key)
+            tuples, the payload is a json string, the status key None for
+            the notifications which are all sent
+
+        """
+        now = time.time()
+
+        self.__cursor.executemany(
+            """UPDATE notifications SET status = 'superseded'
+                WHERE status = 'pending' AND status_key = ?""",
+            [
+                (status_key,)
+                for *_, status_key in notifications
+                if status_key is not None
+            ],
+        )
+        self.__cursor.executemany(
+            """INSERT INTO notifications
+                    (project_id, kind, url, payload, status_key, next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [notification + (now, now) for notification in notifications],
+        )
+        self.__conn.commit()
+
+    def claim_notifications(self, limit: int, claim_seconds: float) -> list[dict]:
+        """
+        Claim the pending notifications which are due, the oldest first.
+
+        A claimed notification is not due again before claim_seconds, so
+        several dispatchers do not send it twice, and it is sent again if
+        its dispatcher stops before recording the result.
+
+        Params:
+            limit: the maximum number of notifications
+            claim_seconds: seconds before a claimed notification is due again
+
+        Returns:
+            A list of dicts with the notification data
+
+        """
+        now = time.time()
+
+        self.__cursor.execute(
+            f"""SELECT id, project_id, kind, url, payload, attempts, next_attempt_at
+                FROM notifications WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY id {self.__limit(limit)}""",
+            (now,),
+        )
+
+        keys = ("id", "project_id", "kind", "url", "payload", "attempts", "next_attempt_at")
+        notifications = [dict(zip(keys, row)) for row in self.__cursor.fetchall()]
+        claimed = []
+
+        for notification in notifications:
+            # The due time check makes the claim atomic between dispatchers
+            if self.__cursor.execute(
+                """UPDATE notifications SET next_attempt_at = ?
+                    WHERE id = ? AND status = 'pending' AND next_attempt_at = ?""",
+                (now + claim_seconds, notification["id"], notification["next_attempt_at"]),
+            ).rowcount > 0:
+                del notification["next_attempt_at"]
+                claimed.append(notification)
+
+        self.__conn.commit()
+
+        return claimed
+
+    def finish_notifications(
+        self, notification_ids: list[int], status: str, error: str = None
+    ) -> None:
+        """
+        Record the end of notifications, sent or given up.
+
+        Params:
+            notification_ids: the ids of the notifications
+            status: "sent" or "failed"
+            error: why the last attempt failed
+
+        """
+        now = time.time()
+
+        self.__cursor.executemany(
+            """UPDATE notifications
+                SET status = ?, attempts = attempts + 1, last_error = ?, sent_at = ?
+                WHERE id = ?""",
+            [
+                (status, error, now if status == "sent" else None, notification_id)
+                for notification_id in notification_ids
+            ],
+        )
+        self.__conn.commit()
+
+    def retry_notification(
+        self, notification_id: int, next_attempt_at: float, error: str
+    ) -> None:
+        """
+        Record a failed attempt to send a notification, sent again at next_attempt_at.
+
+        """
+        self.__cursor.execute(
+            """UPDATE notifications
+                SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                WHERE id = ?""",
+            (next_attempt_at, error, notification_id),
+        )
+        self.__conn.commit()
+
+    def get_notifications(self, project_id: int = None, limit: int = 50) -> list[dict]:
+        """
+        Get the notifications of the outbox, the most recent first.
+
+        Params:
+            project_id: only the notifications of this project, all of them if None
+            limit: the maximum number of notifications
+
+        Returns:
+            A list of dicts with the notification data
+
+        """
+        self.__cursor.execute(
+            """SELECT id, project_id, kind, url, payload, status, attempts,
+                    next_attempt_at, last_error, created_at, sent_at
+                FROM notifications WHERE ? IS NULL OR project_id = ?
+                ORDER BY id DESC LIMIT ?""",
+            (project_id, project_id, limit),
+        )
+
+        keys = (
+            "id",
+            "project_id",
+            "kind",
+            "url",
+            "payload",
+            "status",
+            "attempts",
+            "next_attempt_at",
+            "last_error",
+            "created_at",
+            "sent_at",
+        )
+
+        return [dict(zip(keys, row)) for row in self.__cursor.fetchall()]
+
+    def count_pending_notifications(self) -> int:
+        self.__cursor.execute("""SELECT COUNT(*) FROM notifications WHERE status = 'pending'""")
+
+        return self.__cursor.fetchone()[0]
+
+    ####### PROJECT JOBS #######
+    def insert_project_job(self, kind: str, project_name: str) -> int:
+        """
+        Save a new background job adding or deleting a project.
+
+        Params:
+            kind: "add" or "delete"
+            project_name: the name of the project
+
+        Returns:
+            The id of the job
+
+        """
+        self.__cursor.execute(
+            """INSERT INTO project_jobs (kind, project_name, status, created_at)
+                VALUES (?, ?, 'queued', ?)""",
+            (kind, project_name, time.time()),
+        )
+        self.__conn.commit()
+
+        return self.__cursor.lastrowid
+
+    def update_project_job(self, job_id: int, status: str, message: str) -> None:
+        """
+        Change the status of a project job.
+
+        Params:
+            job_id: the id of the job
+            status: "queued", "running", "done" or "failed"
+            message: what the job does, or how it ended
+
+        """
+        finished_at = time.time() if status in ("done", "failed") else None
+
+        self.__cursor.execute(
+            """UPDATE project_jobs SET status = ?, message = ?, finished_at = ? WHERE id = ?""",
+            (status, message, finished_at, job_id),
+        )
+        self.__conn.commit()
+
+    def get_project_jobs(self, job_id: int = None, limit: int = 20) -> list[dict]:
+        """
+        Get project jobs, the most recent first.
+
+        Params:
+            job_id: only this job, all of them if None
+            limit: the maximum number of jobs
+
+        Returns:
+            A list of dicts with the job data
+
+        """
+        self.__cursor.execute(
+            """SELECT id, kind, project_name, status, message, created_at, finished_at
+                FROM project_jobs WHERE ? IS NULL OR id = ? ORDER BY id DESC LIMIT ?""",
+            (job_id, job_id, limit),
+        )
+
+        keys = ("id", "kind", "project_name", "status", "message", "created_at", "finished_at")
+
+        return [dict(zip(keys, job)) for job in self.__cursor.fetchall()]
+
+    def has_active_project_job(self, project_name: str) -> bool:
+        """
+        Check if a project is being added or deleted.
+
+        """
+        self.__cursor.execute(
+            """SELECT id FROM project_jobs
+                WHERE project_name = ? AND status IN ('queued', 'running')""",
+            (project_name,),
+        )
+
+        return self.__cursor.fetchone() is not None
+
+    def fail_interrupted_project_jobs(self) -> int:
+        """
+        Mark as failed the project jobs left unfinished by a stopped server.
+
+        Returns:
+            The number of interrupted jobs
+
+        """
+        interrupted = self.__cursor.execute(
+            """UPDATE project_jobs SET status = 'failed', message = 'interrupted by a restart',
+                    finished_at = ?
+                WHERE status IN ('queued', 'running')""",
+            (time.time(),),
+        ).rowcount
+        self.__conn.commit()
+
+        return interrupted
+
+    ####### HISTORY #######
+    def get_history_snapshot(self) -> dict[str, int]:
+        """
+        Get the greatest id of each history table, read by a single query.
+
+        Rows added after the snapshot (a build finishing during an export)
+        are left for the next export.
+
+        Returns:
+            A dict with the table name as key and its greatest id as value, 0 if
+            empty. Tables without id get the greatest project id, their rows
+            of the projects created later are left out.
+
+        """
+        # A single query reads every table at the same point in time
+        max_ids = self.__cursor.execute(
+            "SELECT "
+            + ", ".join(
+                f"(SELECT MAX(id) FROM {table if 'id' in columns else 'projects'})"
+                for table, columns in self.history_tables.items()
+            )
+        ).fetchone()
+
+        return {
+            table: max_id or 0 for table, max_id in zip(self.history_tables, max_ids)
+        }
+
+    def iter_history_chunks(
+        self, table: str, max_id: int, chunk_size: int = 5000
+    ) -> Iterator[list[tuple]]:
+        """
+        Iterate over the rows of a history table, a chunk at a time.
+
+        Each chunk is a short query starting after the last id of the previous
+        one, the database is never held in a long read transaction.
+
+        Params:
+            table: a table of history_tables
+            max_id: the greatest id exported, from get_history_snapshot
+            chunk_size: the number of rows of a chunk
+
+        Returns:
+            An iterator of lists of rows, with the columns of history_tables
+
+        """
+        columns = ", ".join(self.history_tables[table])
+
+        if "id" not in self.history_tables[table]:
+            yield from self.__iter_test_rows_chunks(table, columns, max_id, chunk_size)
+            return
+
+        last_id = 0
+
+        while True:
+            rows = self.__cursor.execute(
+                f"""SELECT {columns} FROM {table} WHERE id > ? AND id <= ?
+                    ORDER BY id LIMIT ?""",
+                (last_id, max_id, chunk_size),
+            ).fetchall()
+
+            if not rows:
+                return
+
+            yield rows
+
+            last_id = rows[-1][0]
+
+    def __iter_test_rows_chunks(
+        self, table: str, columns: str, max_project_id: int, chunk_size: int
+    ) -> Iterator[list[tuple]]:
+        # Each chunk starts after the (project_id, test_name) of the previous one
+        last_key = (0, "")
+
+        while True:
+            rows = self.__cursor.execute(
+                f"""SELECT {columns} FROM {table}
+                    WHERE (project_id, test_name) > (?, ?) AND project_id <= ?
+                    ORDER BY project_id, test_name LIMIT ?""",
+                (*last_key, max_project_id, chunk_size),
+            ).fetchall()
+
+            if not rows:
+                return
+
+            yield rows
+
+            last_key = rows[-1][:2]
+
+    def insert_history_rows(self, table: str, rows: list[tuple]) -> int:
+        """
+        Insert exported rows of a history table, keeping their ids.
+
+        Rows whose id already exists are ignored, so importing the same
+        export twice does not duplicate anything.
+
+        Params:
+            table: a table of history_tables
+            rows: rows with the columns of history_tables
+
+        Returns:
+            The number of inserted rows
+
+        """
+        columns = self.history_tables[table]
+
+        self.__cursor.executemany(
+            f"""INSERT INTO {table} ({", ".join(columns)})
+                VALUES ({", ".join("?" * len(columns))}) ON CONFLICT DO NOTHING""",
+            rows,
+        )
+        inserted = self.__cursor.rowcount
+        self.__backend.ids_inserted(table)
+        self.__conn.commit()
+
+        return inserted
+
     ####### STATISTICS #######
     def get_tests_statistics(self) -> dict:
         """
@@ -453,4 +2527,4 @@ class DBWorker:
         Close the connection to the database.
 
         """
-        self.__conn.close()
+        self.__backend.close()
@@ -7,3 +7,17 @@ class ExitCodes(Enum):
     MISSING_REQUIREMENTS = 2
     MISSING_TEST_FILE = 3
     VENV_CREATION_ERROR = 4
+    # Same code as the timeout command
+    TIMEOUT = 124
+    # Same code as a shell interrupted by Ctrl-C
+    CANCELLED = 130
+
+
+class BuildStage(Enum):
+    QUEUE_WAIT = "queue_wait"
+    FETCH = "fetch"
+    ENV_SETUP = "env_setup"
+    DEPENDENCY_INSTALL = "dependency_install"
+    TEST_RUN = "test_run"
+    REPORT_PARSE = "report_parse"
+    DB_INGEST = "db_ingest"
@@ -0,0 +1,121 @@
+import json
+import queue
+import threading
+
+from typing import Iterator
+
+from workers.metrics import Metrics
+
+
+class EventBroadcaster:
+    """
+    Push channel of the dashboard, sent to the open pages as server-sent events.
+
+    Every page opens one /events stream and gets a queue here. An event is
+    serialized once and put in every queue, so the pages never poll and the
+    aggregates sent with an event are computed once, not once per page.
+
+    Events:
+        build_started: a job was leased by an agent
+        build_finished: a job is done or failed, with its batch if any
+        batch: a new batch, with the new stats of its project and the global stats
+
+    The subscribers live in the server process, the server must run a single
+    process (threads are fine) for every page to get every event.
+
+    """
+
+    # A page not reading its events is dropped, it reconnects and reloads
+    max_queued = 100
+
+    # Comment sent when nothing happened, so proxies keep the connection open
+    keepalive_seconds = 15
+
+    # Reconnection delay of the browser, in milliseconds
+    retry_ms = 5000
+
+    __subscribers: set[queue.Queue] = set()
+    __lock = threading.Lock()
+
+    @classmethod
+    def subscribe(cls) -> queue.Queue:
+        """
+        Add a subscriber, returns the queue its events are put in.
+
+        """
+        subscriber = queue.Queue(maxsize=cls.max_queued)
+
+        with cls.__lock:
+            cls.__subscribers.add(subscriber)
+            Metrics.event_subscribers.set(len(cls.__subscribers))
+
+        return subscriber
+
+    @classmethod
+    def unsubscribe(cls, subscriber: queue.Queue) -> None:
+        with cls.__lock:
+            cls.__subscribers.discard(subscriber)
+            Metrics.event_subscribers.set(len(cls.__subscribers))
+
+    @classmethod
+    def has_subscribers(cls) -> bool:
+        """
+        Whether a page listens, events costing queries are only built if so.
+
+        """
+        return bool(cls.__subscribers)
+
+    @classmethod
+    def publish(cls, event: str, data: dict) -> int:
+        """
+        Send an event to every subscriber.
+
+        Params:
+            event: the name of the event
+            data: the payload of the event, serialized as json
+
+        Returns:
+            The number of subscribers the event was sent to
+
+        """
+        message = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+        with cls.__lock:
+            subscribers = list(cls.__subscribers)
+
+        sent = 0
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+                sent += 1
+            except queue.Full:
+                # The page stopped reading, its stream is closed
+                cls.unsubscribe(subscriber)
+
+        Metrics.events_published_total.inc(event=event)
+
+        return sent
+
+    @classmethod
+    def stream(cls, subscriber: queue.Queue) -> Iterator[str]:
+        """
+        Body of the text/event-stream response of a subscriber.
+
+        The subscriber is removed once the page is closed.
+
+        """
+        try:
+            yield f"retry: {cls.retry_ms}\n\n"
+
+            while True:
+                try:
+                    yield subscriber.get(timeout=cls.keepalive_seconds)
+                except queue.Empty:
+                    with cls.__lock:
+                        if subscriber not in cls.__subscribers:
+                            return
+
+                    yield ": keepalive\n\n"
+        finally:
+            cls.unsubscribe(subscriber)
@@ -0,0 +1,48 @@
+import fcntl
+import os
+
+
+class FileLock:
+    """
+    Lock on a file, shared by the threads and processes of a host.
+
+    Used as a context manager:
+
+        with FileLock("projects/app/.venv.lock"):
+            ...
+
+    The lock is exclusive unless shared is set, shared locks are held together
+    and exclude an exclusive one. A lock taken without blocking raises
+    BlockingIOError when it is already held.
+
+    """
+
+    def __init__(self, path: str, shared: bool = False, blocking: bool = True):
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self.__file = None
+
+    def __enter__(self) -> "FileLock":
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            operation |= fcntl.LOCK_NB
+
+        # Each lock opens the file, flock locks are held per open file
+        self.__file = open(self.path, "a")
+
+        try:
+            fcntl.flock(self.__file, operation)
+        except OSError:
+            self.__file.close()
+            self.__file = None
+            raise
+
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
@@ -0,0 +1,155 @@
+import os
+
+import xml.etree.ElementTree as ET
+
+
+class FlakyTests:
+    """
+    Outcomes of test cases in junitxml reports, reruns of failed tests and
+    the quarantine list.
+
+    A failed test passing when rerun in the same build is flaky: its failure
+    element is renamed flakyFailure (flakyError for an error), like Maven
+    surefire does, and the counts of its test suite no longer include it.
+
+    A stage whose only failing tests are quarantined passes, the failures are
+    still saved with the batch.
+
+    Tests are named by their class and name, see test_name: two test classes
+    may have a method with the same name.
+
+    """
+
+    # Child element of a testcase -> outcome, by priority
+    __outcome_tags = {
+        "error": "error",
+        "failure": "failed",
+        "skipped": "skipped",
+        "flakyError": "flaky",
+        "flakyFailure": "flaky",
+    }
+
+    @classmethod
+    def outcome(cls, testcase: ET.Element) -> str:
+        """
+        Outcome of a testcase element: passed, failed, error, skipped or flaky.
+
+        """
+        for tag, outcome in cls.__outcome_tags.items():
+            if testcase.find(tag) is not None:
+                return outcome
+
+        return "passed"
+
+    @classmethod
+    def test_name(cls, testcase: ET.Element) -> str:
+        """
+        Name of a testcase element, qualified by its classname when it has one,
+        like "tests.test_app.TestLogin.test_logout".
+
+        """
+        classname, name = testcase.get("classname"), testcase.get("name")
+
+        return f"{classname}.{name}" if classname else name
+
+    @classmethod
+    def __read(cls, report_file: str) -> ET.ElementTree:
+        try:
+            return ET.parse(report_file)
+        except (OSError, ET.ParseError):
+            # The command crashed before writing a complete report
+            return None
+
+    @classmethod
+    def __testcases(cls, tree: ET.ElementTree) -> list[ET.Element]:
+        return list(tree.getroot().iter("testcase"))
+
+    @classmethod
+    def failed_tests(cls, report_files: list[str]) -> set[str]:
+        """
+        Names of the tests failed or in error in the given reports.
+
+        """
+        failed = set()
+
+        for report_file in report_files:
+            if (tree := cls.__read(report_file)) is None:
+                continue
+
+            failed.update(
+                cls.test_name(testcase)
+                for testcase in cls.__testcases(tree)
+                if cls.outcome(testcase) in ("failed", "error")
+            )
+
+        return failed
+
+    @classmethod
+    def apply_reruns(cls, report_files: list[str], rerun_files: list[str]) -> set[str]:
+        """
+        Mark the failed tests passing in a rerun as flaky, in the reports of a stage.
+
+        The reports are rewritten in place.
+
+        Params:
+            report_files: the reports of the first run of the stage
+            rerun_files: the reports of the reruns, of the failed tests only
+
+        Returns:
+            The names of the flaky tests
+
+        """
+        passed_on_rerun = set()
+
+        for rerun_file in rerun_files:
+            if (tree := cls.__read(rerun_file)) is None:
+                continue
+
+            passed_on_rerun.update(
+                cls.test_name(testcase)
+                for testcase in cls.__testcases(tree)
+                if cls.outcome(testcase) == "passed"
+            )
+
+        flaky = set()
+
+        for report_file in report_files:
+            if (tree := cls.__read(report_file)) is None:
+                continue
+
+            root = tree.getroot()
+            suites = [root] if root.tag == "testsuite" else root.iter("testsuite")
+            changed = False
+
+            for suite in suites:
+                for testcase in suite.findall("testcase"):
+                    if cls.test_name(testcase) not in passed_on_rerun:
+                        continue
+
+                    for tag, counter in (("failure", "failures"), ("error", "errors")):
+                        for element in testcase.findall(tag):
+                            element.tag = "flaky" + tag.capitalize()
+                            count = int(suite.get(counter, 0))
+                            suite.set(counter, str(max(count - 1, 0)))
+                            flaky.add(cls.test_name(testcase))
+                            changed = True
+
+            if changed:
+                tree.write(report_file, encoding="utf-8", xml_declaration=True)
+
+        return flaky
+
+    @classmethod
+    def rerun_files(cls, rerun_dir: str) -> list[str]:
+        """
+        Reports written by the reruns of a stage, in the order of the reruns.
+
+        """
+        if not os.path.isdir(rerun_dir):
+            return []
+
+        return [
+            os.path.join(rerun_dir, file)
+            for file in sorted(os.listdir(rerun_dir))
+            if file.endswith(".xml")
+        ]
@@ -0,0 +1,216 @@
+import gzip
+import io
+import json
+import sys
+
+from contextlib import contextmanager
+from typing import IO, Iterator
+
+from workers.database import DBWorker
+
+
+class History:
+    """
+    Export and import of the CI history (projects, batches, test cases, stage
+    timings, pipeline stages, flakiness counters and quarantined tests),
+    streamed a chunk of rows at a time.
+
+    Two formats, both line delimited json, gzipped when the file ends with .gz:
+
+        ndjson: one line per row, {"table": "test_cases", "id": 1, ...}
+        columnar: one line per chunk of rows of a table, the values stored
+            column by column, the id columns as differences with the
+            previous row. Much smaller once gzipped, and loaded by chunks
+            in analytics tools.
+
+    The first line of a file describes it, so imports detect the format.
+
+    """
+
+    formats = ("ndjson", "columnar")
+
+    # Columns stored as differences with the previous row in the columnar format
+    delta_columns = ("id", "project_id", "test_batch_id")
+
+    version = 1
+
+    @classmethod
+    @contextmanager
+    def __open(cls, path: str, mode: str) -> Iterator[IO[str]]:
+        """
+        Open a history file as text, "-" is stdin / stdout.
+
+        """
+        if path == "-":
+            yield sys.stdout if mode == "w" else sys.stdin
+            return
+
+        if path.endswith(".gz"):
+            with gzip.open(path, mode + "t", encoding="utf-8") as file:
+                yield file
+        else:
+            with open(path, mode, encoding="utf-8") as file:
+                yield file
+
+    @classmethod
+    def __encode_columns(cls, columns: tuple, rows: list[tuple]) -> dict:
+        values = [list(column) for column in zip(*rows)]
+        delta = []
+
+        for index, column in enumerate(columns):
+            column_values = values[index]
+
+            if column not in cls.delta_columns or None in column_values:
+                continue
+
+            values[index] = column_values[:1] + [
+                current - previous
+                for previous, current in zip(column_values, column_values[1:])
+            ]
+            delta.append(column)
+
+        return {"columns": list(columns), "delta": delta, "values": values}
+
+    @classmethod
+    def __decode_columns(cls, chunk: dict) -> list[tuple]:
+        columns, values = chunk["columns"], chunk["values"]
+
+        for column in chunk.get("delta", []):
+            column_values = values[columns.index(column)]
+
+            for index in range(1, len(column_values)):
+                column_values[index] += column_values[index - 1]
+
+        return list(zip(*values))
+
+    @classmethod
+    def export(
+        cls,
+        db_worker: DBWorker,
+        path: str,
+        format_: str = "ndjson",
+        chunk_size: int = 5000,
+    ) -> dict[str, int]:
+        """
+        Export the history of a database to a file.
+
+        Params:
+            db_worker: the database to export
+            path: the file to write, "-" for stdout
+            format_: ndjson or columnar
+            chunk_size: rows read from the database at a time
+
+        Returns:
+            A dict with the table name as key and the number of exported rows as value
+
+        """
+        if format_ not in cls.formats:
+            raise ValueError(f"unknown format: {format_}, use one of {', '.join(cls.formats)}")
+
+        snapshot = db_worker.get_history_snapshot()
+        counts = {}
+
+        with cls.__open(path, "w") as file:
+            header = {"history": "simple-ci", "version": cls.version, "format": format_}
+            file.write(json.dumps(header) + "\n")
+
+            for table, columns in DBWorker.history_tables.items():
+                counts[table] = 0
+
+                for rows in db_worker.iter_history_chunks(table, snapshot[table], chunk_size):
+                    counts[table] += len(rows)
+
+                    if format_ == "columnar":
+                        chunk = {"table": table, **cls.__encode_columns(columns, rows)}
+                        file.write(json.dumps(chunk, separators=(",", ":")) + "\n")
+                        continue
+
+                    file.writelines(
+                        json.dumps({"table": table, **dict(zip(columns, row))}) + "\n"
+                        for row in rows
+                    )
+
+        return counts
+
+    @classmethod
+    def import_(
+        cls, db_worker: DBWorker, path: str, chunk_size: int = 5000
+    ) -> dict[str, int]:
+        """
+        Import a history file in a database.
+
+        Rows keep their ids, rows already in the database are skipped.
+
+        Params:
+            db_worker: the database to import to
+            path: the file to read, "-" for stdin
+            chunk_size: rows written to the database at a time, for ndjson files
+
+        Returns:
+            A dict with the table name as key and the number of inserted rows as value
+
+        Raises:
+            ValueError if the file is not a history export
+
+        """
+        counts = {table: 0 for table in DBWorker.history_tables}
+
+        with cls.__open(path, "r") as file:
+            try:
+                header = json.loads(file.readline())
+            except json.JSONDecodeError:
+                header = None
+
+            if not isinstance(header, dict) or header.get("history") != "simple-ci":
+                raise ValueError(f"{path} is not a history export")
+
+            if header["version"] > cls.version:
+                raise ValueError(f"history version {header['version']} is not supported")
+
+            if header["format"] == "columnar":
+                chunks = cls.__read_columnar(file)
+            else:
+                chunks = cls.__read_ndjson(file, chunk_size)
+
+            for table, rows in chunks:
+                if table not in DBWorker.history_tables:
+                    raise ValueError(f"unknown table in history: {table}")
+
+                counts[table] += db_worker.insert_history_rows(table, rows)
+
+        return counts
+
+    @classmethod
+    def __read_columnar(cls, file: io.TextIOBase) -> Iterator[tuple[str, list[tuple]]]:
+        for line in file:
+            chunk = json.loads(line)
+            rows = cls.__decode_columns(chunk)
+
+            # Columns are given by the file, older exports may miss some
+            records = (dict(zip(chunk["columns"], row)) for row in rows)
+            columns = DBWorker.history_tables.get(chunk["table"], ())
+
+            yield chunk["table"], [
+                tuple(record.get(column) for column in columns) for record in records
+            ]
+
+    @classmethod
+    def __read_ndjson(
+        cls, file: io.TextIOBase, chunk_size: int
+    ) -> Iterator[tuple[str, list[tuple]]]:
+        table, rows = None, []
+
+        for line in file:
+            record = json.loads(line)
+
+            if rows and (record["table"] != table or len(rows) == chunk_size):
+                yield table, rows
+                rows = []
+
+            table = record["table"]
+            rows.append(
+                tuple(record.get(column) for column in DBWorker.history_tables.get(table, ()))
+            )
+
+        if rows:
+            yield table, rows
@@ -0,0 +1,213 @@
+import os
+import shutil
+import threading
+import time
+
+from dotenv import load_dotenv
+
+
+class MemoryUsage:
+    """
+    Peak memory of the commands of a build, see ProcessRunner.measure_memory.
+
+    The stages of a build run at the same time, the peak is the peak of
+    the memory used by all their process groups together.
+
+    """
+
+    def __init__(self):
+        self.peak = 0
+        self.__current: dict[int, int] = {}
+        self.__lock = threading.Lock()
+
+    def update(self, process_group: int, memory: int) -> None:
+        with self.__lock:
+            self.__current[process_group] = memory
+            self.peak = max(self.peak, sum(self.__current.values()))
+
+    def finish(self, process_group: int) -> None:
+        with self.__lock:
+            self.__current.pop(process_group, None)
+
+
+class HostResources:
+    """
+    Admission control of the builds on a build host.
+
+    Before leasing a job, an agent samples the load of the host, its
+    available memory and the free space of the disk of projects/ (venvs,
+    pip caches and checkouts are written there). No job is leased while a
+    threshold is crossed. Otherwise the memory left above the threshold is
+    the budget of the new build: the queue only leases the jobs of projects
+    whose last builds peaked under it.
+
+    A build does not use its memory right away, so the peak memory of the
+    builds leased during the last warmup_seconds is reserved: agents
+    leasing at the same time do not all count the same free memory.
+
+    The thresholds are read from the environment, 0 disables a check:
+
+        CI_ADMIT_MAX_LOAD           1 minute load average per CPU (1.5)
+        CI_ADMIT_MIN_FREE_MEMORY    MB of memory left to the host (512)
+        CI_ADMIT_MIN_FREE_DISK      MB of disk left in projects/ (2048)
+
+    """
+
+    load_dotenv()
+
+    max_load = float(os.getenv("CI_ADMIT_MAX_LOAD", 1.5))
+    min_free_memory = int(os.getenv("CI_ADMIT_MIN_FREE_MEMORY", 512)) * 1024 * 1024
+    min_free_disk = int(os.getenv("CI_ADMIT_MIN_FREE_DISK", 2048)) * 1024 * 1024
+
+    # Seconds a leased build keeps its peak memory reserved
+    warmup_seconds = float(os.getenv("CI_ADMIT_WARMUP_SECONDS", 60))
+
+    projects_dir = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "projects"
+    )
+
+    __page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    # (time, bytes) of the builds leased by the agents of this process
+    __reservations: list[tuple[float, int]] = []
+    __lock = threading.Lock()
+
+    @classmethod
+    def sample(cls) -> dict:
+        """
+        Sample the resources of the host.
+
+        Returns:
+            A dict with the 1 minute "load" per CPU, the "free_memory" and
+            the "free_disk" of projects/ in bytes, None when unknown.
+
+        """
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            load = None
+
+        try:
+            os.makedirs(cls.projects_dir, exist_ok=True)
+            free_disk = shutil.disk_usage(cls.projects_dir).free
+        except OSError:
+            free_disk = None
+
+        return {"load": load, "free_memory": cls.free_memory(), "free_disk": free_disk}
+
+    @classmethod
+    def free_memory(cls) -> int:
+        """
+        Memory available to new processes without swapping, in bytes, None when unknown.
+
+        """
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+        try:
+            return os.sysconf("SC_AVPHYS_PAGES") * cls.__page_size
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    @classmethod
+    def process_group_memory(cls, process_group: int) -> int:
+        """
+        Resident memory of the processes of a process group, in bytes.
+
+        Returns 0 when the processes can not be read (no /proc).
+
+        """
+        memory = 0
+
+        try:
+            entries = os.scandir("/proc")
+        except OSError:
+            return 0
+
+        with entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+
+                try:
+                    with open(f"/proc/{entry.name}/stat", "rb") as stat_file:
+                        stat = stat_file.read()
+                except OSError:
+                    # The process already exited
+                    continue
+
+                # The name of the command, in parentheses, may contain spaces
+                fields = stat[stat.rindex(b")") + 2 :].split()
+
+                # pgrp is the 5th field of stat, rss the 24th
+                if int(fields[2]) == process_group:
+                    memory += int(fields[21]) * cls.__page_size
+
+        return memory
+
+    @classmethod
+    def memory_budget(cls) -> tuple[(int, str)]:
+        """
+        Check if the host can run one more build.
+
+        Returns:
+            A tuple with the memory a new build may use in bytes, None for
+            no limit, and the reason the host is full, None if a build can
+            be leased.
+
+        """
+        resources = cls.sample()
+
+        load = resources["load"]
+
+        if cls.max_load and load is not None and load > cls.max_load:
+            return (None, f"load {load:.2f} per CPU above {cls.max_load}")
+
+        if (
+            cls.min_free_disk
+            and resources["free_disk"] is not None
+            and resources["free_disk"] < cls.min_free_disk
+        ):
+            return (None, f"{resources['free_disk'] // 2**20} MB of free disk left")
+
+        if not cls.min_free_memory or resources["free_memory"] is None:
+            return (None, None)
+
+        budget = resources["free_memory"] - cls.reserved_memory() - cls.min_free_memory
+
+        if budget <= 0:
+            return (None, f"{resources['free_memory'] // 2**20} MB of free memory left")
+
+        return (budget, None)
+
+    @classmethod
+    def reserve(cls, memory: int) -> None:
+        """
+        Reserve the peak memory of a build just leased, for warmup_seconds.
+
+        """
+        if not memory:
+            return
+
+        with cls.__lock:
+            cls.__reservations.append((time.monotonic(), memory))
+
+    @classmethod
+    def reserved_memory(cls) -> int:
+        """
+        Memory reserved by the builds leased during the last warmup_seconds, in bytes.
+
+        """
+        since = time.monotonic() - cls.warmup_seconds
+
+        with cls.__lock:
+            cls.__reservations[:] = [
+                reservation for reservation in cls.__reservations if reservation[0] > since
+            ]
+
+            return sum(memory for _, memory in cls.__reservations)
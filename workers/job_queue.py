@@ -0,0 +1,315 @@
+import hmac
+import logging
+import os
+import tomllib
+
+from dotenv import load_dotenv
+
+from workers.database import DBWorker
+from workers.event_broadcaster import EventBroadcaster
+from workers.matrix import BuildMatrix
+from workers.metrics import Metrics
+from workers.notifier import Notifier
+from workers.project_manager import ProjectManager
+from workers.runners import TestRunner
+
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Queue of build jobs, leased by local and remote build agents.
+
+    A webhook enqueues a job, an agent leases it and must send heartbeats
+    while the build runs. If the heartbeats stop (agent crashed, host lost ...)
+    the lease expires and the job goes back to the queue.
+
+    Jobs are not leased in FIFO order but by priority and fair share, read
+    from the [queue] table of the .simple-ci.toml file of each project:
+
+        [queue]
+        priority = 10       # higher first, 0 by default
+        weight = 2          # share of the agents, relative to the other projects, 1 by default
+        max_running = 3     # jobs of the project running at the same time
+
+    At the same priority, webhook builds go before scheduled builds, then
+    the project which used the least agent time (divided by its weight)
+    during the last fair_share_window seconds goes first. A webhook build
+    waiting for preempt_seconds preempts a running scheduled build: the
+    scheduled build goes back to the queue, its agent learns it from the
+    response of its next heartbeat and stops it.
+
+    """
+
+    load_dotenv()
+
+    # Seconds before a lease expires without heartbeat
+    lease_seconds = int(os.getenv("CI_AGENT_LEASE_SECONDS", 60))
+
+    # Number of leases a job is allowed before being marked as failed
+    max_attempts = int(os.getenv("CI_AGENT_MAX_ATTEMPTS", 3))
+
+    # Seconds of agent time history used to share the agents between the projects
+    fair_share_window = float(os.getenv("CI_QUEUE_FAIR_SHARE_WINDOW", 3600))
+
+    # Jobs of a project running at the same time, when its config does not say, 0 for no limit
+    max_running = int(os.getenv("CI_QUEUE_MAX_RUNNING", 0))
+
+    # Seconds a webhook build waits before preempting a scheduled build, 0 to never preempt
+    preempt_seconds = float(os.getenv("CI_QUEUE_PREEMPT_SECONDS", 30))
+
+    @classmethod
+    def queue_settings(cls, config: dict) -> dict:
+        """
+        Get the queue settings of a project.
+
+        Params:
+            config: the whole config of the project
+
+        Returns:
+            A {"priority", "weight", "max_running"} dict, max_running is None
+            when the project does not set it.
+
+        Raises:
+            ValueError: if a setting is invalid
+
+        """
+        queue = config.get("queue", {})
+
+        priority = queue.get("priority", 0)
+        weight = queue.get("weight", 1)
+        max_running = queue.get("max_running")
+
+        if not isinstance(priority, int):
+            raise ValueError("queue priority must be an integer")
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            raise ValueError("queue weight must be a positive number")
+        if max_running is not None and (not isinstance(max_running, int) or max_running < 1):
+            raise ValueError("queue max_running must be a positive integer")
+
+        return {"priority": priority, "weight": weight, "max_running": max_running}
+
+    @classmethod
+    def enqueue(
+        cls,
+        project_name: str,
+        branch: str,
+        commit_sha: str = None,
+        trigger: str = "webhook",
+        stages: list[str] = None,
+    ) -> int:
+        """
+        Queue a build of a project.
+
+        If the project declares a matrix, one job is queued per cell. The
+        matrix is read from the checkout of the server, the one of the
+        previous build.
+
+        Params:
+            project_name: name of the project
+            branch: the branch that triggered the build
+            commit_sha: the commit that triggered the build, if known
+            trigger: what queued the build, "webhook" or "schedule:<name>"
+            stages: the pipeline stages to run, all of them if None
+
+        Returns:
+            The id of the queued job, the id of the first job for a matrix
+            build, or None if the project does not exist.
+
+        """
+        db_worker = DBWorker()
+        project = db_worker.get_project(project_name.lower())
+
+        if project is None:
+            return None
+
+        project_folder = os.path.join(ProjectManager.parent_dir, "projects", project[1])
+
+        try:
+            config = TestRunner.load_config(project_folder)
+        except tomllib.TOMLDecodeError as e:
+            # The build reports the invalid config
+            logger.error(f"invalid config of {project[1]}: {e}")
+            config = {}
+
+        try:
+            settings = cls.queue_settings(config)
+        except ValueError as e:
+            logger.error(f"invalid queue settings of {project[1]}: {e}")
+            settings = cls.queue_settings({})
+
+        db_worker.set_project_queue_settings(project[0], **settings)
+
+        cells = BuildMatrix.cells(config)
+
+        if not cells:
+            return db_worker.enqueue_build_job(
+                project[0], branch, commit_sha, trigger, stages
+            )
+
+        job_ids = db_worker.enqueue_build_job_group(
+            project[0], branch, commit_sha, cells, trigger, stages
+        )
+        logger.info(f"matrix build of {project[1]}: {len(job_ids)} jobs queued")
+
+        return job_ids[0]
+
+    @classmethod
+    def lease(cls, agent: str, memory_budget: int = None) -> dict:
+        """
+        Lease the next job to an agent.
+
+        Expired leases are put back in the queue first.
+
+        Params:
+            agent: the name of the agent
+            memory_budget: the memory free on the host of the agent, in
+            bytes, see HostResources, None for no limit
+
+        Returns:
+            A dict with the job data, the quarantined tests and the peak memory
+            of the project, or None if the queue is empty.
+
+        """
+        db_worker = DBWorker()
+        db_worker.requeue_expired_build_jobs(cls.max_attempts)
+
+        job = db_worker.lease_build_job(
+            agent,
+            cls.lease_seconds,
+            cls.fair_share_window,
+            cls.max_running,
+            memory_budget,
+        )
+
+        if job is not None:
+            Notifier.build_started(job)
+
+            job["quarantine"] = db_worker.get_quarantined_tests(job["project_id"])
+            job["peak_memory"] = db_worker.get_project_peak_memory(job["project_id"])
+
+            EventBroadcaster.publish(
+                "build_started",
+                {
+                    "job_id": job["id"],
+                    "project_id": job["project_id"],
+                    "project_name": job["project_name"],
+                    "agent": agent,
+                },
+            )
+
+        return job
+
+    @classmethod
+    def heartbeat(cls, job_id: int, agent: str) -> bool:
+        """
+        Extend the lease of a job, unless it is a scheduled build preempted
+        by webhook builds.
+
+        Returns:
+            True if the agent still holds the lease, otherwise False and
+            the agent should abandon the build.
+
+        """
+        db_worker = DBWorker()
+
+        if cls.preempt_seconds and db_worker.preempt_build_job(
+            job_id, agent, cls.preempt_seconds, cls.fair_share_window, cls.max_running
+        ):
+            logger.info(f"job {job_id} preempted by webhook builds, back in the queue")
+            Metrics.builds_preempted_total.inc()
+            return False
+
+        return db_worker.extend_build_job_lease(job_id, agent, cls.lease_seconds)
+
+    @classmethod
+    def complete(
+        cls,
+        job_id: int,
+        success: bool,
+        message: str,
+        batch_id: int = None,
+        agent: str = None,
+    ) -> bool:
+        """
+        Mark a job as done or failed.
+
+        Params:
+            agent: the agent which built the job, nothing is done if another
+                agent holds the lease now
+
+        Returns:
+            True if the job was leased and is now finished, otherwise False.
+
+        """
+        status = "done" if success else "failed"
+
+        if finished := DBWorker().finish_build_job(
+            job_id, status, message, batch_id, agent
+        ):
+            Metrics.builds_total.inc(status=status)
+            cls.__publish_finished(job_id, status, message, batch_id)
+            Notifier.build_finished(job_id, status, message, batch_id)
+
+        return finished
+
+    @classmethod
+    def __publish_finished(
+        cls, job_id: int, status: str, message: str, batch_id: int
+    ) -> None:
+        """
+        Push the end of a build to the dashboard, with its batch and the new stats.
+
+        """
+        if not EventBroadcaster.has_subscribers():
+            return
+
+        db_worker = DBWorker()
+        project_id = db_worker.get_build_job(job_id)["project_id"]
+
+        EventBroadcaster.publish(
+            "build_finished",
+            {
+                "job_id": job_id,
+                "project_id": project_id,
+                "status": status,
+                "message": message,
+                "batch_id": batch_id,
+            },
+        )
+
+        if batch_id is None:
+            return
+
+        # Computed once for every open page
+        EventBroadcaster.publish(
+            "batch",
+            {
+                "project_id": project_id,
+                "batch": db_worker.get_test_batch(batch_id),
+                "diff": db_worker.get_batch_diff_counts(batch_id),
+                "project_stats": db_worker.get_project_statistics(project_id),
+                "stats": db_worker.get_tests_statistics(),
+            },
+        )
+
+    @classmethod
+    def verify_agent_token(cls, token: str) -> bool:
+        """
+        Verify the token sent by a remote build agent.
+
+        Returns:
+            False if the token is invalid, missing or not configured
+            True if the token is valid
+
+        """
+        load_dotenv()
+
+        agent_token = os.getenv("CI_AGENT_TOKEN")
+
+        if not agent_token or token is None:
+            return False
+
+        # We use the compare_digest method to prevent timing attacks
+        return hmac.compare_digest(agent_token, token)
@@ -0,0 +1,234 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from dotenv import load_dotenv
+
+
+# Ids describing what the current thread works on (project, build, delivery ...)
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar(
+    "log_context", default={}
+)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attach the current log context to each record.
+
+    Runs in the thread that logs, before the record is put in the queue.
+
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = _log_context.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line.
+
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        # Ids that are not known, like the delivery of a dashboard request, are left out
+        context = getattr(record, "context", {})
+        entry.update((key, value) for key, value in context.items() if value is not None)
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Human readable format, with the log context appended to the message.
+
+    """
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+
+        context = getattr(record, "context", {})
+
+        if fields := [f"{key}={value}" for key, value in context.items() if value is not None]:
+            line += " - " + " ".join(fields)
+
+        return line
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotate the log file when it reaches a size or when it gets too old,
+    whichever comes first.
+
+    """
+
+    def __init__(
+        self, filename: str, max_bytes: int, max_age: float, backup_count: int
+    ):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        self.max_age = max_age
+        self.opened_at = self.__created_at(self.baseFilename)
+
+    @staticmethod
+    def __created_at(filename: str) -> float:
+        # The age of an existing file counts from before a restart, with its
+        # creation time where the platform keeps it, else its last write
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return time.time()
+
+        return min(getattr(stat, "st_birthtime", stat.st_mtime), time.time())
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() - self.opened_at >= self.max_age:
+            return True
+
+        return super().shouldRollover(record)
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+class LogPipeline:
+    """
+    Non blocking logging pipeline.
+
+    Loggers only put records in an unbounded queue, a background listener
+    thread formats them and writes them to the configured sinks. Logging
+    therefore never waits on a disk write while serving a webhook.
+
+    Sinks are selected with CI_LOG_SINKS (comma separated), new sinks can
+    be added with register_sink.
+
+    """
+
+    load_dotenv()
+
+    log_file = os.getenv("CI_LOG_FILE", "flask-app.log")
+    max_bytes = int(os.getenv("CI_LOG_MAX_BYTES", 10 * 1024 * 1024))
+    max_age = float(os.getenv("CI_LOG_ROTATE_HOURS", 24)) * 3600
+    backup_count = int(os.getenv("CI_LOG_BACKUP_COUNT", 7))
+
+    __sinks: dict[str, Callable[[], logging.Handler]] = {}
+    __listener: logging.handlers.QueueListener = None
+
+    @classmethod
+    def register_sink(cls, name: str, factory: Callable[[], logging.Handler]) -> None:
+        """
+        Make a sink available to CI_LOG_SINKS.
+
+        Params:
+            name: name of the sink in CI_LOG_SINKS
+            factory: function returning the handler writing to the sink
+
+        """
+        cls.__sinks[name] = factory
+
+    @classmethod
+    def setup(cls, default_sinks: str = "file,stderr") -> None:
+        """
+        Route the records of every logger through the queue to the sinks.
+
+        """
+        if cls.__listener is not None:
+            return
+
+        sink_names = os.getenv("CI_LOG_SINKS", default_sinks).split(",")
+        handlers = [cls.__sinks[name.strip()]() for name in sink_names if name.strip()]
+
+        log_queue = queue.SimpleQueue()
+
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(ContextFilter())
+
+        root_logger = logging.getLogger()
+        root_logger.setLevel(logging.INFO)
+        root_logger.addHandler(queue_handler)
+
+        cls.__listener = logging.handlers.QueueListener(
+            log_queue, *handlers, respect_handler_level=True
+        )
+        cls.__listener.start()
+
+        # Flush the queue when the process exits
+        atexit.register(cls.__listener.stop)
+
+    @classmethod
+    def bind(cls, **fields) -> contextvars.Token:
+        """
+        Add ids to the log context of the current thread.
+
+        Returns:
+            A token to restore the previous context with unbind.
+
+        """
+        return _log_context.set({**_log_context.get(), **fields})
+
+    @classmethod
+    def unbind(cls, token: contextvars.Token) -> None:
+        _log_context.reset(token)
+
+    @classmethod
+    @contextmanager
+    def context(cls, **fields) -> Iterator[None]:
+        """
+        Add ids to the log context for the duration of a block.
+
+        """
+        token = cls.bind(**fields)
+
+        try:
+            yield
+        finally:
+            cls.unbind(token)
+
+
+def _file_sink() -> logging.Handler:
+    handler = SizeAndTimeRotatingFileHandler(
+        LogPipeline.log_file,
+        LogPipeline.max_bytes,
+        LogPipeline.max_age,
+        LogPipeline.backup_count,
+    )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def _stream_sink(stream) -> Callable[[], logging.Handler]:
+    def factory() -> logging.Handler:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(TextFormatter())
+        return handler
+
+    return factory
+
+
+LogPipeline.register_sink("file", _file_sink)
+LogPipeline.register_sink("stderr", _stream_sink(sys.stderr))
+LogPipeline.register_sink("stdout", _stream_sink(sys.stdout))
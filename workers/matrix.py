@@ -0,0 +1,101 @@
+import hashlib
+import json
+
+
+class BuildMatrix:
+    """
+    Build matrix of a project, read from the [matrix] table of its
+    .simple-ci.toml file:
+
+        [matrix]
+        python = ["3.11", "3.12"]
+        env = [{ DJANGO = "4.2" }, { DJANGO = "5.0" }]
+
+    Each cell of the matrix (a python version x an env set) is built as its
+    own job, so cells run in parallel on the available agents. A cell has its
+    own venv, kept between builds, and its own reports folder.
+
+    """
+
+    @classmethod
+    def cells(cls, config: dict) -> list[dict]:
+        """
+        Get the cells of the matrix.
+
+        Params:
+            config: the whole config of the project
+
+        Returns:
+            A list of {"python": version or None, "env": dict} cells,
+            empty if the project has no matrix.
+
+        """
+        matrix = config.get("matrix", {})
+
+        pythons = [str(python) for python in matrix.get("python", [])]
+        env_sets = [
+            {name: str(value) for name, value in env_set.items()}
+            for env_set in matrix.get("env", [])
+        ]
+
+        if not pythons and not env_sets:
+            return []
+
+        return [
+            {"python": python, "env": env_set}
+            for python in pythons or [None]
+            for env_set in env_sets or [{}]
+        ]
+
+    @classmethod
+    def name(cls, cell: dict) -> str:
+        """
+        Human readable name of a cell, like "python 3.12, DJANGO=5.0".
+
+        """
+        if cell is None:
+            return "default"
+
+        parts = [f"python {cell['python']}"] if cell.get("python") else []
+        parts += [f"{name}={value}" for name, value in sorted(cell["env"].items())]
+
+        return ", ".join(parts) or "default"
+
+    @classmethod
+    def slug(cls, cell: dict) -> str:
+        """
+        Name of a cell usable as a folder name, like "py3.12-1f2e3d4c".
+
+        """
+        parts = [f"py{cell['python']}"] if cell.get("python") else []
+
+        if cell["env"]:
+            env = json.dumps(cell["env"], sort_keys=True).encode()
+            parts.append(hashlib.sha1(env).hexdigest()[:8])
+
+        return "-".join(parts)
+
+    @classmethod
+    def venv_name(cls, cell: dict) -> str:
+        """
+        Folder of the venv of a cell in the project folder, ".venv" without matrix.
+
+        """
+        if cell is None:
+            return ".venv"
+
+        return f".venv-{cls.slug(cell)}"
+
+    @classmethod
+    def python_executable(cls, cell: dict) -> str:
+        """
+        Interpreter creating the venv of a cell: "3.12" is python3.12,
+        other values like "pypy3" are used as is.
+
+        """
+        python = cell.get("python") if cell else None
+
+        if python is None:
+            return "python3"
+
+        return f"python{python}" if python[0].isdigit() else python
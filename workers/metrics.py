@@ -0,0 +1,294 @@
+import functools
+import inspect
+import threading
+import time
+
+from typing import Callable
+
+
+def _format_labels(labels: dict) -> str:
+    """
+    Format labels like {project="demo",stage="fetch"}, escaped as Prometheus expects.
+
+    """
+    if not labels:
+        return ""
+
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    """
+    Value that only goes up, like the number of webhooks received.
+
+    """
+
+    type_ = "counter"
+
+    def __init__(self, name: str, help_: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+
+        return [
+            f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {value}"
+            for key, value in values
+        ]
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, like the number of queued builds.
+
+    """
+
+    type_ = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """
+    Distribution of observed values, like the duration of build stages.
+
+    Only the bucket counts, the sum and the count are kept in memory.
+
+    """
+
+    type_ = "histogram"
+
+    # Default buckets, in seconds, suited to requests and queries
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(
+        self, name: str, help_: str, labelnames: tuple = (), buckets: tuple = None
+    ):
+        self.name = name
+        self.help = help_
+        self.labelnames = labelnames
+        self.buckets = buckets or self.buckets
+
+        # Label values -> [count per bucket ..., sum, count]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labelnames)
+
+        with self._lock:
+            if (state := self._values.get(key)) is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+
+        samples = []
+
+        for key, state in values:
+            labels = dict(zip(self.labelnames, key))
+
+            for bound, count in zip(self.buckets, state):
+                bucket_labels = _format_labels({**labels, "le": bound})
+                samples.append(f"{self.name}_bucket{bucket_labels} {count}")
+
+            inf_labels = _format_labels({**labels, "le": "+Inf"})
+            samples.append(f"{self.name}_bucket{inf_labels} {state[-1]}")
+            samples.append(f"{self.name}_sum{_format_labels(labels)} {state[-2]}")
+            samples.append(f"{self.name}_count{_format_labels(labels)} {state[-1]}")
+
+        return samples
+
+
+class Metrics:
+    """
+    Metrics of the CI server, exposed at /metrics in the Prometheus text format.
+
+    Values are aggregated in the server process, a counter increment
+    or a histogram observation is a dict update under a lock.
+
+    """
+
+    # Buckets for builds, from a few seconds to half an hour
+    build_buckets = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+    queue_depth = Gauge("ci_queue_depth", "Number of builds waiting for an agent.")
+
+    builds_in_flight = Gauge(
+        "ci_builds_in_flight", "Number of builds leased by an agent."
+    )
+
+    builds_total = Counter(
+        "ci_builds_total", "Number of finished builds.", ("status",)
+    )
+
+    builds_preempted_total = Counter(
+        "ci_builds_preempted_total",
+        "Number of scheduled builds put back in the queue for webhook builds.",
+    )
+
+    build_stage_duration = Histogram(
+        "ci_build_stage_duration_seconds",
+        "Duration of each stage of a build.",
+        ("project", "stage"),
+        build_buckets,
+    )
+
+    build_duration = Histogram(
+        "ci_build_duration_seconds",
+        "Duration of a build, all stages included.",
+        ("project",),
+        build_buckets,
+    )
+
+    http_request_duration = Histogram(
+        "ci_http_request_duration_seconds",
+        "Time spent handling a request, the webhook endpoint is 'test'.",
+        ("endpoint",),
+    )
+
+    http_requests_total = Counter(
+        "ci_http_requests_total", "Number of handled requests.", ("endpoint", "status")
+    )
+
+    db_query_duration = Histogram(
+        "ci_db_query_duration_seconds",
+        "Duration of each DBWorker method.",
+        ("method",),
+    )
+
+    cache_requests_total = Counter(
+        "ci_cache_requests_total",
+        "Number of cache lookups, by cache and result (hit or miss).",
+        ("cache", "result"),
+    )
+
+    event_subscribers = Gauge(
+        "ci_event_subscribers", "Number of dashboard pages listening to /events."
+    )
+
+    events_published_total = Counter(
+        "ci_events_published_total", "Number of events pushed to the dashboard.", ("event",)
+    )
+
+    notifications_pending = Gauge(
+        "ci_notifications_pending", "Number of notifications waiting in the outbox."
+    )
+
+    notifications_total = Counter(
+        "ci_notifications_total",
+        "Number of notification attempts, by kind and result (sent, retry or failed).",
+        ("kind", "result"),
+    )
+
+    @classmethod
+    def all(cls) -> list:
+        return [
+            value
+            for value in vars(cls).values()
+            if isinstance(value, (Counter, Histogram))
+        ]
+
+    @classmethod
+    def render(cls) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        """
+        lines = []
+
+        for metric in cls.all():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_}")
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def time_db_methods(cls, target: type) -> type:
+        """
+        Class decorator observing the duration of every public method of DBWorker.
+
+        """
+        for name, method in list(vars(target).items()):
+            if name.startswith("_") or not callable(method):
+                continue
+
+            setattr(target, name, cls.__timed(name, method))
+
+        return target
+
+    @classmethod
+    def __timed(cls, name: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                cls.db_query_duration.observe(time.perf_counter() - start, method=name)
+                raise
+
+            elapsed = time.perf_counter() - start
+
+            # The query of an iter_* method runs while its rows are iterated
+            if inspect.isgenerator(result):
+                return cls.__timed_iteration(name, result, elapsed)
+
+            cls.db_query_duration.observe(elapsed, method=name)
+
+            return result
+
+        return wrapper
+
+    @classmethod
+    def __timed_iteration(cls, name: str, generator, elapsed: float):
+        # Only the time spent in the generator is summed, not the time of the
+        # caller between two rows, and observed once it is exhausted or closed
+        try:
+            while True:
+                start = time.perf_counter()
+
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+
+                yield item
+        finally:
+            start = time.perf_counter()
+            generator.close()
+            elapsed += time.perf_counter() - start
+
+            cls.db_query_duration.observe(elapsed, method=name)
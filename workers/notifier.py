@@ -0,0 +1,489 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import tomllib
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+from workers.database import DBWorker
+from workers.matrix import BuildMatrix
+from workers.metrics import Metrics
+from workers.project_manager import ProjectManager
+from workers.runners import TestRunner
+
+
+logger = logging.getLogger(__name__)
+
+
+class HttpPool:
+    """
+    Keep-alive HTTP connections, reused between the requests to the same host.
+
+    """
+
+    def __init__(self, timeout: float = 10, max_idle: int = 4):
+        """
+        Params:
+            timeout: seconds to connect, and to wait for each read of a response
+            max_idle: idle connections kept per host
+
+        """
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self.__idle: dict[tuple, list] = {}
+        self.__lock = threading.Lock()
+
+    def __acquire(self, scheme: str, netloc: str) -> tuple:
+        with self.__lock:
+            if idle := self.__idle.get((scheme, netloc)):
+                return (idle.pop(), True)
+
+        # Only the processes sending notifications pay for the import
+        import http.client
+
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+        return (connection, False)
+
+    def __release(self, scheme: str, netloc: str, connection) -> None:
+        with self.__lock:
+            idle = self.__idle.setdefault((scheme, netloc), [])
+
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def post(self, url: str, body: bytes, headers: dict) -> tuple[(int, dict)]:
+        """
+        Send a POST request.
+
+        Returns:
+            A tuple with the status and the headers of the response
+
+        Raises:
+            OSError or http.client.HTTPException: if the request failed
+
+        """
+        import http.client
+
+        parts = urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+
+        while True:
+            connection, reused = self.__acquire(parts.scheme, parts.netloc)
+
+            try:
+                connection.request("POST", path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+
+                # The server closed the idle connection, a new one is opened
+                if reused:
+                    continue
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.__release(parts.scheme, parts.netloc, connection)
+
+            return (response.status, dict(response.headers))
+
+    def close(self) -> None:
+        with self.__lock:
+            connections = [
+                connection for idle in self.__idle.values() for connection in idle
+            ]
+            self.__idle.clear()
+
+        for connection in connections:
+            connection.close()
+
+
+class Notifier:
+    """
+    Send the results of the builds outside of the dashboard: commit statuses
+    to GitHub, and build summaries to the endpoints of the [[notifications]]
+    tables of the .simple-ci.toml file of a project:
+
+        [[notifications]]
+        url = "https://chat.example.com/hooks/ci"
+        on = "failure"          # "always" by default
+
+    Commit statuses are sent when CI_GITHUB_TOKEN is set, for the builds
+    of a known commit: pending when an agent leases the build, then
+    success, failure (failed tests) or error (the build did not finish).
+
+    Notifications are written to an outbox table by the job queue, and
+    sent by a dispatcher thread: a slow or failing endpoint never blocks a
+    build. Each round, the dispatcher sends the due notifications over
+    keep-alive connections, the summaries for the same endpoint in one
+    {"builds": [...]} request, and only the last status of each commit: a
+    new status supersedes the older ones not sent yet, even those waiting
+    for a retry, so a late pending status never overwrites a final one.
+    Failed requests are retried with an exponential backoff, up to
+    CI_NOTIFY_MAX_ATTEMPTS times, the outbox survives restarts.
+
+    """
+
+    load_dotenv()
+
+    github_token = os.getenv("CI_GITHUB_TOKEN")
+    github_api_url = os.getenv("CI_GITHUB_API_URL", "https://api.github.com")
+
+    # Name of the commit statuses, matrix builds add the name of their cell
+    status_context = os.getenv("CI_STATUS_CONTEXT", "simple-ci")
+
+    # Seconds to wait for an endpoint
+    timeout = float(os.getenv("CI_NOTIFY_TIMEOUT", 10))
+
+    # Attempts before a notification is given up
+    max_attempts = int(os.getenv("CI_NOTIFY_MAX_ATTEMPTS", 8))
+
+    # Delay before the first retry, doubled after each failed attempt
+    retry_seconds = float(os.getenv("CI_NOTIFY_RETRY_SECONDS", 5))
+    max_retry_seconds = 3600
+
+    # Notifications claimed by round, and endpoints called at the same time
+    batch_size = 100
+    max_workers = 4
+
+    # Seconds between two rounds when nothing wakes the dispatcher up
+    interval = 5
+
+    __pool = None
+    __pool_lock = threading.Lock()
+
+    __wake_event = threading.Event()
+    __stop_event = threading.Event()
+
+    @classmethod
+    def endpoints(cls, config: dict) -> list[dict]:
+        """
+        Get the notification endpoints of a project.
+
+        Params:
+            config: the whole config of the project
+
+        Returns:
+            A list of {"url", "on"} dicts
+
+        Raises:
+            ValueError: if an endpoint is invalid
+
+        """
+        endpoints = []
+
+        for endpoint in config.get("notifications", []):
+            url = endpoint.get("url")
+            on = endpoint.get("on", "always")
+
+            if not isinstance(url, str) or urlsplit(url).scheme not in ("http", "https"):
+                raise ValueError("notifications must have an http or https url")
+            if on not in ("always", "failure"):
+                raise ValueError(f"on of notification {url} must be always or failure")
+
+            endpoints.append({"url": url, "on": on})
+
+        return endpoints
+
+    @classmethod
+    def state(cls, status: str, batch: dict) -> str:
+        """
+        State of the commit status of a finished build.
+
+        Params:
+            status: the status of the job, "done" or "failed"
+            batch: the batch of the build, if any
+
+        """
+        if status != "done":
+            return "error"
+
+        if batch is not None and (int(batch["failures"]) or int(batch["errors"])):
+            return "failure"
+
+        return "success"
+
+    @classmethod
+    def commit_status(cls, job: dict, state: str, description: str) -> tuple[(str, dict)]:
+        """
+        Commit status of a build.
+
+        Returns:
+            A tuple with the url and the payload of the status, or None if
+            the status can not be sent (no token, commit or GitHub repository)
+
+        """
+        if not cls.github_token or not job.get("commit_sha"):
+            return None
+
+        match = re.search(
+            r"github\.com[/:]([^/]+)/([^/]+?)(?:\.git)?/?$", job.get("github_url") or ""
+        )
+        if match is None:
+            return None
+
+        owner, repository = match.groups()
+        context = cls.status_context
+
+        if job.get("matrix") is not None:
+            context += f" ({BuildMatrix.name(job['matrix'])})"
+
+        return (
+            f"{cls.github_api_url.rstrip('/')}/repos/{owner}/{repository}/statuses/{job['commit_sha']}",
+            # GitHub cuts descriptions at 140 characters
+            {"state": state, "description": description[:140], "context": context},
+        )
+
+    @classmethod
+    def build_started(cls, job: dict) -> None:
+        """
+        Queue the pending status of a build just leased.
+
+        """
+        try:
+            if (status := cls.commit_status(job, "pending", "Build started")) is not None:
+                cls.__queue([(job["project_id"], "commit_status", *status)])
+        except Exception:
+            logger.exception(f"could not queue the status of job {job['id']}")
+
+    @classmethod
+    def build_finished(cls, job_id: int, status: str, message: str, batch_id: int) -> None:
+        """
+        Queue the commit status and the summaries of a finished build.
+
+        """
+        try:
+            db_worker = DBWorker()
+            job = db_worker.get_build_job(job_id)
+            batch = db_worker.get_test_batch(batch_id) if batch_id is not None else None
+            state = cls.state(status, batch)
+
+            notifications = []
+
+            if (commit_status := cls.commit_status(job, state, message)) is not None:
+                notifications.append((job["project_id"], "commit_status", *commit_status))
+
+            summary = {
+                "project": job["project_name"],
+                "job_id": job_id,
+                "branch": job["branch"],
+                "commit_sha": job["commit_sha"],
+                "trigger": job["trigger"],
+                "matrix": job["matrix"],
+                "state": state,
+                "message": message,
+                "batch": batch,
+            }
+
+            for endpoint in cls.__project_endpoints(job["project_name"]):
+                if endpoint["on"] == "always" or state != "success":
+                    notifications.append(
+                        (job["project_id"], "summary", endpoint["url"], summary)
+                    )
+
+            cls.__queue(notifications)
+        except Exception:
+            # The build is finished whatever happens to its notifications
+            logger.exception(f"could not queue the notifications of job {job_id}")
+
+    @classmethod
+    def __project_endpoints(cls, project_name: str) -> list[dict]:
+        project_folder = os.path.join(ProjectManager.parent_dir, "projects", project_name)
+
+        try:
+            return cls.endpoints(TestRunner.load_config(project_folder))
+        except (tomllib.TOMLDecodeError, ValueError) as e:
+            logger.error(f"invalid notifications of {project_name}: {e}")
+            return []
+
+    @classmethod
+    def __queue(cls, notifications: list[tuple]) -> None:
+        if not notifications:
+            return
+
+        DBWorker().insert_notifications(
+            [
+                (
+                    project_id,
+                    kind,
+                    url,
+                    json.dumps(payload, default=str),
+                    # A status replaces the previous one of its commit and context
+                    f"{url} {payload['context']}" if kind == "commit_status" else None,
+                )
+                for project_id, kind, url, payload in notifications
+            ]
+        )
+        cls.__wake_event.set()
+
+    @classmethod
+    def __http_pool(cls) -> HttpPool:
+        with cls.__pool_lock:
+            if cls.__pool is None:
+                cls.__pool = HttpPool(cls.timeout)
+
+            return cls.__pool
+
+    @classmethod
+    def retry_delay(cls, attempts: int, retry_after: str = None) -> float:
+        """
+        Seconds before the next attempt to send a notification.
+
+        The delay doubles after each failed attempt, with some jitter so the
+        retries of many notifications do not all hit an endpoint together.
+        An endpoint asking to wait longer with Retry-After is obeyed.
+
+        Params:
+            attempts: the failed attempts so far
+            retry_after: the Retry-After header of the last response, if any
+
+        """
+        delay = min(cls.retry_seconds * 2 ** (attempts - 1), cls.max_retry_seconds)
+        delay *= random.uniform(0.5, 1)
+
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), cls.max_retry_seconds))
+
+        return delay
+
+    @classmethod
+    def dispatch(cls) -> int:
+        """
+        Send the notifications which are due.
+
+        Returns:
+            The number of notifications handled, sent or not
+
+        """
+        db_worker = DBWorker()
+        notifications = db_worker.claim_notifications(
+            cls.batch_size, cls.timeout * 2 + 30
+        )
+
+        if not notifications:
+            return 0
+
+        # Only the last status of each commit matters
+        statuses, superseded = {}, []
+
+        for notification in notifications:
+            if notification["kind"] != "commit_status":
+                continue
+
+            key = (notification["url"], json.loads(notification["payload"])["context"])
+
+            if key in statuses:
+                superseded.append(statuses[key]["id"])
+            statuses[key] = notification
+
+        if superseded:
+            db_worker.finish_notifications(superseded, "superseded")
+
+        requests = [[notification] for notification in statuses.values()]
+
+        # The summaries for the same endpoint are sent together
+        summaries = {}
+        for notification in notifications:
+            if notification["kind"] == "summary":
+                summaries.setdefault(notification["url"], []).append(notification)
+
+        requests += summaries.values()
+
+        with ThreadPoolExecutor(max_workers=cls.max_workers) as executor:
+            list(executor.map(cls.__send, requests))
+
+        return len(notifications)
+
+    @classmethod
+    def __send(cls, notifications: list[dict]) -> None:
+        """
+        Send notifications of the same kind to the same url in one request.
+
+        """
+        kind, url = notifications[0]["kind"], notifications[0]["url"]
+        headers = {"Content-Type": "application/json", "User-Agent": "simple-ci"}
+
+        if kind == "commit_status":
+            body = notifications[0]["payload"]
+            headers["Accept"] = "application/vnd.github+json"
+            headers["Authorization"] = f"Bearer {cls.github_token}"
+        else:
+            body = f'{{"builds": [{", ".join(n["payload"] for n in notifications)}]}}'
+
+        retry_after, permanent = None, False
+
+        try:
+            status, response_headers = cls.__http_pool().post(url, body.encode(), headers)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if 200 <= status < 300:
+                DBWorker().finish_notifications([n["id"] for n in notifications], "sent")
+                Metrics.notifications_total.inc(len(notifications), kind=kind, result="sent")
+                return
+
+            error = f"HTTP {status}"
+            retry_after = response_headers.get("Retry-After")
+            # The request itself is wrong, sending it again will not help
+            permanent = 400 <= status < 500 and status not in (408, 429)
+
+        db_worker = DBWorker()
+
+        for notification in notifications:
+            attempts = notification["attempts"] + 1
+
+            if permanent or attempts >= cls.max_attempts:
+                logger.error(f"{kind} notification {notification['id']} to {url} failed: {error}")
+                db_worker.finish_notifications([notification["id"]], "failed", error)
+                Metrics.notifications_total.inc(kind=kind, result="failed")
+            else:
+                db_worker.retry_notification(
+                    notification["id"],
+                    time.time() + cls.retry_delay(attempts, retry_after),
+                    error,
+                )
+                Metrics.notifications_total.inc(kind=kind, result="retry")
+
+    @classmethod
+    def run_forever(cls) -> None:
+        """
+        Send the notifications as they are queued, until stop is called.
+
+        """
+        cls.__stop_event.clear()
+
+        while not cls.__stop_event.is_set():
+            try:
+                handled = cls.dispatch()
+            except Exception:
+                logger.exception("notification dispatch failed")
+                handled = 0
+
+            # More notifications may be due right away
+            if handled >= cls.batch_size:
+                continue
+
+            cls.__wake_event.wait(cls.interval)
+            cls.__wake_event.clear()
+
+    @classmethod
+    def stop(cls) -> None:
+        cls.__stop_event.set()
+        cls.__wake_event.set()
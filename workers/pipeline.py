@@ -0,0 +1,315 @@
+import contextvars
+import hashlib
+import logging
+import os
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+from workers.matrix import BuildMatrix
+from workers.runners import TestRunner
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """
+    Stages of a build, declared in the .simple-ci.toml file of a project.
+
+        [stages.lint]
+        command = "ruff check ."
+
+        [stages.unit]
+        tests = "tests/unit"
+
+        [stages.integration]
+        tests = "tests/integration"
+        needs = ["unit"]
+
+        [pipeline]
+        max_parallel = 2            # stages running at the same time, all by default
+
+    A stage is a test runner (see runners.py) using the [runner] table as
+    defaults, plus the stages it needs. Stages whose needs passed run at the
+    same time, the stages needing a failed stage are skipped.
+
+    Without [stages], the pipeline has a single "test" stage, the [runner].
+
+    """
+
+    default_stage = "test"
+
+    def __init__(
+        self,
+        runners: dict[str, TestRunner],
+        needs: dict[str, list[str]],
+        max_parallel: int = None,
+    ):
+        self.runners = runners
+        self.needs = needs
+        self.max_parallel = max(max_parallel or len(runners), 1)
+
+        self.order = self.__sort_stages(needs)
+
+    @classmethod
+    def for_project(
+        cls,
+        project_folder: str,
+        test_file: str,
+        config: dict = None,
+        cell: dict = None,
+        only_stages: list[str] = None,
+    ) -> "Pipeline":
+        """
+        Get the pipeline configured for a project.
+
+        Params:
+            project_folder: path of the project
+            test_file: the test file saved with the project
+            config: the whole config, read from the project config file if None
+            cell: the matrix cell built, see matrix.py
+            only_stages: the stages to run and the stages they need, all of them if None
+
+        Raises:
+            ValueError if a backend does not exist, or if the needs of the
+            stages are unknown or circular
+
+        """
+        if config is None:
+            config = TestRunner.load_config(project_folder)
+
+        defaults = config.get("runner", {})
+        stages = config.get("stages") or {cls.default_stage: {}}
+
+        if only_stages is not None:
+            stages = cls.__select_stages(stages, only_stages)
+
+        runners, needs = {}, {}
+
+        for stage, stage_config in stages.items():
+            stage_config = dict(stage_config)
+            needs[stage] = list(stage_config.pop("needs", []))
+
+            # Cells of a matrix run at the same time, each one writes its own reports
+            if cell is not None:
+                reports_name = os.path.join(BuildMatrix.slug(cell), stage)
+            else:
+                reports_name = stage
+
+            runners[stage] = TestRunner.for_project(
+                project_folder, test_file, {**defaults, **stage_config}, reports_name
+            )
+
+            if cell is not None:
+                runners[stage].env.update(cell["env"])
+
+        return cls(runners, needs, config.get("pipeline", {}).get("max_parallel"))
+
+    @staticmethod
+    def __select_stages(stages: dict[str, dict], selected: list[str]) -> dict[str, dict]:
+        """
+        Keep the selected stages and the stages they need.
+
+        Raises:
+            ValueError if a selected stage does not exist
+
+        """
+        kept, pending = set(), list(selected)
+
+        while pending:
+            stage = pending.pop()
+
+            if stage not in stages:
+                raise ValueError(f"unknown stage {stage}")
+
+            if stage not in kept:
+                kept.add(stage)
+                pending.extend(stages[stage].get("needs", []))
+
+        return {stage: config for stage, config in stages.items() if stage in kept}
+
+    @staticmethod
+    def __sort_stages(needs: dict[str, list[str]]) -> list[str]:
+        """
+        Order the stages so that each stage comes after the stages it needs.
+
+        Raises:
+            ValueError if a stage needs an unknown stage or if needs are circular
+
+        """
+        for stage, stage_needs in needs.items():
+            for need in stage_needs:
+                if need not in needs:
+                    raise ValueError(f"stage {stage} needs unknown stage {need}")
+
+        order, visiting = [], set()
+
+        def visit(stage: str) -> None:
+            if stage in order:
+                return
+            if stage in visiting:
+                raise ValueError(f"stage {stage} is part of a dependency cycle")
+
+            visiting.add(stage)
+            for need in needs[stage]:
+                visit(need)
+            visiting.discard(stage)
+
+            order.append(stage)
+
+        for stage in needs:
+            visit(stage)
+
+        return order
+
+    def __requirements_runners(self) -> dict[str, TestRunner]:
+        runners = {}
+
+        for stage in self.order:
+            runners.setdefault(self.runners[stage].requirements, self.runners[stage])
+
+        return runners
+
+    @property
+    def requirements(self) -> list[str]:
+        """
+        Requirements files of the stages, each once, in the order of the stages:
+        every stage runs in the same venv.
+
+        """
+        return list(self.__requirements_runners())
+
+    def requirements_hash(self) -> str:
+        """
+        Short hash of the content of every requirements file of the stages.
+
+        """
+        hashes = [
+            (requirements, runner.requirements_hash())
+            for requirements, runner in self.__requirements_runners().items()
+        ]
+
+        # The venvs of a single requirements file keep the name of its hash
+        if len(hashes) == 1:
+            return hashes[0][1]
+
+        content = "\n".join(f"{requirements} {digest}" for requirements, digest in hashes)
+
+        return hashlib.sha256(content.encode()).hexdigest()[:12]
+
+    def pip_arguments(self) -> list[str]:
+        """
+        Arguments added to pip install, for the runners of every stage.
+
+        """
+        packages, extras = [], []
+
+        for stage in self.order:
+            runner = self.runners[stage]
+            packages += [package for package in runner.packages if package not in packages]
+            extras += [extra for extra in runner.extras if extra not in extras]
+
+        # Every stage runs in the same venv, the project is installed once
+        if extras:
+            project_folder = self.runners[self.order[0]].project_folder
+            packages += ["-e", f"{project_folder}[{','.join(extras)}]"]
+
+        return packages
+
+    def check(self) -> str:
+        """
+        Check every stage can run.
+
+        Returns:
+            The error of the first stage that cannot, or None.
+
+        """
+        for stage in self.order:
+            if (error := self.runners[stage].check()) is not None:
+                return error if len(self.runners) == 1 else f"stage {stage}: {error}"
+
+        return None
+
+    def clear_reports(self) -> None:
+        for runner in self.runners.values():
+            runner.clear_reports()
+
+    def report_files(self) -> list[str]:
+        files = []
+
+        for stage in self.order:
+            files.extend(self.runners[stage].report_files())
+
+        return files
+
+    def run(self, execute: Callable[[TestRunner], int]) -> dict[str, dict]:
+        """
+        Run the stages, independent stages at the same time.
+
+        Params:
+            execute: function running the command of a runner, returns its exit code
+
+        Returns:
+            A dict of stage name -> {"status": passed / failed / skipped, "duration": seconds},
+            in the order of the stages.
+
+        """
+        results: dict[str, dict] = {}
+        pending = list(self.order)
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            running = {}
+
+            while pending or running:
+                # pending is sorted, so skips cascade to the whole branch in one pass
+                for stage in list(pending):
+                    needs_status = [
+                        results[need]["status"] if need in results else None
+                        for need in self.needs[stage]
+                    ]
+
+                    if "failed" in needs_status or "skipped" in needs_status:
+                        logger.info(f"stage {stage} skipped, a stage it needs did not pass")
+                        results[stage] = {"status": "skipped", "duration": 0.0}
+                        pending.remove(stage)
+
+                    elif all(status == "passed" for status in needs_status):
+                        # Stages log with the project and build ids of the build
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            self.__run_stage,
+                            stage,
+                            execute,
+                        )
+                        running[future] = stage
+                        pending.remove(stage)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+        return {stage: results[stage] for stage in self.order}
+
+    def __run_stage(self, stage: str, execute: Callable[[TestRunner], int]) -> dict:
+        logger.info(f"stage {stage} started")
+
+        start = time.perf_counter()
+
+        try:
+            return_code = execute(self.runners[stage])
+        except Exception:
+            logger.exception(f"stage {stage} could not run")
+            return_code = None
+
+        duration = time.perf_counter() - start
+        status = "passed" if return_code == 0 else "failed"
+
+        logger.info(f"stage {stage} {status} in {duration:.2f} s")
+
+        return {"status": status, "duration": duration}
@@ -0,0 +1,294 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import signal
+import sys
+import threading
+
+from contextlib import contextmanager
+from typing import Callable, Coroutine, Iterator
+
+from workers.enums import ExitCodes
+from workers.host_resources import HostResources, MemoryUsage
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessRunner:
+    """
+    Run the commands of the builds (git, bash scripts, test commands) as
+    asyncio subprocesses, all supervised by one event loop in a background
+    thread.
+
+    The loop streams the output of every process and enforces its timeout,
+    so a command costs no thread while it runs: hundreds of git fetches and
+    test runs are watched by the same loop. Callers either await run() from
+    a coroutine, submit() it and get a future, or call() it and wait like
+    subprocess.call.
+
+    A command still running after its timeout is terminated with its whole
+    process group (the tests it started too), killed after kill_grace_seconds,
+    and returns ExitCodes.TIMEOUT.
+
+    The commands called inside a cancel_on block are stopped the same way
+    when its event is set, and return ExitCodes.CANCELLED. The memory of
+    the commands called inside a measure_memory block is sampled while
+    they run.
+
+    """
+
+    # Seconds a command may run, CI_COMMAND_TIMEOUT (one hour by default)
+    default_timeout = float(os.getenv("CI_COMMAND_TIMEOUT", "3600"))
+
+    kill_grace_seconds = 10
+
+    # Output is read by chunks of this size, whatever the length of its lines
+    chunk_size = 64 * 1024
+
+    # Seconds between two checks of the cancel event of a call
+    cancel_check_seconds = 0.5
+
+    # Seconds between two samples of the memory of a command
+    memory_sample_seconds = 1.0
+
+    __loop: asyncio.AbstractEventLoop = None
+    __lock = threading.Lock()
+
+    # Event stopping the commands called in the current context, see cancel_on
+    __cancel_event: contextvars.ContextVar = contextvars.ContextVar(
+        "cancel_event", default=None
+    )
+
+    # Peak memory of the commands called in the current context, see measure_memory
+    __memory_usage: contextvars.ContextVar = contextvars.ContextVar(
+        "memory_usage", default=None
+    )
+
+    @classmethod
+    def loop(cls) -> asyncio.AbstractEventLoop:
+        """
+        The event loop supervising the processes, started on first use.
+
+        """
+        with cls.__lock:
+            if cls.__loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=loop.run_forever, name="process-runner", daemon=True
+                ).start()
+                cls.__loop = loop
+
+        return cls.__loop
+
+    @classmethod
+    def write_output(cls, chunk: bytes) -> None:
+        """
+        Default output of the commands: the output of the server, as before.
+
+        """
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+
+    @classmethod
+    async def run(
+        cls,
+        command: list[str],
+        env: dict = None,
+        cwd: str = None,
+        timeout: float = None,
+        on_output: Callable[[bytes], None] = None,
+        memory_usage: MemoryUsage = None,
+    ) -> int:
+        """
+        Run a command, streaming its output as it is written.
+
+        Params:
+            command: the program and its arguments
+            env: the environment of the command, the one of the server if None
+            cwd: the working dir of the command
+            timeout: seconds before the command is stopped, default_timeout if None
+            on_output: called in the loop with each chunk of stdout and stderr,
+                write_output if None
+            memory_usage: updated with the memory of the command while it runs
+
+        Returns:
+            The exit code of the command, ExitCodes.TIMEOUT if it was stopped
+
+        """
+        timeout = timeout or cls.default_timeout
+        on_output = on_output or cls.write_output
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=env,
+                cwd=cwd,
+                # Its own process group, so a timeout stops the processes it started
+                start_new_session=True,
+            )
+        except OSError as error:
+            logger.error(f"could not run {command[0]}: {error}")
+
+            # Exit code of a shell not finding the command
+            return 127
+
+        async def stream() -> None:
+            while chunk := await process.stdout.read(cls.chunk_size):
+                on_output(chunk)
+
+        async def sample_memory() -> None:
+            while True:
+                memory_usage.update(
+                    process.pid, HostResources.process_group_memory(process.pid)
+                )
+                await asyncio.sleep(cls.memory_sample_seconds)
+
+        sampler = None
+
+        if memory_usage is not None:
+            sampler = asyncio.create_task(sample_memory())
+
+        try:
+            await asyncio.wait_for(asyncio.gather(stream(), process.wait()), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{' '.join(command[:3])} timed out after {timeout:.0f} s")
+            await cls.__stop(process)
+            return ExitCodes.TIMEOUT.value
+        except asyncio.CancelledError:
+            await cls.__stop(process)
+            raise
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+                memory_usage.finish(process.pid)
+
+        return process.returncode
+
+    @classmethod
+    async def __stop(cls, process: asyncio.subprocess.Process) -> None:
+        for signal_ in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, signal_)
+            except ProcessLookupError:
+                return
+
+            try:
+                await asyncio.wait_for(process.wait(), cls.kill_grace_seconds)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    @classmethod
+    def submit(cls, coroutine: Coroutine) -> concurrent.futures.Future:
+        """
+        Run a coroutine in the loop, from any thread.
+
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.loop())
+
+    @classmethod
+    def call(
+        cls,
+        command: list[str],
+        env: dict = None,
+        cwd: str = None,
+        timeout: float = None,
+        on_output: Callable[[bytes], None] = None,
+    ) -> int:
+        """
+        Run a command and wait for its exit code, see run().
+
+        Returns ExitCodes.CANCELLED if the event of an enclosing cancel_on
+        block is set, without running the command if it was set before.
+
+        """
+        cancel_event = cls.__cancel_event.get()
+        memory_usage = cls.__memory_usage.get()
+
+        if cancel_event is not None and cancel_event.is_set():
+            return ExitCodes.CANCELLED.value
+
+        future = cls.submit(cls.run(command, env, cwd, timeout, on_output, memory_usage))
+
+        if cancel_event is None:
+            return future.result()
+
+        while True:
+            try:
+                return future.result(cls.cancel_check_seconds)
+            except concurrent.futures.TimeoutError:
+                if cancel_event.is_set():
+                    # Cancelling the task stops the process group
+                    future.cancel()
+                    logger.warning(f"{' '.join(command[:3])} cancelled")
+                    return ExitCodes.CANCELLED.value
+
+    @classmethod
+    @contextmanager
+    def cancel_on(cls, event: threading.Event) -> Iterator[None]:
+        """
+        Stop the commands called in a block, and in the threads it starts
+        with its context, when an event is set. None lets the commands of
+        the block run to the end, inside an outer cancel_on block.
+
+        """
+        token = cls.__cancel_event.set(event)
+
+        try:
+            yield
+        finally:
+            cls.__cancel_event.reset(token)
+
+    @classmethod
+    @contextmanager
+    def measure_memory(cls) -> Iterator[MemoryUsage]:
+        """
+        Measure the peak memory of the commands called in a block, and in
+        the threads it starts with its context.
+
+        Yields a MemoryUsage, its peak is in bytes.
+
+        """
+        memory_usage = MemoryUsage()
+        token = cls.__memory_usage.set(memory_usage)
+
+        try:
+            yield memory_usage
+        finally:
+            cls.__memory_usage.reset(token)
+
+    @classmethod
+    def cancelled(cls) -> bool:
+        """
+        Check if the event of the enclosing cancel_on block is set.
+
+        """
+        cancel_event = cls.__cancel_event.get()
+
+        return cancel_event is not None and cancel_event.is_set()
+
+    @classmethod
+    def run_in_background(
+        cls, function: Callable, *args, description: str = None
+    ) -> concurrent.futures.Future:
+        """
+        Run a blocking function, like removing a folder, without waiting for it.
+
+        Errors are logged, nobody waits for the result.
+
+        """
+
+        async def task():
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, function, *args
+                )
+            except Exception:
+                logger.exception(f"background task failed: {description or function.__name__}")
+
+        return cls.submit(task())
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import shutil
+
+from workers.database import DBWorker
+from workers.log_pipeline import LogPipeline
+from workers.process_runner import ProcessRunner
+from workers.project_manager import ProjectManager
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProjectJobs:
+    """
+    Background jobs adding and deleting projects, so the web requests answer
+    right away instead of waiting for a clone or for gigabytes of venvs to
+    be removed.
+
+    Each job is saved in the project_jobs table, its status page is
+    /project_jobs/<id>. The jobs run as coroutines in the loop of
+    ProcessRunner: no thread waits for git, the database is written from
+    the threads of the loop executor.
+
+    """
+
+    @classmethod
+    def add_project(
+        cls,
+        db_worker: DBWorker,
+        name: str,
+        github_url: str,
+        test_file: str,
+        target_branch: str,
+    ) -> int:
+        """
+        Start a job cloning a project, then saving it to the database.
+
+        Returns:
+            The id of the job
+
+        """
+        job_id = db_worker.insert_project_job("add", name)
+
+        ProcessRunner.submit(
+            cls.__add(db_worker, job_id, name, github_url, test_file, target_branch)
+        )
+
+        return job_id
+
+    @classmethod
+    def delete_project(cls, db_worker: DBWorker, name: str) -> int:
+        """
+        Delete a project from the database and move its folder to the trash,
+        then start a job removing the folder.
+
+        The project is gone once this returns, only the disk space is
+        reclaimed in the background.
+
+        Returns:
+            The id of the job, or None if the project does not exist
+
+        """
+        deleted = db_worker.delete_project_by_name(name)
+        trash_folder = ProjectManager.move_to_trash(name)
+
+        if not deleted and trash_folder is None:
+            return None
+
+        job_id = db_worker.insert_project_job("delete", name)
+
+        if trash_folder is None:
+            db_worker.update_project_job(job_id, "done", "project deleted, it had no folder")
+            return job_id
+
+        db_worker.update_project_job(job_id, "running", "removing the project folder")
+        ProcessRunner.submit(cls.__remove_folder(db_worker, job_id, name, trash_folder))
+
+        return job_id
+
+    @classmethod
+    async def __add(
+        cls,
+        db_worker: DBWorker,
+        job_id: int,
+        name: str,
+        github_url: str,
+        test_file: str,
+        target_branch: str,
+    ) -> None:
+        with LogPipeline.context(project=name, project_job=job_id):
+            try:
+                await asyncio.to_thread(
+                    db_worker.update_project_job, job_id, "running", "cloning the project"
+                )
+
+                if not await ProjectManager.clone(github_url):
+                    await asyncio.to_thread(ProjectManager.delete_project_folder, name)
+                    status, message = "failed", "project could not be cloned"
+                elif not await asyncio.to_thread(
+                    db_worker.insert_project_to_database,
+                    name,
+                    test_file,
+                    github_url,
+                    target_branch,
+                ):
+                    await asyncio.to_thread(ProjectManager.delete_project_folder, name)
+                    status, message = "failed", "project could not be added to database"
+                else:
+                    status, message = "done", "project added"
+            except Exception as error:
+                logger.exception("project job failed")
+                status, message = "failed", f"project job failed: {error}"
+
+            logger.log(
+                logging.INFO if status == "done" else logging.ERROR, f"add {name}: {message}"
+            )
+            await asyncio.to_thread(db_worker.update_project_job, job_id, status, message)
+
+    @classmethod
+    async def __remove_folder(
+        cls, db_worker: DBWorker, job_id: int, name: str, trash_folder: str
+    ) -> None:
+        with LogPipeline.context(project=name, project_job=job_id):
+            try:
+                await asyncio.to_thread(shutil.rmtree, trash_folder)
+                status, message = "done", "project deleted"
+            except OSError as error:
+                logger.exception("project folder could not be removed")
+                status, message = "failed", f"project folder could not be removed: {error}"
+
+            await asyncio.to_thread(db_worker.update_project_job, job_id, status, message)
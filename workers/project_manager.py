@@ -1,7 +1,10 @@
 import os
-import subprocess
+import shutil
+import tempfile
+import time
 
 from workers.enums import ExitCodes
+from workers.process_runner import ProcessRunner
 
 
 class ProjectManager:
@@ -18,6 +21,14 @@ class ProjectManager:
 
     clone_script_path = os.path.join(bash_scripts_dir, "clone_project.sh")
     pull_script_path = os.path.join(bash_scripts_dir, "pull_latest_changes.sh")
+    create_workspace_script_path = os.path.join(bash_scripts_dir, "create_workspace.sh")
+    remove_workspace_script_path = os.path.join(bash_scripts_dir, "remove_workspace.sh")
+
+    # Each build runs in its own workspace, a git worktree of the project clone
+    workspaces_dir = os.path.join(parent_dir, "workspaces")
+
+    # Deleted projects are moved there, then removed in the background
+    trash_dir = os.path.join(parent_dir, "projects", ".trash")
 
     @classmethod
     def clone_project(cls, project_url: str) -> bool:
@@ -33,10 +44,20 @@ class ProjectManager:
 
         """
 
+        return ProcessRunner.submit(cls.clone(project_url)).result()
+
+    @classmethod
+    async def clone(cls, project_url: str) -> bool:
+        """
+        Clone a project, from a coroutine running in the loop of ProcessRunner.
+
+        See clone_project.
+
+        """
         # Extract project name from URL, last index after last /
         project_name = project_url.split("/")[-1]
 
-        return_code = subprocess.call(
+        return_code = await ProcessRunner.run(
             [
                 "bash",
                 cls.clone_script_path,
@@ -46,10 +67,7 @@ class ProjectManager:
         )
 
         # Exit code 0 == success
-        if return_code == ExitCodes.SUCCESS.value:
-            return True
-        else:
-            return False
+        return return_code == ExitCodes.SUCCESS.value
 
     @classmethod
     def pull_latest_changes(cls, project_name: str) -> bool:
@@ -63,7 +81,7 @@ class ProjectManager:
             True if script execution went well, otherwise False.
 
         """
-        return_code = subprocess.call(["bash", cls.pull_script_path, project_name])
+        return_code = ProcessRunner.call(["bash", cls.pull_script_path, project_name])
 
         # Exit code 0 == success
         if return_code == ExitCodes.SUCCESS.value:
@@ -71,6 +89,57 @@ class ProjectManager:
         else:
             return False
 
+    @classmethod
+    def create_workspace(cls, project_name: str, ref: str = None) -> str:
+        """
+        Check out a commit of a project in a new build workspace.
+
+        The workspace is a git worktree of the project clone: it shares its
+        objects, so creating it only writes the files of the commit. Builds
+        of a project can run at the same time, each one in its workspace.
+
+        Params:
+            project_name: name of the project
+            ref: the commit (or branch) to check out, the last pulled commit if None
+
+        Returns:
+            The path of the workspace, or None if it could not be created.
+
+        """
+        os.makedirs(cls.workspaces_dir, exist_ok=True)
+        workspace = tempfile.mkdtemp(prefix=f"{project_name}-", dir=cls.workspaces_dir)
+
+        return_code = ProcessRunner.call(
+            [
+                "bash",
+                cls.create_workspace_script_path,
+                project_name,
+                workspace,
+                ref or "HEAD",
+            ]
+        )
+
+        if return_code != ExitCodes.SUCCESS.value:
+            shutil.rmtree(workspace, ignore_errors=True)
+            return None
+
+        return workspace
+
+    @classmethod
+    def remove_workspace(cls, project_name: str, workspace: str) -> bool:
+        """
+        Remove a build workspace and its worktree entry in the project clone.
+
+        Returns:
+            True if the workspace was removed, otherwise False.
+
+        """
+        ProcessRunner.call(
+            ["bash", cls.remove_workspace_script_path, project_name, workspace]
+        )
+
+        return not os.path.exists(workspace)
+
     @classmethod
     def project_exists(cls, project_name: str) -> bool:
         """
@@ -92,22 +161,64 @@ class ProjectManager:
         """
         Delete a project.
 
+        The folder is moved to the trash and removed in the background, its
+        venvs and checkouts can take minutes to remove.
+
         Params:
             project_name: name of the project
 
         Returns:
             True if project was deleted, otherwise False.
 
+        """
+        trash_folder = cls.move_to_trash(project_name)
+
+        if trash_folder is None:
+            return False
+
+        ProcessRunner.run_in_background(
+            shutil.rmtree, trash_folder, True, description=f"removing {trash_folder}"
+        )
+
+        return True
+
+    @classmethod
+    def move_to_trash(cls, project_name: str) -> str:
+        """
+        Move the folder of a project to the trash, the name can be used again right away.
+
+        Params:
+            project_name: name of the project
+
+        Returns:
+            The path of the folder in the trash, or None if the project has no folder.
+
         """
         project_name = project_name.lower()
         project_folder = os.path.join(cls.parent_dir, "projects", project_name)
 
-        if os.path.exists(project_folder):
-            return_code = subprocess.call(["rm", "-rf", project_folder])
+        if not os.path.exists(project_folder):
+            return None
 
-            if return_code == ExitCodes.SUCCESS.value:
-                return True
-            else:
-                return False
-        else:
-            return False
+        # Renaming is instant, removing the files is not
+        os.makedirs(cls.trash_dir, exist_ok=True)
+        trash_folder = os.path.join(cls.trash_dir, f"{project_name}-{time.time_ns()}")
+
+        try:
+            os.rename(project_folder, trash_folder)
+        except OSError:
+            return None
+
+        return trash_folder
+
+    @classmethod
+    def empty_trash(cls) -> None:
+        """
+        Remove the folders left in the trash, by a server stopped while removing them.
+
+        """
+        if not os.path.isdir(cls.trash_dir):
+            return
+
+        for name in os.listdir(cls.trash_dir):
+            shutil.rmtree(os.path.join(cls.trash_dir, name), ignore_errors=True)
@@ -0,0 +1,298 @@
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from typing import Callable
+
+from dotenv import load_dotenv
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryProfiler:
+    """
+    Opt-in profiling of the queries run by DBWorker.
+
+    Enabled with CI_DB_PROFILE=1. Every query is recorded with the DBWorker
+    method that ran it, the rows it returned and its wall time (execution
+    and fetch). Queries slower than CI_DB_SLOW_QUERY_MS are logged with
+    their EXPLAIN QUERY PLAN, to spot full table scans.
+
+    """
+
+    load_dotenv()
+
+    enabled = os.getenv("CI_DB_PROFILE", "0") == "1"
+    slow_query_ms = float(os.getenv("CI_DB_SLOW_QUERY_MS", 100))
+
+    # Normalized query text -> aggregated stats
+    __stats: dict[str, dict] = {}
+    __lock = threading.Lock()
+
+    # Public DBWorker method running in the current context, see name_db_methods
+    __method: contextvars.ContextVar = contextvars.ContextVar("db_method", default=None)
+
+    @classmethod
+    def name_db_methods(cls, target: type) -> type:
+        """
+        Class decorator recording the queries of every public method of
+        DBWorker under its name, the queries of its private helpers and of
+        the generators it returns included.
+
+        """
+        for name, method in list(vars(target).items()):
+            if name.startswith("_") or not callable(method):
+                continue
+
+            setattr(target, name, cls.__named(name, method))
+
+        return target
+
+    @classmethod
+    def current_method(cls) -> str:
+        return cls.__method.get()
+
+    @classmethod
+    def __named(cls, name: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if not cls.enabled:
+                return method(*args, **kwargs)
+
+            token = cls.__method.set(name)
+
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                cls.__method.reset(token)
+
+            # The query of an iter_* method runs while its rows are iterated
+            if inspect.isgenerator(result):
+                return cls.__named_iteration(name, result)
+
+            return result
+
+        return wrapper
+
+    @classmethod
+    def __named_iteration(cls, name: str, generator):
+        try:
+            while True:
+                token = cls.__method.set(name)
+
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    cls.__method.reset(token)
+
+                yield item
+        finally:
+            generator.close()
+
+    @classmethod
+    def record(
+        cls,
+        connection: sqlite3.Connection,
+        method: str,
+        query: str,
+        parameters: tuple,
+        rows: int,
+        duration: float,
+    ) -> None:
+        """
+        Add one execution of a query to the stats.
+
+        Params:
+            connection: the connection that ran the query, to explain slow queries
+            method: the DBWorker method that ran the query
+            query: the query text
+            parameters: the parameters of the query
+            rows: rows returned, or rows changed for INSERT / UPDATE / DELETE
+            duration: wall time of the query in seconds
+
+        """
+        query = re.sub(r"\s+", " ", query).strip()
+
+        plan = None
+        slow = duration * 1000 >= cls.slow_query_ms
+
+        if slow:
+            plan = cls.explain(connection, query, parameters)
+            logger.warning(
+                f"slow query in {method}: {duration * 1000:.1f} ms, {rows} rows: {query}"
+                + (f" | plan: {'; '.join(plan)}" if plan else "")
+            )
+
+        with cls.__lock:
+            if (stats := cls.__stats.get(query)) is None:
+                stats = cls.__stats[query] = {
+                    "query": query,
+                    "method": method,
+                    "calls": 0,
+                    "rows": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "slow_calls": 0,
+                    "plan": None,
+                }
+
+            stats["calls"] += 1
+            stats["rows"] += rows
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+
+            if slow:
+                stats["slow_calls"] += 1
+                stats["plan"] = plan or stats["plan"]
+
+    @classmethod
+    def explain(
+        cls, connection: sqlite3.Connection, query: str, parameters: tuple
+    ) -> list[str]:
+        """
+        Get the query plan of a SELECT query, like "SCAN test_cases".
+
+        Returns:
+            A list with one line per step of the plan, None for other queries.
+
+        """
+        if not query.upper().startswith(("SELECT", "WITH")):
+            return None
+
+        try:
+            rows = connection.execute("EXPLAIN QUERY PLAN " + query, parameters)
+        except sqlite3.Error:
+            return None
+
+        # Each row is (id, parent, notused, detail)
+        return [row[3] for row in rows.fetchall()]
+
+    @classmethod
+    def top_queries(cls, limit: int = 50) -> list[dict]:
+        """
+        Get the queries that took the most time in total.
+
+        Returns:
+            A list of dicts sorted by total time, with the average time added.
+
+        """
+        with cls.__lock:
+            stats = [dict(query_stats) for query_stats in cls.__stats.values()]
+
+        for query_stats in stats:
+            query_stats["average_time"] = query_stats["total_time"] / query_stats["calls"]
+
+        return sorted(stats, key=lambda x: x["total_time"], reverse=True)[:limit]
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls.__lock:
+            cls.__stats.clear()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Cursor recording each query to the QueryProfiler.
+
+    A SELECT is recorded once its rows are fetched, so the time spent
+    stepping through the rows is counted with the query. Rows read with
+    fetchmany are summed until the last of them, or until the cursor is
+    closed.
+
+    """
+
+    __pending = None
+    __fetched = None
+
+    def execute(self, query: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        # The DBWorker method running the query, else the caller
+        method = QueryProfiler.current_method() or sys._getframe(1).f_code.co_name
+
+        start = time.perf_counter()
+        super().execute(query, parameters)
+        duration = time.perf_counter() - start
+
+        if self.description is None:
+            # INSERT / UPDATE / DELETE, nothing to fetch
+            self.__pending = None
+            QueryProfiler.record(
+                self.connection, method, query, parameters, max(self.rowcount, 0), duration
+            )
+        else:
+            self.__pending = (method, query, parameters, duration)
+
+        self.__fetched = None
+
+        return self
+
+    def executemany(self, query: str, seq_of_parameters) -> sqlite3.Cursor:
+        method = QueryProfiler.current_method() or sys._getframe(1).f_code.co_name
+
+        start = time.perf_counter()
+        super().executemany(query, seq_of_parameters)
+        duration = time.perf_counter() - start
+
+        self.__pending = None
+        QueryProfiler.record(
+            self.connection, method, query, (), max(self.rowcount, 0), duration
+        )
+
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.__record_fetch(0 if row is None else 1, time.perf_counter() - start)
+
+        return row
+
+    def fetchall(self) -> list:
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.__record_fetch(len(rows), time.perf_counter() - start)
+
+        return rows
+
+    def fetchmany(self, size: int = None) -> list:
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        duration = time.perf_counter() - start
+
+        fetched_rows, fetched_duration = self.__fetched or (0, 0.0)
+        self.__fetched = (fetched_rows + len(rows), fetched_duration + duration)
+
+        # Fewer rows than asked for: the last ones
+        if len(rows) < (self.arraysize if size is None else size):
+            self.__record_fetch(*self.__fetched)
+
+        return rows
+
+    def close(self) -> None:
+        # A query whose rows were not all read, like a page of an API list
+        if self.__fetched is not None:
+            self.__record_fetch(*self.__fetched)
+
+        super().close()
+
+    def __record_fetch(self, rows: int, fetch_duration: float) -> None:
+        self.__fetched = None
+
+        if self.__pending is None:
+            return
+
+        method, query, parameters, duration = self.__pending
+        self.__pending = None
+
+        QueryProfiler.record(
+            self.connection, method, query, parameters, rows, duration + fetch_duration
+        )
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+
+from dotenv import load_dotenv
+
+from workers.enums import ExitCodes
+from workers.matrix import BuildMatrix
+from workers.pipeline import Pipeline
+from workers.process_runner import ProcessRunner
+from workers.runners import TestRunner
+
+
+class ResultCache:
+    """
+    Cache of test results, keyed on the content that was tested.
+
+    The key hashes the git tree of the workspace, the requirements file,
+    the project config, the test file and the matrix cell. A build whose
+    key was already tested (webhook redelivered, revert, merge commit with
+    an identical tree ...) records a batch referencing the previous results
+    instead of running the tests again.
+
+    Disabled with CI_RESULT_CACHE=0.
+
+    """
+
+    load_dotenv()
+
+    enabled = os.getenv("CI_RESULT_CACHE", "1") == "1"
+
+    # Seconds a git command of the key may run
+    git_timeout = 60
+
+    @classmethod
+    def __git(cls, workspace: str, *args: str) -> str:
+        """
+        Run a git command in the workspace, like the other commands of the
+        build: stopped after git_timeout, or when the build is cancelled.
+
+        Returns:
+            The output of the command, or None if it failed
+
+        """
+        output = bytearray()
+
+        return_code = ProcessRunner.call(
+            ["git", "-C", workspace, *args],
+            timeout=cls.git_timeout,
+            on_output=output.extend,
+        )
+
+        if return_code != ExitCodes.SUCCESS.value:
+            return None
+
+        return output.decode(errors="replace").strip()
+
+    @classmethod
+    def key(
+        cls, workspace: str, test_file: str, cell: dict = None, stages: list[str] = None
+    ) -> str:
+        """
+        Compute the cache key of a build.
+
+        Params:
+            workspace: the checkout to test, a git worktree
+            test_file: the test file saved with the project
+            cell: the matrix cell built, see matrix.py
+            stages: the pipeline stages run, all of them if None
+
+        Returns:
+            The key, or None if the workspace is not a clean git checkout
+            (the tree would not describe what is tested). The key is computed
+            even when the cache is disabled, flaky tests are detected with it.
+
+        """
+        tree = cls.__git(workspace, "rev-parse", "HEAD^{tree}")
+        dirty = cls.__git(workspace, "status", "--porcelain", "--untracked-files=no")
+
+        # git failed, was cancelled, or the checkout has local changes
+        if tree is None or dirty is None or dirty:
+            return None
+
+        try:
+            config = TestRunner.load_config(workspace)
+            pipeline = Pipeline.for_project(workspace, test_file, config, only_stages=stages)
+        except ValueError:
+            # The build reports the invalid config
+            return None
+
+        parts = {
+            "tree": tree,
+            "requirements": pipeline.requirements_hash(),
+            "config": json.dumps(config, sort_keys=True, default=str),
+            "test_file": test_file,
+            "matrix": BuildMatrix.name(cell),
+        }
+
+        # Keys of the builds running every stage stay the same as before
+        if stages is not None:
+            parts["stages"] = sorted(stages)
+
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
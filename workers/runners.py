@@ -0,0 +1,458 @@
+import glob
+import hashlib
+import os
+import shutil
+import tomllib
+
+
+class TestRunner:
+    """
+    Backend running the tests of a project and producing junitxml reports.
+
+    The backend and its options are read from the [runner] table of the
+    .simple-ci.toml file at the root of the project:
+
+        [runner]
+        backend = "pytest"          # pytest, unittest, tox, nox or command
+        workers = "auto"            # parallel workers, "auto" is one per CPU
+        working_dir = "."           # relative to the project root
+        requirements = "requirements.txt"
+        extras = ["test"]           # installs the project with pip install -e .[test]
+        args = ["-x"]               # extra arguments of the test command
+        reruns = 2                  # reruns of the failed tests (pytest only)
+        timeout = 1800              # seconds, CI_COMMAND_TIMEOUT by default
+
+        [runner.env]
+        DATABASE_URL = "sqlite://"
+
+    Without config file, pytest runs the test file of the project, as before.
+
+    """
+
+    # Not a test class, for pytest collecting the test modules importing it
+    __test__ = False
+
+    config_file = ".simple-ci.toml"
+
+    # Reports are written there, the folder is emptied before each run
+    reports_dir = ".ci-reports"
+
+    # Backend name -> runner class, filled at the end of this module
+    backends: dict[str, type] = {}
+
+    def __init__(
+        self, project_folder: str, test_file: str, config: dict, stage: str = None
+    ):
+        self.project_folder = project_folder
+        self.test_file = test_file
+        self.config = config
+
+        # Each pipeline stage writes its reports to its own folder
+        if stage is not None:
+            self.reports_dir = os.path.join(TestRunner.reports_dir, stage)
+
+        self.working_dir = os.path.normpath(
+            os.path.join(project_folder, config.get("working_dir", "."))
+        )
+        self.args = [str(arg) for arg in config.get("args", [])]
+        self.requirements = config.get("requirements", "requirements.txt")
+        self.extras = config.get("extras", [])
+        self.env = {name: str(value) for name, value in config.get("env", {}).items()}
+
+    @classmethod
+    def load_config(cls, project_folder: str) -> dict:
+        """
+        Read the .simple-ci.toml file of a project.
+
+        Returns:
+            The whole config as a dict, empty if the project has no config file.
+
+        """
+        config_path = os.path.join(project_folder, cls.config_file)
+
+        if not os.path.isfile(config_path):
+            return {}
+
+        with open(config_path, "rb") as config_file:
+            return tomllib.load(config_file)
+
+    @classmethod
+    def for_project(
+        cls, project_folder: str, test_file: str, config: dict = None, stage: str = None
+    ) -> "TestRunner":
+        """
+        Get the runner configured for a project.
+
+        Params:
+            project_folder: path of the project
+            test_file: the test file saved with the project
+            config: the [runner] table, read from the project config file if None
+            stage: the pipeline stage run by this runner
+
+        Raises:
+            ValueError if the backend does not exist
+
+        """
+        if config is None:
+            config = cls.load_config(project_folder).get("runner", {})
+
+        # A stage with only a command, like a linter, is run by the command backend
+        backend = config.get("backend", "command" if "command" in config else "pytest")
+
+        if backend not in cls.backends:
+            raise ValueError(f"unknown test runner backend: {backend}")
+
+        return cls.backends[backend](project_folder, test_file, config, stage)
+
+    def requirements_hash(self) -> str:
+        """
+        Short hash of the content of the requirements file, "none" if it does not exist.
+
+        """
+        path = os.path.join(self.project_folder, self.requirements)
+
+        if not os.path.isfile(path):
+            return "none"
+
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()[:12]
+
+    @property
+    def workers(self) -> int:
+        workers = self.config.get("workers", 1)
+
+        if workers == "auto":
+            return os.cpu_count() or 1
+
+        return max(int(workers), 1)
+
+    @property
+    def reruns(self) -> int:
+        """
+        Number of times the failed tests are run again when the command fails.
+
+        """
+        return max(int(self.config.get("reruns", 0)), 0)
+
+    @property
+    def timeout(self) -> float:
+        """
+        Seconds the test command may run, None for the default of ProcessRunner.
+
+        """
+        return float(self.config["timeout"]) if "timeout" in self.config else None
+
+    @property
+    def packages(self) -> list[str]:
+        """
+        Packages needed by the backend, installed in the venv with the project requirements.
+
+        """
+        return []
+
+    def pip_arguments(self) -> list[str]:
+        """
+        Arguments added to pip install, after the requirements file.
+
+        """
+        arguments = list(self.packages)
+
+        if self.extras:
+            arguments += ["-e", f"{self.project_folder}[{','.join(self.extras)}]"]
+
+        return arguments
+
+    def check(self) -> str:
+        """
+        Check the project can be tested by this backend.
+
+        Returns:
+            An error message, or None if everything is in place.
+
+        """
+        if not os.path.isdir(self.working_dir):
+            return f"working dir {self.working_dir} does not exist"
+
+        if self.reruns and self.rerun_command(1) is None:
+            return f"reruns are not supported by the {self.config.get('backend')} backend"
+
+        return None
+
+    def command(self) -> list[str]:
+        """
+        Command running the tests, inside the project venv, from the working dir.
+
+        """
+        raise NotImplementedError
+
+    def rerun_command(self, attempt: int) -> list[str]:
+        """
+        Command running again the tests failed by the previous run, None if
+        the backend cannot rerun only the failed tests.
+
+        Params:
+            attempt: number of the rerun, starting at 1
+
+        """
+        return None
+
+    @property
+    def rerun_dir(self) -> str:
+        """
+        Folder of the reports of the reruns, not part of report_files.
+
+        """
+        return os.path.join(self.project_folder, self.reports_dir, "reruns")
+
+    def report_patterns(self) -> list[str]:
+        """
+        Glob patterns of the junitxml reports written by the command.
+
+        """
+        return [os.path.join(self.project_folder, self.reports_dir, "*.xml")]
+
+    def report_files(self) -> list[str]:
+        files = []
+
+        for pattern in self.report_patterns():
+            files.extend(sorted(glob.glob(pattern, recursive=True)))
+
+        return files
+
+    def clear_reports(self) -> None:
+        """
+        Remove the reports of the previous run so they are never parsed twice.
+
+        """
+        for report in self.report_files():
+            os.remove(report)
+
+        shutil.rmtree(self.rerun_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.project_folder, self.reports_dir), exist_ok=True)
+
+    def environment(self, venv_folder: str) -> dict:
+        """
+        Environment of the test command: the project venv and the configured variables.
+
+        """
+        env = dict(os.environ)
+        env["VIRTUAL_ENV"] = venv_folder
+        env["PATH"] = os.path.join(venv_folder, "bin") + os.pathsep + env.get("PATH", "")
+        env.update(self.env)
+
+        return env
+
+    @property
+    def report_path(self) -> str:
+        return os.path.join(self.project_folder, self.reports_dir, "junit.xml")
+
+
+class PytestRunner(TestRunner):
+    """
+    pytest, in parallel with pytest-xdist when more than one worker is configured.
+
+    Option:
+        tests: files or folders to test, the project test file by default
+
+    """
+
+    @property
+    def packages(self) -> list[str]:
+        return ["pytest", "pytest-xdist"] if self.workers > 1 else ["pytest"]
+
+    @property
+    def tests(self) -> list[str]:
+        tests = self.config.get("tests", self.test_file)
+        return [tests] if isinstance(tests, str) else list(tests)
+
+    def check(self) -> str:
+        for test_path in self.tests:
+            if not os.path.exists(os.path.join(self.working_dir, test_path)):
+                return "test file does not exist"
+
+        return super().check()
+
+    @property
+    def cache_dir(self) -> str:
+        """
+        pytest cache of the stage, keeping the last failed tests for the reruns.
+
+        Stages run at the same time in the same working dir, they would share
+        its .pytest_cache otherwise.
+
+        """
+        return os.path.join(self.rerun_dir, ".cache")
+
+    def command(self) -> list[str]:
+        command = [
+            "python",
+            "-m",
+            "pytest",
+            f"--junitxml={self.report_path}",
+            "-o",
+            f"cache_dir={self.cache_dir}",
+        ]
+
+        if self.workers > 1:
+            command += ["-n", str(self.workers)]
+
+        return command + self.args + self.tests
+
+    def rerun_command(self, attempt: int) -> list[str]:
+        report = os.path.join(self.rerun_dir, f"junit-{attempt}.xml")
+        command = [
+            "python",
+            "-m",
+            "pytest",
+            f"--junitxml={report}",
+            "-o",
+            f"cache_dir={self.cache_dir}",
+            "--last-failed",
+            "--last-failed-no-failures",
+            "none",
+        ]
+
+        if self.workers > 1:
+            command += ["-n", str(self.workers)]
+
+        return command + self.args + self.tests
+
+
+class UnittestRunner(TestRunner):
+    """
+    unittest, the test modules are spread over the workers in separate processes.
+
+    Options:
+        start_dir: folder where tests are discovered, "." by default
+        pattern: pattern of the test files, "test*.py" by default
+
+    """
+
+    # Standalone script, runs with the python of the project venv
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "unittest_junit.py")
+
+    def command(self) -> list[str]:
+        return [
+            "python",
+            self.script_path,
+            self.report_path,
+            str(self.workers),
+            self.config.get("start_dir", "."),
+            self.config.get("pattern", "test*.py"),
+        ]
+
+
+class ToxRunner(TestRunner):
+    """
+    tox, environments run in parallel with tox run-parallel.
+
+    Options:
+        envs: environments to run, all of them by default
+        reports: glob patterns of the reports written by the tox environments,
+            relative to the working dir, ".tox/junit-*.xml" by default
+
+    """
+
+    @property
+    def packages(self) -> list[str]:
+        return ["tox"]
+
+    def command(self) -> list[str]:
+        command = ["tox", "run-parallel", "-p", str(self.workers)]
+
+        if envs := self.config.get("envs"):
+            command += ["-e", ",".join(envs)]
+
+        return command + self.args
+
+    def report_patterns(self) -> list[str]:
+        patterns = self.config.get("reports", [".tox/junit-*.xml"])
+
+        return [os.path.join(self.working_dir, pattern) for pattern in patterns]
+
+    def clear_reports(self) -> None:
+        for report in self.report_files():
+            os.remove(report)
+
+        shutil.rmtree(self.rerun_dir, ignore_errors=True)
+
+
+class NoxRunner(ToxRunner):
+    """
+    nox, the listed sessions run in parallel as separate nox processes.
+
+    Options:
+        sessions: sessions to run, all of them one after the other if empty
+        reports: glob patterns of the reports written by the sessions,
+            relative to the working dir, ".nox/junit-*.xml" by default
+
+    """
+
+    @property
+    def packages(self) -> list[str]:
+        return ["nox"]
+
+    def command(self) -> list[str]:
+        sessions = self.config.get("sessions", [])
+
+        if not sessions:
+            return ["nox"] + self.args
+
+        # xargs starts one nox per session, at most "workers" at a time
+        nox_command = " ".join(["nox", "-s", "{}"] + self.args)
+
+        return [
+            "bash",
+            "-c",
+            f"printf '%s\\n' \"$@\" | xargs -P {self.workers} -I{{}} {nox_command}",
+            "nox",
+        ] + sessions
+
+    def report_patterns(self) -> list[str]:
+        patterns = self.config.get("reports", [".nox/junit-*.xml"])
+
+        return [os.path.join(self.working_dir, pattern) for pattern in patterns]
+
+
+class CommandRunner(TestRunner):
+    """
+    Any command writing junitxml reports, run with bash.
+
+    Options:
+        command: the command, {workers} and {report} are replaced by the number
+            of workers and the default report path
+        reports: glob patterns of the reports, relative to the working dir,
+            the default report path if not set
+
+    """
+
+    def check(self) -> str:
+        if not self.config.get("command"):
+            return "no command configured for the command backend"
+
+        return super().check()
+
+    def command(self) -> list[str]:
+        # Only the two placeholders are replaced, the shell uses braces too
+        command = (
+            self.config["command"]
+            .replace("{workers}", str(self.workers))
+            .replace("{report}", self.report_path)
+        )
+
+        return ["bash", "-c", command]
+
+    def report_patterns(self) -> list[str]:
+        if patterns := self.config.get("reports"):
+            return [os.path.join(self.working_dir, pattern) for pattern in patterns]
+
+        return super().report_patterns()
+
+
+TestRunner.backends = {
+    "pytest": PytestRunner,
+    "unittest": UnittestRunner,
+    "tox": ToxRunner,
+    "nox": NoxRunner,
+    "command": CommandRunner,
+}
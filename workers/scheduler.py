@@ -0,0 +1,332 @@
+import datetime
+import logging
+import os
+import threading
+import time
+import tomllib
+import zoneinfo
+
+from workers.database import DBWorker
+from workers.job_queue import JobQueue
+from workers.log_pipeline import LogPipeline
+from workers.project_manager import ProjectManager
+from workers.runners import TestRunner
+
+
+logger = logging.getLogger(__name__)
+
+
+class CronExpression:
+    """
+    A cron expression with the 5 usual fields:
+
+        minute  hour  day-of-month  month  day-of-week
+
+    Each field is "*", a number, a range "1-5", a list "1,15,30" or a step
+    "*/15" or "9-17/2". Days of week go from 0 (Sunday) to 6, 7 is Sunday too.
+    The @hourly, @daily, @midnight, @weekly, @monthly, @yearly and @annually
+    shortcuts are accepted.
+
+    As in cron, when both day fields are restricted a day matches if it
+    matches either of them.
+
+    """
+
+    macros = {
+        "@hourly": "0 * * * *",
+        "@daily": "0 0 * * *",
+        "@midnight": "0 0 * * *",
+        "@weekly": "0 0 * * 0",
+        "@monthly": "0 0 1 * *",
+        "@yearly": "0 0 1 1 *",
+        "@annually": "0 0 1 1 *",
+    }
+
+    # Allowed values of each field
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        """
+        Raises:
+            ValueError: if the expression is invalid
+
+        """
+        self.expression = expression
+        fields = self.macros.get(expression.strip(), expression).split()
+
+        if len(fields) != 5:
+            raise ValueError(f"cron expression {expression!r} must have 5 fields")
+
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.__parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.ranges)
+        )
+
+        # 7 is another name of Sunday
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+
+        self.any_day = fields[2].startswith("*")
+        self.any_weekday = fields[4].startswith("*")
+
+    def __parse_field(self, field: str, low: int, high: int) -> set[int]:
+        values = set()
+
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+
+            try:
+                step = int(step) if step else 1
+
+                if part == "*":
+                    start, end = low, high
+                elif "-" in part:
+                    start, end = (int(bound) for bound in part.split("-", 1))
+                else:
+                    start = end = int(part)
+                    # "5/10" means from 5 to the end, every 10
+                    if step != 1:
+                        end = high
+            except ValueError:
+                raise ValueError(
+                    f"invalid field {field!r} in cron expression {self.expression!r}"
+                ) from None
+
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError(
+                    f"field {field!r} out of range {low}-{high} in cron expression {self.expression!r}"
+                )
+
+            values.update(range(start, end + 1, step))
+
+        return values
+
+    def matches(self, moment: datetime.datetime) -> bool:
+        """
+        Check if the minute of a datetime is a time of the expression.
+
+        """
+        if (
+            moment.minute not in self.minutes
+            or moment.hour not in self.hours
+            or moment.month not in self.months
+        ):
+            return False
+
+        # isoweekday: Monday is 1, Sunday is 7
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def __repr__(self) -> str:
+        return f"CronExpression({self.expression!r})"
+
+
+class Scheduler:
+    """
+    Queue builds of projects on a schedule, read from the [[schedules]]
+    tables of their .simple-ci.toml file:
+
+        [[schedules]]
+        name = "nightly"
+        cron = "0 2 * * *"              # every day at 2:00
+        timezone = "Europe/Paris"       # of the cron expression, UTC by default
+
+        [[schedules]]
+        name = "smoke"
+        cron = "@hourly"
+        stages = ["lint", "unit"]       # the stages to run, all of them by default
+
+        [[schedules]]
+        name = "idle"
+        idle_hours = 12                 # when the last build is older than 12 hours
+        branch = "develop"              # the target branch of the project by default
+
+    A schedule with both cron and idle_hours runs at the cron times when the
+    project was idle for that long.
+
+    The builds go to the job queue like the builds of webhooks, with a
+    "schedule:<name>" trigger. A schedule does not queue a build while its
+    previous build is still queued or running, and each run is claimed in
+    the database so several servers do not queue the same run twice.
+
+    """
+
+    # Seconds between two evaluations of the schedules
+    interval = 60
+
+    __stop_event = threading.Event()
+
+    @classmethod
+    def schedules(cls, config: dict) -> list[dict]:
+        """
+        Get the schedules of a project.
+
+        Params:
+            config: the whole config of the project
+
+        Returns:
+            A list of {"name", "cron", "idle_hours", "branch", "stages",
+            "timezone"} dicts, cron is a CronExpression or None.
+
+        Raises:
+            ValueError: if a schedule is invalid
+
+        """
+        schedules = []
+
+        for schedule in config.get("schedules", []):
+            name = schedule.get("name")
+
+            if not name:
+                raise ValueError("schedules must have a name")
+            if name in (other["name"] for other in schedules):
+                raise ValueError(f"schedule {name} is declared twice")
+            if "cron" not in schedule and "idle_hours" not in schedule:
+                raise ValueError(f"schedule {name} needs a cron or idle_hours")
+
+            idle_hours = schedule.get("idle_hours")
+            if idle_hours is not None and (
+                not isinstance(idle_hours, (int, float)) or idle_hours <= 0
+            ):
+                raise ValueError(f"idle_hours of schedule {name} must be a positive number")
+
+            stages = schedule.get("stages")
+            if stages is not None and (not isinstance(stages, list) or not stages):
+                raise ValueError(f"stages of schedule {name} must be a list of stages")
+
+            try:
+                timezone = zoneinfo.ZoneInfo(schedule.get("timezone", "UTC"))
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                raise ValueError(
+                    f"unknown timezone {schedule['timezone']!r} of schedule {name}"
+                ) from None
+
+            schedules.append(
+                {
+                    "name": name,
+                    "cron": CronExpression(schedule["cron"]) if "cron" in schedule else None,
+                    "idle_hours": idle_hours,
+                    "branch": schedule.get("branch"),
+                    "stages": stages,
+                    "timezone": timezone,
+                }
+            )
+
+        return schedules
+
+    @classmethod
+    def is_due(cls, schedule: dict, now: float, last_build_time: float) -> bool:
+        """
+        Check if a schedule must run at a time.
+
+        Params:
+            schedule: a schedule, see schedules
+            now: the time, as a timestamp
+            last_build_time: when the last build of the project was queued,
+            None if it was never built
+
+        """
+        if schedule["cron"] is not None:
+            moment = datetime.datetime.fromtimestamp(now, schedule["timezone"])
+            if not schedule["cron"].matches(moment):
+                return False
+
+        if schedule["idle_hours"] is not None and last_build_time is not None:
+            return now - last_build_time >= schedule["idle_hours"] * 3600
+
+        return True
+
+    @classmethod
+    def tick(cls, now: float = None) -> list[int]:
+        """
+        Queue the builds of the schedules due at a time.
+
+        Params:
+            now: the time, as a timestamp, the current time if None
+
+        Returns:
+            The ids of the queued jobs
+
+        """
+        # Schedules are evaluated once per minute, at the start of the minute
+        now = (now if now is not None else time.time()) // 60 * 60
+
+        db_worker = DBWorker()
+        job_ids = []
+
+        for project in db_worker.iter_projects():
+            project_folder = os.path.join(
+                ProjectManager.parent_dir, "projects", project["name"]
+            )
+
+            with LogPipeline.context(project=project["name"]):
+                try:
+                    schedules = cls.schedules(TestRunner.load_config(project_folder))
+                except (tomllib.TOMLDecodeError, ValueError) as e:
+                    logger.error(f"invalid schedules: {e}")
+                    continue
+
+                for schedule in schedules:
+                    job_id = cls.__run_schedule(db_worker, project, schedule, now)
+                    if job_id is not None:
+                        job_ids.append(job_id)
+
+        return job_ids
+
+    @classmethod
+    def __run_schedule(
+        cls, db_worker: DBWorker, project: dict, schedule: dict, now: float
+    ) -> int:
+        """
+        Queue the build of a schedule if it is due.
+
+        Returns:
+            The id of the queued job, or None
+
+        """
+        trigger = f"schedule:{schedule['name']}"
+        last_build_time = db_worker.get_project_last_build_time(project["id"])
+
+        if not cls.is_due(schedule, now, last_build_time):
+            return None
+
+        if db_worker.has_pending_build_job(project["id"], trigger):
+            logger.info(f"{trigger} skipped, its previous build is not finished")
+            return None
+
+        if not db_worker.claim_schedule_run(project["id"], schedule["name"], now):
+            return None
+
+        job_id = JobQueue.enqueue(
+            project["name"],
+            schedule["branch"] or project["target_branch"],
+            trigger=trigger,
+            stages=schedule["stages"],
+        )
+        logger.info(f"{trigger}: build {job_id} queued")
+
+        return job_id
+
+    @classmethod
+    def run_forever(cls) -> None:
+        """
+        Evaluate the schedules at the start of every minute, until stop is called.
+
+        """
+        cls.__stop_event.clear()
+
+        while not cls.__stop_event.is_set():
+            try:
+                cls.tick()
+            except Exception:
+                logger.exception("scheduler tick failed")
+
+            cls.__stop_event.wait(cls.interval - time.time() % cls.interval)
+
+    @classmethod
+    def stop(cls) -> None:
+        cls.__stop_event.set()
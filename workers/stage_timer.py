@@ -0,0 +1,41 @@
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+from workers.enums import BuildStage
+
+
+class StageTimer:
+    """
+    Measure the wall time of each stage of a build.
+
+    A build can run on several machines (queued by the server, fetched
+    and tested by an agent, ingested by the server), so the timings
+    can be filled in several steps.
+
+    """
+
+    def __init__(self, timings: dict = None):
+        # Stage name -> duration in seconds
+        self.timings: dict[str, float] = dict(timings or {})
+
+    @contextmanager
+    def stage(self, stage: BuildStage) -> Iterator[None]:
+        """
+        Time the block of code of a stage.
+
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: BuildStage, duration: float) -> None:
+        """
+        Add a duration measured elsewhere to a stage.
+
+        """
+        self.timings[stage.value] = self.timings.get(stage.value, 0) + duration
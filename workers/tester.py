@@ -1,9 +1,25 @@
 import os
-import subprocess
+import re
+import shutil
+import tomllib
 
+from contextlib import ExitStack
+from datetime import datetime
 
+from typing import Iterator
+
+from workers.batch_diff import BatchDiff
 from workers.database import DBWorker
-from workers.enums import ExitCodes
+from workers.enums import BuildStage, ExitCodes
+from workers.file_lock import FileLock
+from workers.flaky_tests import FlakyTests
+from workers.matrix import BuildMatrix
+from workers.metrics import Metrics
+from workers.pipeline import Pipeline
+from workers.process_runner import ProcessRunner
+from workers.result_cache import ResultCache
+from workers.runners import TestRunner
+from workers.stage_timer import StageTimer
 
 import xml.etree.ElementTree as ET
 
@@ -20,18 +36,42 @@ class Tester:
     # Path to the bash_scripts directory
     __bash_scripts_dir = os.path.join(__parent_dir, "bash_scripts")
 
+    __setup_venv_script_path = os.path.join(__bash_scripts_dir, "setup_venv.sh")
+    __install_script_path = os.path.join(__bash_scripts_dir, "install_dependencies.sh")
     __test_script_path = os.path.join(__bash_scripts_dir, "run_tests.sh")
 
-    __db_worker = DBWorker()
+    @classmethod
+    def __database(cls) -> DBWorker:
+        # Opened on first use, importing the module does not touch the database
+        return DBWorker.instance()
 
     @classmethod
     def run_test_script(
-        cls, project_name: str, test_file_name: str
+        cls,
+        project_name: str,
+        test_file_name: str,
+        timer: StageTimer = None,
+        pipeline_results: dict = None,
+        cell: dict = None,
+        workspace: str = None,
+        quarantine: list[str] = None,
+        stages: list[str] = None,
     ) -> tuple[(ExitCodes, str)]:
         """
-        Runs a bash script that creates a venv and installs project dependencies.
+        Runs the bash scripts that create a venv, install project dependencies
+        and run the stages of the pipeline configured for the project.
 
-        The bash script then calls another bash script that run tests.
+        Each script is a stage of the build, timed with the given timer.
+
+        Params:
+            project_name: the name of the project
+            test_file_name: the test file saved with the project
+            timer: timer of the build stages
+            pipeline_results: filled with the status and duration of each pipeline stage
+            cell: the matrix cell to build (python version and env vars), see matrix.py
+            workspace: the checkout to test, the project folder if None
+            quarantine: tests whose failures do not fail their stage
+            stages: the pipeline stages to run, all of them if None
 
         Returns tuple with (success: Boolean, optional error message)
 
@@ -39,70 +79,531 @@ class Tester:
             see enums.py
 
         """
-        return_code = subprocess.call(
-            ["bash", cls.__test_script_path, project_name, test_file_name]
-        )
+        timer = timer or StageTimer()
+
+        # Venvs are kept in the project folder, the tests run in the workspace
+        project_folder = os.path.join(cls.__parent_dir, "projects", project_name)
+        workspace = workspace or project_folder
+
+        try:
+            pipeline = Pipeline.for_project(
+                workspace, test_file_name, cell=cell, only_stages=stages
+            )
+        except (ValueError, tomllib.TOMLDecodeError) as e:
+            return (False, f"Invalid {TestRunner.config_file}: {e}")
+
+        # A missing requirements file is fine when the runner installs the
+        # project through its extras, or only needs its own packages
+        requirements_paths = [
+            path
+            for path in (
+                os.path.join(workspace, requirements) for requirements in pipeline.requirements
+            )
+            if os.path.isfile(path)
+        ]
+
+        # Venvs are reused by the builds with the same requirements (and matrix cell)
+        venv_name = BuildMatrix.venv_name(cell) + "-" + pipeline.requirements_hash()
+        venv_folder = os.path.join(project_folder, venv_name)
+        venv_cached = "hit" if os.path.isdir(venv_folder) else "miss"
+        Metrics.cache_requests_total.inc(cache="venv", result=venv_cached)
+
+        with ExitStack() as venv_lock:
+            # Builds running at the same time must not install in the same venv together
+            venv_lock.enter_context(FileLock(venv_folder + ".lock"))
+
+            with timer.stage(BuildStage.ENV_SETUP):
+                return_code = ProcessRunner.call(
+                    [
+                        "bash",
+                        cls.__setup_venv_script_path,
+                        project_name,
+                        venv_name,
+                        BuildMatrix.python_executable(cell),
+                    ]
+                )
+
+            if return_code != ExitCodes.SUCCESS.value:
+                return cls.__exit_code_message(return_code)
+
+            with timer.stage(BuildStage.DEPENDENCY_INSTALL):
+                return_code = ProcessRunner.call(
+                    ["bash", cls.__install_script_path, project_name, venv_name]
+                    + [arg for path in requirements_paths for arg in ("-r", path)]
+                    + pipeline.pip_arguments()
+                )
+
+            # Here a generic error means pip failed, not that some tests failed
+            if return_code == ExitCodes.ERROR_EXIT.value:
+                return (False, "Could not install dependencies.")
+            elif return_code != ExitCodes.SUCCESS.value:
+                return cls.__exit_code_message(return_code)
+
+            cls.remove_old_venvs(project_folder, BuildMatrix.venv_name(cell), venv_name)
+
+            # Held while the tests run, so the venv is not removed under them.
+            # Taken before the install lock is released, see remove_old_venvs
+            with FileLock(venv_folder + ".use", shared=True):
+                # The venv points to the workspace when the project is installed
+                # with its extras, the venv stays locked until the tests are done
+                if "-e" not in pipeline.pip_arguments():
+                    venv_lock.close()
+
+                return cls.__run_pipeline(
+                    pipeline,
+                    project_name,
+                    venv_name,
+                    venv_folder,
+                    timer,
+                    pipeline_results,
+                    set(quarantine or []),
+                )
+
+    @classmethod
+    def remove_old_venvs(cls, project_folder: str, cell_venv: str, venv_name: str) -> None:
+        """
+        Remove the venvs of a cell built with other requirements.
+
+        A venv is skipped while a build installs in it or runs its tests,
+        the next build with newer requirements removes it.
+
+        Params:
+            project_folder: the folder holding the venvs of the project
+            cell_venv: the venv name of the cell, see BuildMatrix.venv_name
+            venv_name: the venv of the current requirements, kept
+
+        """
+        # Only the cell venvs, ".venv-py3.12-<hash>" is not a venv of ".venv"
+        old_venv = re.compile(re.escape(cell_venv) + r"-(?:[0-9a-f]{12}|none)")
 
+        for name in os.listdir(project_folder):
+            folder = os.path.join(project_folder, name)
+
+            if name == venv_name or not old_venv.fullmatch(name) or not os.path.isdir(folder):
+                continue
+
+            try:
+                with FileLock(folder + ".lock", blocking=False), FileLock(
+                    folder + ".use", blocking=False
+                ):
+                    shutil.rmtree(folder, ignore_errors=True)
+            except BlockingIOError:
+                continue
+
+    @classmethod
+    def __run_pipeline(
+        cls,
+        pipeline: Pipeline,
+        project_name: str,
+        venv_name: str,
+        venv_folder: str,
+        timer: StageTimer,
+        pipeline_results: dict,
+        quarantine: set[str],
+    ) -> tuple[(bool, str)]:
+        if (error := pipeline.check()) is not None:
+            return (False, error)
+
+        pipeline.clear_reports()
+
+        def run(runner: TestRunner, command: list[str]) -> int:
+            return ProcessRunner.call(
+                ["bash", cls.__test_script_path, project_name, venv_name]
+                + [runner.working_dir]
+                + command,
+                env=runner.environment(venv_folder),
+                timeout=runner.timeout,
+            )
+
+        def execute(runner: TestRunner) -> int:
+            return_code = run(runner, runner.command())
+
+            # Only the failed tests run again, a test passing now is flaky
+            for attempt in range(1, runner.reruns + 1):
+                if return_code == ExitCodes.SUCCESS.value:
+                    break
+
+                return_code = run(runner, runner.rerun_command(attempt))
+
+            if runner.reruns and (rerun_files := FlakyTests.rerun_files(runner.rerun_dir)):
+                FlakyTests.apply_reruns(runner.report_files(), rerun_files)
+
+            if return_code != ExitCodes.SUCCESS.value and quarantine:
+                failed = FlakyTests.failed_tests(runner.report_files())
+
+                if failed and failed <= quarantine:
+                    return ExitCodes.SUCCESS.value
+
+            return return_code
+
+        with timer.stage(BuildStage.TEST_RUN):
+            results = pipeline.run(execute)
+
+        if pipeline_results is not None:
+            pipeline_results.update(results)
+
+        failed = [
+            stage for stage, result in results.items() if result["status"] != "passed"
+        ]
+
+        # Without report the stages crashed before running any test
+        if not pipeline.report_files():
+            return (
+                False,
+                "No test report written"
+                + (f", stages not passed: {', '.join(failed)}" if failed else ""),
+            )
+
+        if failed:
+            return cls.__exit_code_message(ExitCodes.ERROR_EXIT.value)
+
+        return cls.__exit_code_message(ExitCodes.SUCCESS.value)
+
+    @classmethod
+    def __exit_code_message(cls, return_code: int) -> tuple[(bool, str)]:
         match return_code:
             case ExitCodes.SUCCESS.value:
                 return (True, "Success")
             case ExitCodes.ERROR_EXIT.value:
                 return (True, "Success with some errors")
             case ExitCodes.MISSING_REQUIREMENTS.value:
-                return (False, "requirements.txt does not exist")
+                return (False, "no requirements file and nothing else to install")
             case ExitCodes.MISSING_TEST_FILE.value:
                 return (False, "test file does not exist")
             case ExitCodes.VENV_CREATION_ERROR.value:
                 return (False, "Could not create venv folder.")
+            case ExitCodes.TIMEOUT.value:
+                return (False, "Timed out.")
+            case ExitCodes.CANCELLED.value:
+                return (False, "Cancelled.")
+            case _:
+                return (False, f"Test script exited with code {return_code}")
 
     @classmethod
-    def get_junitxml_file(cls, project_name: str) -> str:
+    def get_junitxml_files(
+        cls,
+        project_name: str,
+        cell: dict = None,
+        workspace: str = None,
+        stages: list[str] = None,
+    ) -> list[str]:
+        """
+        Get the junitxml reports written by the stages of the last test run of a project.
 
-        project_folder = os.path.join(cls.__parent_dir, "projects", project_name)
+        Reports written at the root of the project folder by older runs are
+        used when the stages did not write any.
 
-        xml_files = [
-            file for file in os.listdir(project_folder) if file.endswith(".xml")
-        ]
-        # We take the first file in the list
-        test_file = xml_files[0]
+        """
+        project_folder = workspace or os.path.join(
+            cls.__parent_dir, "projects", project_name
+        )
 
-        test_file_path = os.path.join(project_folder, test_file)
+        pipeline = Pipeline.for_project(project_folder, None, cell=cell, only_stages=stages)
 
-        return test_file_path
+        if report_files := pipeline.report_files():
+            return report_files
+
+        return [
+            os.path.join(project_folder, file)
+            for file in sorted(os.listdir(project_folder))
+            if file.endswith(".xml")
+        ][:1]
 
     @classmethod
-    def parse_junitxml_file(cls, project_name: str) -> None:
+    def merge_junitxml_files(cls, report_files: list[str]) -> ET.Element:
+        """
+        Put the test suites of several junitxml reports under one testsuites element.
+
+        """
+        root = ET.Element("testsuites")
 
-        # get_junitxml_file returns both the file name and the project folder path
-        test_file_path = cls.get_junitxml_file(project_name)
+        for report_file in report_files:
+            report_root = ET.parse(report_file).getroot()
 
-        tree = ET.parse(test_file_path)
-        root = tree.getroot()
+            if report_root.tag == "testsuite":
+                root.append(report_root)
+            else:
+                root.extend(report_root.findall("testsuite"))
+
+        return root
+
+    @classmethod
+    def read_junitxml_report(
+        cls,
+        project_name: str,
+        cell: dict = None,
+        workspace: str = None,
+        stages: list[str] = None,
+    ) -> str:
+        """
+        Get the reports of the last test run of a project as one junitxml document.
+
+        """
+        root = cls.merge_junitxml_files(
+            cls.get_junitxml_files(project_name, cell, workspace, stages)
+        )
+
+        return ET.tostring(root, encoding="unicode")
+
+    @classmethod
+    def parse_junitxml(cls, root: ET.Element) -> tuple[dict, Iterator]:
+        """
+        Extract the batch data and the test cases of a junitxml document.
+
+        The counts of the test suites are summed, runners like tox or
+        pytest-xdist may write several suites for one build.
+
+        Params:
+            root: root element of the junitxml document, testsuites or testsuite
+
+        Returns:
+            A tuple with the batch attributes (errors, failures, skipped, timestamp ...)
+            and a generator of (test name, duration, outcome) tuples, see
+            FlakyTests.test_name
+
+        """
+        testsuites = [root] if root.tag == "testsuite" else root.findall("testsuite")
 
         # Contains errors, failures, skipped, timestamp ...
-        test_result = root[0].attrib
+        test_result = dict(testsuites[0].attrib) if testsuites else {}
+
+        if len(testsuites) > 1:
+            for key in ("errors", "failures", "skipped", "tests"):
+                test_result[key] = str(
+                    sum(int(suite.get(key, 0)) for suite in testsuites)
+                )
+
+            test_result["time"] = str(
+                sum(float(suite.get("time", 0)) for suite in testsuites)
+            )
 
-        # Extract the testcases
-        testcases_elems = root[0].findall("testcase")
-        
         # generator expression
         testcases = (
-            (elem.attrib["name"], elem.attrib["time"]) for elem in testcases_elems
+            (FlakyTests.test_name(elem), elem.attrib["time"], FlakyTests.outcome(elem))
+            for suite in testsuites
+            for elem in suite.findall("testcase")
         )
 
+        return (test_result, testcases)
+
+    @classmethod
+    def parse_junitxml_file(
+        cls,
+        project_name: str,
+        cell: dict = None,
+        workspace: str = None,
+        stages: list[str] = None,
+    ) -> None:
+
+        root = cls.merge_junitxml_files(
+            cls.get_junitxml_files(project_name, cell, workspace, stages)
+        )
+
+        test_result, testcases = cls.parse_junitxml(root)
+
         return (project_name, test_result, testcases)
 
     @classmethod
-    def perform_tests(cls, project_name: str) -> None:
+    def ingest_results(
+        cls,
+        project_id: int,
+        test_result: dict,
+        testcases: Iterator,
+        timer: StageTimer = None,
+        pipeline_results: dict = None,
+        cache_key: str = None,
+        cell: dict = None,
+        stages: list[str] = None,
+    ) -> int:
         """
-        Run tests for a specific projects.
+        Insert a batch, its test cases, its stage timings and the results of
+        its pipeline stages to the database.
+
+        Params:
+            cache_key: the content hash tested by the batch, see result_cache.py
+                (the flakiness of a test is its outcomes on the same content)
+            cell: the matrix cell built, see matrix.py
+            stages: the pipeline stages run, all of them if None
 
-        Insert the test results to the database.
+        Returns:
+            The id of the inserted batch
 
         """
+        timer = timer or StageTimer()
+
+        with timer.stage(BuildStage.DB_INGEST):
+            variant = BatchDiff.variant(cell, stages)
+            batch_id = cls.__database().insert_test_batch(project_id, test_result, variant)
+
+            # Add testcases to the database
+            testcases = list(testcases)
+            cls.__database().insert_many_test_cases(batch_id, testcases)
+
+            cls.__insert_diff(project_id, batch_id, variant, testcases)
+
+            # Flakiness counters are updated with this batch only
+            cls.__database().update_test_flakiness(
+                project_id,
+                [(testcase[0], testcase[2]) for testcase in testcases if len(testcase) > 2],
+                cache_key,
+            )
+
+        cls.__database().insert_batch_stage_timings(batch_id, timer.timings)
+
+        if pipeline_results:
+            cls.__database().insert_batch_pipeline_stages(batch_id, pipeline_results)
+
+        # The next build of the same content may reuse these results
+        if cache_key is not None:
+            cls.__database().insert_cached_batch(cache_key, batch_id)
+
+        cls.__observe_timings(project_id, timer)
+
+        return batch_id
+
+    @classmethod
+    def __insert_diff(
+        cls, project_id: int, batch_id: int, variant: str, testcases: list
+    ) -> None:
+        """
+        Save the changes of the test cases since the previous batch of the
+        same variant, so the pages showing them never compare whole batches.
+
+        """
+        base_batch_id, previous = cls.__database().get_diff_base(
+            project_id, batch_id, variant
+        )
+
+        if base_batch_id is None:
+            return
+
+        diff = BatchDiff.compute(previous, testcases)
+
+        cls.__database().insert_batch_diff(
+            batch_id, base_batch_id, BatchDiff.counts(diff), BatchDiff.encode(diff)
+        )
+
+    @classmethod
+    def ingest_cached_results(
+        cls, project_id: int, cache_key: str, timer: StageTimer = None
+    ) -> int:
+        """
+        Insert a batch reusing the results of the batch that already tested
+        the same content, if any.
+
+        Params:
+            project_id: the id of the project
+            cache_key: the content hash of the build, see result_cache.py
+            timer: timings of the stages already run
+
+        Returns:
+            The id of the inserted batch, or None if the content was never tested
+
+        """
+        if cache_key is None or not ResultCache.enabled:
+            return None
+
+        source_batch_id = cls.__database().get_cached_batch(cache_key)
+
+        Metrics.cache_requests_total.inc(
+            cache="results", result="miss" if source_batch_id is None else "hit"
+        )
+
+        if source_batch_id is None:
+            return None
+
+        timer = timer or StageTimer()
+
+        with timer.stage(BuildStage.DB_INGEST):
+            batch_id = cls.__database().insert_cache_hit_batch(
+                project_id,
+                source_batch_id,
+                datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f"),
+            )
+
+        cls.__database().insert_batch_stage_timings(batch_id, timer.timings)
+        cls.__observe_timings(project_id, timer)
+
+        return batch_id
+
+    @classmethod
+    def __observe_timings(cls, project_id: int, timer: StageTimer) -> None:
+        project_name = cls.__database().get_project_by_id(project_id)["name"].lower()
+
+        for stage, duration in timer.timings.items():
+            Metrics.build_stage_duration.observe(
+                duration, project=project_name, stage=stage
+            )
+
+        Metrics.build_duration.observe(
+            sum(timer.timings.values()), project=project_name
+        )
+
+    @classmethod
+    def ingest_junitxml(
+        cls,
+        project_id: int,
+        junitxml: str,
+        timer: StageTimer = None,
+        pipeline_results: dict = None,
+        cache_key: str = None,
+        cell: dict = None,
+        stages: list[str] = None,
+    ) -> int:
+        """
+        Insert the results of a junitxml report uploaded by a build agent.
+
+        Params:
+            project_id: the id of the project
+            junitxml: content of the junitxml report
+            timer: timings of the stages already run by the agent
+            pipeline_results: status and duration of the pipeline stages run by the agent
+            cache_key: the content hash tested by the agent, see result_cache.py
+            cell: the matrix cell built by the agent
+            stages: the pipeline stages run by the agent, all of them if None
+
+        Returns:
+            The id of the inserted batch
+
+        """
+        timer = timer or StageTimer()
+
+        with timer.stage(BuildStage.REPORT_PARSE):
+            test_result, testcases = cls.parse_junitxml(ET.fromstring(junitxml))
+
+        return cls.ingest_results(
+            project_id,
+            test_result,
+            testcases,
+            timer,
+            pipeline_results,
+            cache_key,
+            cell,
+            stages,
+        )
+
+    @classmethod
+    def perform_tests(
+        cls,
+        project_name: str,
+        timer: StageTimer = None,
+        cell: dict = None,
+        workspace: str = None,
+        stages: list[str] = None,
+    ) -> dict:
+        """
+        Run tests for a specific projects, for one cell of its matrix if given,
+        in a build workspace if given, only the given pipeline stages if given.
+
+        Insert the test results, the timings of each stage and the results of
+        the pipeline stages to the database.
+
+        """
+        timer = timer or StageTimer()
+        pipeline_results = {}
 
         # Check if project exists in the database
-        project = cls.__db_worker.get_project(
+        project = cls.__database().get_project(
             project_name.lower()
         )  # project_name is always lowercase in the database
 
@@ -115,16 +616,53 @@ class Tester:
         project_id = project[0]
         test_file = project[2]
 
+        # A workspace is a clean checkout, its content may already be tested
+        cache_key = None
+
+        if workspace is not None:
+            cache_key = ResultCache.key(workspace, test_file, cell, stages)
+
+            if (batch_id := cls.ingest_cached_results(project_id, cache_key, timer)) is not None:
+                return {
+                    "status": "success",
+                    "message": "Same content already tested, results reused",
+                    "batch_id": batch_id,
+                }
+
         # Run the test script
-        success, message = cls.run_test_script(project_name, test_file)
+        success, message = cls.run_test_script(
+            project_name,
+            test_file,
+            timer,
+            pipeline_results,
+            cell,
+            workspace,
+            cls.__database().get_quarantined_tests(project_id),
+            stages,
+        )
 
         if success is False:
             return {"status": "error", "message": message}
 
+        # The build was preempted or lost its lease, its reports are incomplete
+        if ProcessRunner.cancelled():
+            return {"status": "error", "message": "Cancelled."}
+
         # Parse the junitxml file
-        project_name, test_result, testcases = cls.parse_junitxml_file(project_name)
+        with timer.stage(BuildStage.REPORT_PARSE):
+            project_name, test_result, testcases = cls.parse_junitxml_file(
+                project_name, cell, workspace, stages
+            )
+
+        batch_id = cls.ingest_results(
+            project_id,
+            test_result,
+            testcases,
+            timer,
+            pipeline_results,
+            cache_key,
+            cell,
+            stages,
+        )
 
-        batch_id = cls.__db_worker.insert_test_batch(project_id, test_result)
-        
-        # Add testcases to the database
-        cls.__db_worker.insert_many_test_cases(batch_id, list(testcases))
\ No newline at end of file
+        return {"status": "success", "message": message, "batch_id": batch_id}
@@ -0,0 +1,182 @@
+"""
+Run unittest tests in parallel and write a junitxml report.
+
+Usage:
+    python unittest_junit.py <report> <workers> <start_dir> <pattern>
+
+Runs with the python of the project venv, so it only uses the standard library.
+Test modules are spread over the worker processes.
+
+Exit codes:
+    0 if all tests passed, 1 otherwise
+
+"""
+
+import os
+import sys
+import time
+import traceback
+import unittest
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+
+class JunitResult(unittest.TestResult):
+    """
+    Keep the outcome and duration of each test.
+
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.cases = []
+        self.__start = None
+
+    def startTest(self, test):
+        super().startTest(test)
+        self.__start = time.perf_counter()
+
+    def __add(self, test, outcome: str, message: str = None) -> None:
+        classname, _, name = test.id().rpartition(".")
+        self.cases.append(
+            {
+                "classname": classname,
+                "name": name,
+                "time": time.perf_counter() - (self.__start or time.perf_counter()),
+                "outcome": outcome,
+                "message": message,
+            }
+        )
+
+    def addSuccess(self, test):
+        super().addSuccess(test)
+        self.__add(test, "passed")
+
+    def addFailure(self, test, err):
+        super().addFailure(test, err)
+        self.__add(test, "failure", "".join(traceback.format_exception(*err)))
+
+    def addError(self, test, err):
+        super().addError(test, err)
+        self.__add(test, "error", "".join(traceback.format_exception(*err)))
+
+    def addSkip(self, test, reason):
+        super().addSkip(test, reason)
+        self.__add(test, "skipped", reason)
+
+    def addExpectedFailure(self, test, err):
+        super().addExpectedFailure(test, err)
+        self.__add(test, "passed")
+
+    def addUnexpectedSuccess(self, test):
+        super().addUnexpectedSuccess(test)
+        self.__add(test, "failure", "unexpected success")
+
+
+def iter_tests(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_tests(test)
+        else:
+            yield test
+
+
+def run_tests(start_dir: str, names: list[str]) -> list[dict]:
+    """
+    Run tests by name, in a worker process.
+
+    """
+    sys.path.insert(0, start_dir)
+
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names)
+    result = JunitResult()
+    suite.run(result)
+
+    return result.cases
+
+
+def write_report(report: str, cases: list[dict], duration: float) -> None:
+    counts = {outcome: 0 for outcome in ("failure", "error", "skipped")}
+
+    for case in cases:
+        counts[case["outcome"]] = counts.get(case["outcome"], 0) + 1
+
+    testsuites = ET.Element("testsuites")
+    testsuite = ET.SubElement(
+        testsuites,
+        "testsuite",
+        name="unittest",
+        errors=str(counts["error"]),
+        failures=str(counts["failure"]),
+        skipped=str(counts["skipped"]),
+        tests=str(len(cases)),
+        time=f"{duration:.3f}",
+        timestamp=datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f"),
+    )
+
+    for case in cases:
+        testcase = ET.SubElement(
+            testsuite,
+            "testcase",
+            classname=case["classname"],
+            name=case["name"],
+            time=f"{case['time']:.3f}",
+        )
+
+        if case["outcome"] != "passed":
+            message = (case["message"] or "").strip()
+
+            # The last line of a traceback is the exception
+            child = ET.SubElement(testcase, case["outcome"])
+            child.set("message", message.splitlines()[-1] if message else "")
+            child.text = message
+
+    os.makedirs(os.path.dirname(os.path.abspath(report)), exist_ok=True)
+    ET.ElementTree(testsuites).write(report, encoding="utf-8", xml_declaration=True)
+
+
+def main(report: str, workers: int, start_dir: str, pattern: str) -> int:
+    start = time.perf_counter()
+    start_dir = os.path.abspath(start_dir)
+    sys.path.insert(0, start_dir)
+
+    suite = unittest.defaultTestLoader.discover(start_dir, pattern=pattern)
+
+    # Modules that failed to import cannot be loaded by name, they run here
+    modules: dict[str, list[str]] = {}
+    broken = unittest.TestSuite()
+
+    for test in iter_tests(suite):
+        if isinstance(test, unittest.loader._FailedTest):
+            broken.addTest(test)
+        else:
+            module = test.id().rsplit(".", 2)[0]
+            modules.setdefault(module, []).append(test.id())
+
+    broken_result = JunitResult()
+    broken.run(broken_result)
+    cases = broken_result.cases
+
+    # Round robin of the modules over the workers
+    chunks = [[] for _ in range(max(min(workers, len(modules)), 1))]
+    for index, names in enumerate(modules.values()):
+        chunks[index % len(chunks)].extend(names)
+
+    if len(chunks) == 1:
+        cases += run_tests(start_dir, chunks[0])
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            for chunk_cases in executor.map(run_tests, [start_dir] * len(chunks), chunks):
+                cases += chunk_cases
+
+    write_report(report, cases, time.perf_counter() - start)
+
+    failed = any(case["outcome"] in ("failure", "error") for case in cases)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    report, workers, start_dir, pattern = sys.argv[1:5]
+    sys.exit(main(report, int(workers), start_dir, pattern))